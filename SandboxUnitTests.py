@@ -143,6 +143,42 @@ import SandboxUnitTestTasking
 import sandbox_TOEM
 testsuite.append(unittest.TestLoader().loadTestsFromModule(sandbox_TOEM))
 
+import sandbox_spatial
+testsuite.append(unittest.TestLoader().loadTestsFromModule(sandbox_spatial))
+
+import sandbox_scheduler
+testsuite.append(unittest.TestLoader().loadTestsFromModule(sandbox_scheduler))
+
+import sandbox_montecarlo
+testsuite.append(unittest.TestLoader().loadTestsFromModule(sandbox_montecarlo))
+
+import sandbox_writer
+testsuite.append(unittest.TestLoader().loadTestsFromModule(sandbox_writer))
+
+import sandbox_profiler
+testsuite.append(unittest.TestLoader().loadTestsFromModule(sandbox_profiler))
+
+import sandbox_benchmark
+testsuite.append(unittest.TestLoader().loadTestsFromModule(sandbox_benchmark))
+
+import sandbox_checkpoint
+testsuite.append(unittest.TestLoader().loadTestsFromModule(sandbox_checkpoint))
+
+import sandbox_server
+testsuite.append(unittest.TestLoader().loadTestsFromModule(sandbox_server))
+
+import sandbox_branches
+testsuite.append(unittest.TestLoader().loadTestsFromModule(sandbox_branches))
+
+import sandbox_random
+testsuite.append(unittest.TestLoader().loadTestsFromModule(sandbox_random))
+
+import sandbox_map
+testsuite.append(unittest.TestLoader().loadTestsFromModule(sandbox_map))
+
+import algo_Astar
+testsuite.append(unittest.TestLoader().loadTestsFromModule(algo_Astar))
+
 # Collate all and run
 allsuite = unittest.TestSuite(testsuite)
 unittest.TextTestRunner(verbosity=2).run(allsuite)
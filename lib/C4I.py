@@ -2,7 +2,7 @@
 
 
 # General imports from the Python build
-from random import random
+from sandbox_random import random
 
 # Sandbox stuff
 from sandbox_TOEM import TOEMargument
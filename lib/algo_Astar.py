@@ -0,0 +1,504 @@
+'''!
+        A* - Generic grid search algorithm
+        OPCON Sandbox -- Extensible Operational level military simulation.
+        Copyright (C) 2007 Christian Blouin
+
+        This program is free software; you can redistribute it and/or modify
+        it under the terms of the GNU General Public License version 2 as published by
+        the Free Software Foundation.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License along
+        with this program; if not, write to the Free Software Foundation, Inc.,
+        51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+from heapq import heappush, heappop
+
+SQRT2 = 2**0.5
+
+# Cells this costly (friction under 0.001) don't make portals between clusters
+BLOCKED = 1000.0
+
+class Grid_Astar:
+    '''! \brief Least cost path on a grid of cell costs (cost per unit of length), 8-connected.
+
+         A step between neighbors costs its length times the mean cost of the two cells and a straight
+         line costs its length times the mean cost of the cells sampled along it. Cells are addressed
+         as (x,y) tuples and the length unit is the side of a cell.
+
+         \param cost a 2D array (numpy or nested lists) indexed as [y][x].
+    '''
+    def __init__(self, cost):
+        self.H = len(cost)
+        self.W = len(cost[0])
+
+        # Flat list of costs with a border of -1.0 around the grid (no bound checks in the search).
+        self.W2 = self.W + 2
+        self.C = [-1.0] * self.W2
+        for row in cost:
+            self.C.append(-1.0)
+            self.C.extend([float(i) for i in row])
+            self.C.append(-1.0)
+        self.C.extend([-1.0] * self.W2)
+
+        # The cheapest cell makes the heuristic admissible.
+        self.mincost = min([i for i in self.C if i >= 0.0])
+
+        # Neighbors as offsets in the flat list
+        W2 = self.W2
+        self.neighbors = [(1,1.0),(-1,1.0),(W2,1.0),(-W2,1.0),(W2+1,SQRT2),(W2-1,SQRT2),(-W2+1,SQRT2),(-W2-1,SQRT2)]
+
+    def Solve(self, start, goal):
+        '''! \brief Search from start to goal.
+             \return a list of cells from start to goal (inclusive) and the cost of the path.
+        '''
+        W2 = self.W2
+        C = self.C
+        s = self.Index(start)
+        t = self.Index(goal)
+        if s == t:
+            return [start], 0.0
+
+        # Octile distance to the goal, scaled by the cheapest cost
+        tx, ty = t % W2, t // W2
+        h = self.mincost
+        k = (SQRT2 - 1.0) * h
+
+        g = [1E300] * len(C)
+        g[s] = 0.0
+        parent = {s:s}
+        closed = bytearray(len(C))
+        heap = [(0.0, s)]
+        neighbors = self.neighbors
+
+        while heap:
+            f, u = heappop(heap)
+            if closed[u]:
+                continue
+            if u == t:
+                break
+            closed[u] = 1
+
+            gu = g[u]
+            cu = C[u]
+            for off, d in neighbors:
+                v = u + off
+                cv = C[v]
+                if cv < 0.0 or closed[v]:
+                    continue
+                gv = gu + d * (cu + cv) * 0.5
+                if gv < g[v]:
+                    g[v] = gv
+                    parent[v] = u
+                    dx = abs(v % W2 - tx)
+                    dy = abs(v // W2 - ty)
+                    if dx < dy:
+                        heappush(heap, (gv + h*dy + k*dx, v))
+                    else:
+                        heappush(heap, (gv + h*dx + k*dy, v))
+
+        if not t in parent:
+            return [], None
+
+        # Trace back
+        out = [t]
+        while out[-1] != s:
+            out.append(parent[out[-1]])
+        out.reverse()
+
+        return [self.Cell(i) for i in out], g[t]
+
+    def StringPull(self, path):
+        '''! \brief Lazy string pulling, drop the cells that can be joined by a cheaper straight line.
+             \param path A list of cells as returned by Solve.
+             \return a shorter list of cells.
+        '''
+        if len(path) <= 2:
+            return path
+        P = [self.Index(i) for i in path]
+
+        # Cost along the path from the start
+        G = [0.0]
+        for i in range(1,len(P)):
+            G.append(G[-1] + self.LineCost(P[i-1], P[i]))
+
+        out = [P[0]]
+        anchor = 0
+        for i in range(2, len(P)):
+            # Can we go straight from the anchor to i?
+            if self.LineCost(P[anchor], P[i]) > G[i] - G[anchor] + 1E-9:
+                anchor = i - 1
+                out.append(P[anchor])
+        out.append(P[-1])
+
+        return [self.Cell(i) for i in out]
+
+    def PathCost(self, path):
+        '''! \brief Cost of a list of cells joined by straight lines.
+        '''
+        out = 0.0
+        for i in range(1,len(path)):
+            out += self.LineCost(self.Index(path[i-1]), self.Index(path[i]))
+        return out
+
+    def Dijkstra(self, start, box, goals = ()):
+        '''! \brief Least costs from start to the cells of a box, the search doesn't leave the box.
+             \param box (x0,y0,x1,y1) in cells, x1 and y1 excluded.
+             \param goals The search stops once all these cells are reached.
+             \return dictionaries of costs and parents keyed by cell index.
+        '''
+        W2 = self.W2
+        C = self.C
+        x0, y0, x1, y1 = box
+        allowed = set()
+        for y in xrange(y0, y1):
+            i = (y + 1) * W2 + 1
+            allowed.update(xrange(i + x0, i + x1))
+
+        s = self.Index(start)
+        left = set([self.Index(i) for i in goals])
+        g = {s:0.0}
+        parent = {s:s}
+        closed = set()
+        heap = [(0.0, s)]
+        neighbors = self.neighbors
+
+        while heap:
+            gu, u = heappop(heap)
+            if u in closed:
+                continue
+            closed.add(u)
+            if u in left:
+                left.remove(u)
+                if not left:
+                    break
+
+            cu = C[u]
+            for off, d in neighbors:
+                v = u + off
+                cv = C[v]
+                if cv < 0.0 or not v in allowed or v in closed:
+                    continue
+                gv = gu + d * (cu + cv) * 0.5
+
+                if gv < g.get(v, 1E300):
+                    g[v] = gv
+                    parent[v] = u
+                    heappush(heap, (gv, v))
+
+        return g, parent
+
+    # Private methods
+    def Index(self, cell):
+        return (cell[1] + 1) * self.W2 + cell[0] + 1
+
+    def Cell(self, index):
+        return (index % self.W2 - 1, index // self.W2 - 1)
+
+    def LineCost(self, a, b):
+        '''! \brief Cost of the straight line between two cell indices (sampled twice per cell).
+        '''
+        W2 = self.W2
+        C = self.C
+        ax, ay = a % W2, a // W2
+        dx = b % W2 - ax
+        dy = b // W2 - ay
+        N = 2 * max(abs(dx), abs(dy))
+        if N == 0:
+            return 0.0
+        tot = 0.0
+        for i in xrange(N + 1):
+            f = float(i) / N
+            tot += C[int(ay + dy*f + 0.5) * W2 + int(ax + dx*f + 0.5)]
+        return (dx*dx + dy*dy)**0.5 * tot / (N + 1)
+
+
+class Grid_HPA:
+    '''! \brief Hierarchical A* (HPA*) on top of a Grid_Astar.
+
+         The grid is cut into square clusters. Portals are pairs of cells facing each other across
+         the border of two clusters, one per stretch of passable border. The abstract graph links the
+         portals of a cluster by their least cost within the cluster, a search on this small graph
+         is then refined cluster by cluster. Paths are near optimal.
+
+         The abstract graph can be pickled, the grid search is left out and must be set again
+         (attribute search) after loading.
+         \param search A Grid_Astar
+         \param size The side of a cluster in cells.
+    '''
+    def __init__(self, search, size = 32):
+        self.search = search
+        self.size = size
+        self.W = search.W
+        self.H = search.H
+
+        # Portal indices for each cluster (I,J)
+        self.portals = {}
+        # Edges of the abstract graph, index : list of (index, cost)
+        self.edges = {}
+        self.Build()
+
+    def __getstate__(self):
+        out = self.__dict__.copy()
+        del out['search']
+        return out
+
+    def Build(self):
+        '''! \brief Find the portals and cost the edges of the abstract graph.
+        '''
+        S = self.size
+        NI = (self.W + S - 1) // S
+        NJ = (self.H + S - 1) // S
+        for I in range(NI):
+            for J in range(NJ):
+                self.portals[(I,J)] = []
+
+        # Portals on vertical, then horizontal borders
+        for I in range(NI-1):
+            x = (I + 1) * S
+            for J in range(NJ):
+                pairs = [((x-1,y),(x,y)) for y in range(J*S, min(J*S + S, self.H))]
+                self.Entrances(pairs, (I,J), (I+1,J))
+        for J in range(NJ-1):
+            y = (J + 1) * S
+            for I in range(NI):
+                pairs = [((x,y-1),(x,y)) for x in range(I*S, min(I*S + S, self.W))]
+                self.Entrances(pairs, (I,J), (I,J+1))
+
+        # Intra-cluster edges, costs are symmetric
+        for cluster in self.portals:
+            P = self.portals[cluster]
+            box = self.Box(cluster)
+            for i in range(len(P) - 1):
+                g, parent = self.search.Dijkstra(self.search.Cell(P[i]), box, [self.search.Cell(j) for j in P[i+1:]])
+                for j in P[i+1:]:
+                    if j in g:
+                        self.edges[P[i]].append((j, g[j]))
+                        self.edges[j].append((P[i], g[j]))
+
+    def Solve(self, start, goal):
+        '''! \brief Search from start to goal, plain A* if they are in the same or neighboring clusters.
+             \return a list of cells from start to goal (inclusive) and the cost of the path.
+        '''
+        search = self.search
+        cs = self.Cluster(start)
+        ct = self.Cluster(goal)
+        if max(abs(cs[0] - ct[0]), abs(cs[1] - ct[1])) <= 1:
+            return search.Solve(start, goal)
+
+        # Link the end points to the portals of their clusters
+        s = search.Index(start)
+        t = search.Index(goal)
+        gs, ps = search.Dijkstra(start, self.Box(cs), [search.Cell(i) for i in self.portals[cs]])
+        gt, pt = search.Dijkstra(goal, self.Box(ct), [search.Cell(i) for i in self.portals[ct]])
+        first = [(i, gs[i]) for i in self.portals[cs] if i in gs]
+        last = dict([(i, gt[i]) for i in self.portals[ct] if i in gt])
+
+        route, cost = self.SolveAbstract(s, t, first, last)
+        if route is None:
+            return search.Solve(start, goal)
+
+        # Refine each hop of the route
+        out = [s]
+        for i in range(1, len(route)):
+            a, b = route[i-1], route[i]
+            if self.Cluster(search.Cell(a)) != self.Cluster(search.Cell(b)):
+                # Across a border
+                out.append(b)
+            elif a == s:
+                out.extend(self.Trace(ps, s, b)[1:])
+            elif b == t:
+                temp = self.Trace(pt, t, a)
+                temp.reverse()
+                out.extend(temp[1:])
+            else:
+                g, parent = search.Dijkstra(search.Cell(a), self.Box(self.Cluster(search.Cell(a))), [search.Cell(b)])
+                out.extend(self.Trace(parent, a, b)[1:])
+
+        return [search.Cell(i) for i in out], cost
+
+    def SolveAbstract(self, s, t, first, last):
+        '''! \brief A* on the abstract graph from s to t.
+             \param first Edges out of s.
+             \param last Costs to t from the portals of its cluster.
+             \return the list of indices from s to t and the cost, (None, None) if there are none.
+        '''
+        W2 = self.search.W2
+        h = self.search.mincost
+        k = (SQRT2 - 1.0) * h
+        tx, ty = t % W2, t // W2
+
+        g = {s:0.0}
+        parent = {s:s}
+        closed = set()
+        heap = [(0.0, s)]
+        while heap:
+            f, u = heappop(heap)
+            if u in closed:
+                continue
+            if u == t:
+                break
+            closed.add(u)
+
+            out = self.edges.get(u, [])
+            if u == s:
+                out = first + out
+            if u in last:
+                out = out + [(t, last[u])]
+            gu = g[u]
+            for v, c in out:
+                if v in closed:
+                    continue
+                gv = gu + c
+                if gv < g.get(v, 1E300):
+                    g[v] = gv
+                    parent[v] = u
+                    dx = abs(v % W2 - tx)
+                    dy = abs(v // W2 - ty)
+                    if dx < dy:
+                        heappush(heap, (gv + h*dy + k*dx, v))
+                    else:
+                        heappush(heap, (gv + h*dx + k*dy, v))
+
+        if not t in parent:
+            return None, None
+        return self.Trace(parent, s, t), g[t]
+
+    # Private methods
+    def Cluster(self, cell):
+        return (cell[0] // self.size, cell[1] // self.size)
+
+    def Box(self, cluster):
+        x0 = cluster[0] * self.size
+        y0 = cluster[1] * self.size
+        return (x0, y0, min(x0 + self.size, self.W), min(y0 + self.size, self.H))
+
+    def Trace(self, parent, a, b):
+        '''! \brief The indices from a to b following the parents of b.
+        '''
+        out = [b]
+        while out[-1] != a:
+            out.append(parent[out[-1]])
+        out.reverse()
+        return out
+
+    def Entrances(self, pairs, a, b):
+        '''! \brief Make portals along the border between clusters a and b.
+
+             Passable stretches of the border are cut in pieces of half a cluster, the cheapest
+             crossing of each piece is a portal.
+             \param pairs Facing cells (in a, in b) along the border.
+        '''
+        C = self.search.C
+        chunk = max(1, self.size // 2)
+        run = []
+        for ca, cb in pairs:
+            ia = self.search.Index(ca)
+            ib = self.search.Index(cb)
+            if 0.0 <= C[ia] < BLOCKED and 0.0 <= C[ib] < BLOCKED:
+                run.append((C[ia] + C[ib], ia, ib))
+                if len(run) < chunk:
+                    continue
+            if run:
+                self.Link(min(run), a, b)
+                run = []
+        if run:
+            self.Link(min(run), a, b)
+
+    def Link(self, crossing, a, b):
+        c, ia, ib = crossing
+        for i, cluster in [(ia, a), (ib, b)]:
+            if not i in self.edges:
+                self.edges[i] = []
+                self.portals[cluster].append(i)
+        self.edges[ia].append((ib, c * 0.5))
+        self.edges[ib].append((ia, c * 0.5))
+
+
+import unittest
+class AstarTest(unittest.TestCase):
+    def setUp(self):
+        # A wall at x = 5 with a gap at the bottom
+        self.cost = [[1.0] * 10 for y in range(10)]
+        for y in range(9):
+            self.cost[y][5] = 1000.0
+        self.search = Grid_Astar(self.cost)
+
+    def StepCost(self, path):
+        '''! \brief The cost of a path of neighboring cells, summed step by step.
+        '''
+        out = 0.0
+        for i in range(1, len(path)):
+            (ax, ay), (bx, by) = path[i-1], path[i]
+            self.assertEqual(max(abs(ax - bx), abs(ay - by)), 1)
+            out += ((ax - bx)**2 + (ay - by)**2)**0.5 * (self.cost[ay][ax] + self.cost[by][bx]) * 0.5
+        return out
+
+
+    def testOpenGround(self):
+        search = Grid_Astar([[1.0] * 10 for y in range(10)])
+        path, cost = search.Solve((0,0), (9,9))
+        self.assertEqual([len(path), path[0], path[-1]], [10, (0,0), (9,9)])
+        self.assertAlmostEqual(cost, 9 * SQRT2)
+        self.assertEqual([search.Solve((0,0), (9,0))[1], search.Solve((3,3), (3,3))], [9.0, ([(3,3)], 0.0)])
+
+    def testKnownOptimum(self):
+        # Least costs to all cells
+        g, parent = self.search.Dijkstra((0,0), (0, 0, 10, 10))
+        for goal in [(9,0), (9,9), (6,2), (4,8)]:
+            path, cost = self.search.Solve((0,0), goal)
+            self.assertAlmostEqual(cost, g[self.search.Index(goal)])
+            self.assertAlmostEqual(self.StepCost(path), cost)
+        self.assertTrue((5,9) in self.search.Solve((0,0), (9,0))[0])
+
+    def testUnreachable(self):
+        cost = [[1.0, -1.0, 1.0] for y in range(3)]
+        self.assertEqual(Grid_Astar(cost).Solve((0,0), (2,2)), ([], None))
+
+    def testStringPull(self):
+        search = Grid_Astar([[1.0] * 10 for y in range(10)])
+        path, cost = search.Solve((0,0), (9,3))
+        self.assertEqual(search.StringPull(path), [(0,0), (9,3)])
+        # Around the wall, never cutting through it
+        path, cost = self.search.Solve((0,0), (9,0))
+        pulled = self.search.StringPull(path)
+        self.assertEqual([pulled[0], pulled[-1], len(pulled) < len(path)], [(0,0), (9,0), True])
+        self.assertTrue(self.search.PathCost(pulled) <= self.search.PathCost(path) + 1E-9)
+        self.assertTrue(self.search.PathCost(pulled) < 1000.0)
+
+class HPATest(unittest.TestCase):
+    StepCost = AstarTest.StepCost.im_func
+
+    def setUp(self):
+        # Rolling costs, a river at x = 20 with two fords and a few obstacles
+        self.cost = [[1.0 + ((3*x + 7*y) % 11) / 5.0 for x in range(48)] for y in range(48)]
+        for y in range(48):
+            if not y in [6, 40]:
+                self.cost[y][20] = 50.0
+        for x in range(30, 44):
+            self.cost[24][x] = -1.0
+        self.search = Grid_Astar(self.cost)
+        self.hpa = Grid_HPA(self.search, 8)
+
+    def testNearOptimal(self):
+        for start, goal in [((0,0), (47,47)), ((2,30), (45,10)), ((47,0), (0,47)), ((35,20), (35,30))]:
+            path, cost = self.hpa.Solve(start, goal)
+            best = self.search.Solve(start, goal)[1]
+            self.assertEqual([path[0], path[-1]], [start, goal])
+            self.assertAlmostEqual(self.StepCost(path), cost)
+            self.assertTrue(best - 1E-9 <= cost <= 1.1 * best)
+
+    def testNeighborClusters(self):
+        # Plain A* between neighboring clusters
+        self.assertEqual(self.hpa.Solve((1,1), (12,12)), self.search.Solve((1,1), (12,12)))
+
+    def testPickle(self):
+        from pickle import loads, dumps, HIGHEST_PROTOCOL
+        graph = loads(dumps(self.hpa, HIGHEST_PROTOCOL))
+        self.assertFalse(hasattr(graph, 'search'))
+        graph.search = self.search
+        self.assertEqual(graph.Solve((0,0), (47,47)), self.hpa.Solve((0,0), (47,47)))
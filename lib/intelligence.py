@@ -16,7 +16,7 @@
         with this program; if not, write to the Free Software Foundation, Inc.,
         51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 '''
-from random import random, choice, expovariate
+from sandbox_random import random, choice, expovariate
 from math import pi
 
 from copy import copy
@@ -325,6 +325,10 @@ class sandbox_contact:
     # Set the field
     if Key in ['personel', 'vehicle']:
       for i in value:
+        # Sightings are {'ID','count'}, or 'count X ID' in older contacts
+        if type(i) == type({}):
+          self.EquipmentSighting(Key, i['ID'], i['count'])
+          continue
         n = i[:i.find('X')].strip()
         kind = i[i.find('X')+1:].strip()
         self.EquipmentSighting(Key, kind, n)
@@ -412,7 +416,7 @@ class sandbox_contact:
     out = ''
     # Itermize
     for i in xx:
-      out += html.Tag( 'li' , '%s X %s'%(xx[i]['count'], xx[i]['ID']) )
+      out += html.Tag( 'li' , '%s X %s'%(i['count'], i['ID']) )
       
     # Wrap into a <ul>
     out = html.Tag('ul',out)
@@ -612,9 +616,10 @@ class system_intelligence(system_base.system_base):
     
 
   # Simulation Interface
-  def AcquireTarget(self, E, tgt):
+  def AcquireTarget(self, E, tgt, reach = None):
     ''' Process the detection of each sensor owned by E on target tgt.
-        Returns the contact to tgt.
+        Returns the contact to tgt. reach is the overlap of the sensors' areas with tgt, if known
+        (see SensorReach).
         
         Algorithm:
         
@@ -635,7 +640,7 @@ class system_intelligence(system_base.system_base):
     # Go over each sensor
     for s in sensors:
       # Get the argument on whether there will be an acquisition
-      argument = self.AcquireWithSensor(E, s, tgt)
+      argument = self.AcquireWithSensor(E, s, tgt, reach)
       
       # Factor in levels of deception
       for i in range(cnt.DeceptionLevel()):
@@ -671,8 +676,19 @@ class system_intelligence(system_base.system_base):
     return self['signature']['deployed']  
   
   
+  def SensorReach(self, E, targets):
+    ''' Whether the area of each sensor of E overlaps each target, for all targets at once.
+        Returns a dictionary {max range: overlap} for each target.
+    '''
+    footprints = [tgt.Footprint() for tgt in targets]
+    reach = {}
+    for s in self.EnumerateSensors(E):
+      if s.max_range and not s.max_range in reach:
+        reach[s.max_range] = sandbox_geometry.circle(E.Position(), s.max_range).OverlapsAny(footprints)
+    return [dict([(r, reach[r][i]) for r in reach]) for i in range(len(targets))]
+  
   # Private Methods
-  def AcquireWithSensor(self, E, sensor, tgt):
+  def AcquireWithSensor(self, E, sensor, tgt, reach = None):
     ''' Algorithm:
         
         SIGNAL <- GET sensor's signal
@@ -681,17 +697,22 @@ class system_intelligence(system_base.system_base):
         
     '''
     # Footprint overlap
-    if sensor.max_range:
-      # A circular area
-      sensor.AoI = sandbox_geometry.circle(E.Position(),sensor.max_range)
-    else:
-      # No footprint
-      sensor.AoI = None
-    
-    if sensor.AoI:
-      # If defined, check for overlap
-      if not sensor.AoI.Overlaps(tgt.Footprint()):
+    if reach != None and sensor.max_range in reach:
+      # Already solved (see SensorReach)
+      if not reach[sensor.max_range]:
         return TOEMargument(base_prob='impossible')
+    else:
+      if sensor.max_range:
+        # A circular area
+        sensor.AoI = sandbox_geometry.circle(E.Position(),sensor.max_range)
+      else:
+        # No footprint
+        sensor.AoI = None
+      
+      if sensor.AoI:
+        # If defined, check for overlap
+        if not sensor.AoI.Overlaps(tgt.Footprint()):
+          return TOEMargument(base_prob='impossible')
     
     # Signal Type
     signal = sensor.signal
@@ -896,7 +917,7 @@ class system_intelligence(system_base.system_base):
     # Get Current task
     act = opord.GetCurrentSubTask()
     if act:
-      return act.type
+      return act.task_type
     # No task...
     return 'idle'
   
@@ -1048,6 +1069,14 @@ class IntelligenceModelTest(unittest.TestCase):
     
     self.assertTrue(True)
     
+  def testFieldActivity(self):
+    from sandbox_entity import sandbox_entity
+    from sandbox_tasks import sandbox_task
+    E = sandbox_entity()
+    task = sandbox_task()
+    E['OPORD'].AddTask(task)
+    self.assertEqual(system_intelligence().ExtractFieldactivity(None, E), task.GetSubTask().task_type)
+    
 class ContactTest(unittest.TestCase):
   def setUp(self):
     from sandbox_XML import sandboXML
@@ -1140,6 +1169,12 @@ class ContactTest(unittest.TestCase):
     x.UpdateField('size','Plt', 0)
     
     self.assertEqual(x.GetField('size'), 'Plt')
+    
+  def testEquipmentSightings(self):
+    x = sandbox_contact()
+    x.UpdateField('vehicle', [{'ID':'M1','count':2}, {'ID':'M1','count':3}, {'ID':'HMMWV','count':1}])
+    self.assertEqual(x.GetField('vehicle'), [{'ID':'M1','count':3}, {'ID':'HMMWV','count':1}])
+    self.assertTrue(x.WriteFieldvehicle().find('3 X M1') != -1)
 
 
     
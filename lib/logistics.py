@@ -466,9 +466,12 @@ class system_logistics(system_base.system_base):
     '''
        Logistics report for entity E
     '''
-    cargo = E.GetCargo()
-    capacity = E.GetCapacity()
-    
+    return self.ReportInventory(E.GetCargo(), E.GetCapacity())
+  
+  def ReportInventory(self, cargo, capacity):
+    '''
+       Inventory report for a cargo and a capacity, possibly summed over several units.
+    '''
     out = html.Tag('b','Inventory:')
     out = out + ' %.2f STON (%.2f%% store)'%(float(cargo), 100.0 * float(cargo)/float(capacity))
     mylist = ''
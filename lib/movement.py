@@ -1,5 +1,5 @@
 
-from random import random
+from sandbox_random import random
 import system_base
 
 '''
@@ -106,7 +106,7 @@ class system_movement(system_base.system_base):
         ''' Returns a list of modes for this entity (and vehicles'''
         out = [self['mode']]
         for i in self.vehicles:
-            x = i.GetMode()
+            x = i.GetKit().GetMode()
             if not x in out:
                 out.append(x)
         return out
@@ -142,6 +142,9 @@ class system_movement(system_base.system_base):
         
     def friction_dict(self):
         # TODO - do not account for a mixture of vehicles.
+        # Same fallback as GetFriction for modes the map doesn't define
+        if not self['mode'] in self.map_frictions:
+            return self.map_frictions['']
         return self.map_frictions[self['mode']]
     
     def MovementSuppression(self, friction):
@@ -149,4 +152,4 @@ class system_movement(system_base.system_base):
            Compute the suppression caused by a given amount of friction.
            Currently modeled such as the supression can go up to friction over 24 hours movement, assuming an impulse of 10 minutes.
         '''
-        return 0.007 * random() * friction
\ No newline at end of file
+        return 0.007 * random() * friction
\ No newline at end of file
@@ -4,7 +4,7 @@
    Christian Blouin, bongotatic@gmail.com
    http://www.opcon.org
 '''
-from random import random, shuffle
+from sandbox_random import random, shuffle
 
 from sandbox_exception import SandboxException
 
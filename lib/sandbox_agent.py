@@ -24,7 +24,7 @@ import time as ttime
 import os
 import os.path
 from math import ceil
-from random import choice
+from sandbox_random import choice
 
 from vector import NormalizeAngle
 from sandbox_comm import *
@@ -110,28 +110,39 @@ class agent:
         else:
             self.log('Unimplemented communication request to type : %s'%(type(msg)),'communications')
             
-        # Write the communication into the COMMnet folder
-        net = msg.net
+        # Write the communication into the COMMnet folder (orders issued directly were not broadcasted on a net)
+        net = getattr(msg, 'net', self.entity.GetInnerCOMMnet())
         filename = os.path.join(self.entity.FolderName(),'COMMnet', msg.ArchiveName())
 
         # Write a text version 
-        fout = open(filename, 'w')
         text = html.HTMLfile('COMM on net %s'%(net),msg.AsHTML())
-        fout.write(text)
-        fout.close()
+        if self.entity.sim:
+            self.entity.sim.writer.Write(filename, text)
+        else:
+            fout = open(filename, 'w')
+            fout.write(text)
+            fout.close()
 
 
     def ProcessSTAFF_QUEUE(self):
         '''!
-           Call Process on each COMM in the queue.
+           Call Process on each COMM in the queue and empty it.
+           
+           Messages for which this unit isn't the recipient are dropped with the rest
+           of the queue, they aren't kept for a later pulse.
         '''
+        # Take the queue, what is posted while processing waits for the next pulse
+        queue = self.entity['staff queue']
+        self.entity['staff queue'] = []
+        
         # Iterate over all item in STAFF QUEUE (OPORD or REQUESTS)
-        for i in self.entity['staff queue']:
+        for i in queue:
             # Process only conditionally to being a recipient
             if i.IsRecipient(self.entity.GetName()):
                 self.Process(i)
 
         
+
     
     def PrepareOPORD(self, recipient):
         '''! \brief Prepare an OPORD to a given recipient. 
@@ -202,7 +213,7 @@ class agent:
         # It is time for a report
         intsum = INTSUM(self.entity)
         for i in self.entity['contacts'].values():
-            if i.fields['nature'] != 'undetected':
+            if i.fields.get('nature', i.status) != 'undetected':
                 temp = i.Duplicate('encode')
                 intsum.ContactList(temp)
             
@@ -224,7 +235,8 @@ class agent:
             d = self.entity['OPORD']['EXECUTION']['COORDINATING INSTRUCTION']['REPORTING']['INTSUM']
             self.data['next INTSUM'] = self.clock + timedelta(hours=d)
         else:
-            del self.data['next INTSUM']
+            if self.data.has_key('next INTSUM'):
+                del self.data['next INTSUM']
             self.log('No more scheduled INTSUM, should we take appropriate actions?','intelligence')
         
 
@@ -263,7 +275,7 @@ class agent:
         # Recipient name
         if self.entity.GetHQ():
             x = self.entity.GetHQ().GetName()
-            sitrep.AddRecipient(self.entity.GetHQ())
+            sitrep.SetRecipient(self.entity.GetHQ())
         else:
             x = 'DRAFT'
         sitrep.FillField('##RECIPIENT##', x)
@@ -932,7 +944,7 @@ class agent:
     def SolveReportContact(self, contact):
         ''' Decides if a contact should be sent as SPOT
         '''
-        if contact.status == 'undetected':
+        if contact.status == 'undetected' or contact.GetTimeStamp() == None:
             return False
         if (self.clock - contact.GetTimeStamp()) <= self.entity.sim.pulse:
             return True
@@ -1477,7 +1489,7 @@ class agent:
         if baseSP == None:
             baseSP = self.entity['movement']['speed']
             
-        return self.map.EffectivePathLength(path, frict=self.entity['movement'].frictions) / baseSP
+        return self.map.EffectivePathLength(path, frict=self.entity['movement'].friction_dict()) / baseSP
     
     
     def EstimateSupplyRequired(self, act, ctime = 1.0):
@@ -1935,7 +1947,76 @@ class agent:
             times.append(ttime)
         times.sort()
         return times[0]
+    
+    def SolveDormancy(self):
+        '''! \brief Decide whether the unit can go dormant, and until when.
+             \return (True, wake up time or None) or (False, None)
+             
+             Only an idle unit can sleep: no task under way, no ressuply pending, no suppression to
+             regroup, no supply deficit, no engagement and no sighting of another side this pulse. It 
+             wakes up at the start of its next task, its next SITREP or INTSUM, or before its supply 
+             runs down to the minimum levels (earlier by the convoy's transit time if it has a CSS unit).
+        '''
+        E = self.entity
+        if E.has_key('delete me') or E['TOE'] == 'LOGPAC' or E['suppression'] > 0:
+            return False, None
+        if E.cargo and not E.cargo.HasNoDeficit():
+            return False, None
+        if E.get('ground engagements') or self.potentialengagements or E.sim.EngagementFetch(E):
+            return False, None
+        if self.issuedSUPREQs or self.sustaintask.ressuplytasks:
+            return False, None
+        
+        # Sightings
+        for cnt in E['contacts'].values():
+            if cnt.GetTimeStamp() == self.clock and cnt.unit['side'] != E['side']:
+                return False, None
+        
+        # Tasking, a task that can begin is under way
+        wake = []
+        task = E['OPORD'].GetCurrentTask()
+        if task:
+            hhour = E['OPORD'].GetHhour()
+            if task.CanBegin(self.clock, hhour):
+                return False, None
+            if task.GetEarliestTime(hhour):
+                wake.append(task.GetEarliestTime(hhour))
+                
+        # Reports
+        for k in ['next SITREP', 'next INTSUM']:
+            if self.data.get(k):
+                wake.append(self.data[k])
+        
+        # Supply
+        hours = self.EstimateIdleSupplyTime(self.PolicyMinMaxSupplyLevels()[0])
+        if hours != None:
+            myCSS = self.SolveCSSUnit()
+            if myCSS != None and myCSS != E:
+                hours -= self.EstimateConvoyTransitTime() * 1.1
+            if hours <= E.sim.Pulse():
+                return False, None
+            wake.append(self.clock + timedelta(hours = hours))
+            
+        if wake:
+            return True, min(wake)
+        return True, None
+    
+    def EstimateIdleSupplyTime(self, level = 0.0):
+        '''! \brief Hours before the unit runs out of a class of supply, or its supply falls
+             to a fraction of capacity, when idle.
+             \return Hours (float) or None if nothing is expended when idle.
+        '''
+        E = self.entity
+        rate = E['logistics'].SupplyExpenditure(1, ['idle'], 1.0, E)
+        if float(rate) <= 0.0:
+            return None
+        out = (float(E.cargo) - level * float(E.GetCapacity())) / float(rate)
+        for k in rate:
+            if rate[k] > 0.0:
+                out = min(out, E.cargo.get(k, 0.0) / rate[k])
+        return out
           
+
     def SolveIFF(self, color):
         if color != self.entity['side']:
             return 'FOE'
@@ -2041,9 +2122,14 @@ class agent:
         '''!
            Write the text to a file in the entity folder
         '''
-        fh = open(os.path.join(self.entity['folder'],name),'w')
+        fname = os.path.join(self.entity['folder'],name)
+        if self.entity.sim:
+            self.entity.sim.writer.Write(fname, text)
+            return
+        fh = open(fname,'w')
         fh.write(text)
-        fh.close
+        fh.close()
+
 
 
 class agent_CO(agent):
@@ -2148,7 +2234,7 @@ class agent_CO(agent):
        for i in contacts:
            if i.IsDirectObs('echelon'):
                temp = i.Duplicate('encode')
-               if self.SolveIFF(i.fields['side']) != 'FRIEND':
+               if self.SolveIFF(i.GetField('side')) != 'FRIEND':
                    eny.append(temp)
                    tout += i.AsHTML()
        if tout == '':
@@ -2169,7 +2255,7 @@ class agent_CO(agent):
                else:
                    if i.IsDirectObs('echelon'):
                        temp = i.Duplicate('encode')
-                       if self.SolveIFF(i.fields['side']) == 'FRIEND':
+                       if self.SolveIFF(i.GetField('side')) == 'FRIEND':
                            others.append(i.Duplicate())
             
        out += html.Tag('H2','B. Friendly Forces') + '<HR>'
@@ -2221,18 +2307,11 @@ class agent_CO(agent):
         # cargo (local copy)
         cargo = self.entity.GetCargo() * 1.0
         capacity = self.entity.GetCapacity() * 1.0
-        freight = supply_package()
         for s in sub:
             cargo = cargo + s.GetCargo()
             capacity = capacity + s.GetCapacity()
-            freight += s['logistics']['freight']
         
-        temp = system_logistics()
-        temp['cargo'] = cargo
-        temp['capacity'] = capacity
-        temp['freight'] = freight
-        
-        out += temp.Report()
+        out += system_logistics().ReportInventory(cargo, capacity)
                 
         
         return html.Tag('div',out)
@@ -2276,8 +2355,14 @@ class agent_CO(agent):
         # Out string
         out = html.Tag('H3', 'Capacity and Strenght')
         
-        # Relative Combat strenght
-        R = self.entity['combat'].RawRCP()/self.entity['combat']['TOE RCP']
+        # Relative Combat strenght, as the kit on hand over the TOE allocation of all subordinates
+        count = auth = 0.0
+        for S in self.entity.Subordinates() + [self.entity]:
+            for x in [S.personel, S.vehicle]:
+                for kit in x:
+                    count += x[kit].GetCount()
+                    auth += x[kit].GetAuthorized()
+        R = count / max(1.0, auth)
         temp = 'We are operating at %d%% of our TOE allocation. '%(int(100*R))
         
         '''
@@ -2336,11 +2421,11 @@ class agent_CO(agent):
             Is defined as the convex polygon of the footprint of all subordinates
        '''
        
-       V = self.entity.Footprint().vertices()
+       V = list(self.entity.Footprint().vertices())
        for i in self.entity.Subordinates():
            # Get Contact
            C = self.entity.Contact(i)
-           if C and C.fields['Echelon Footprint']:
+           if C and C.GetField('Echelon Footprint'):
                V += C.fields['Echelon Footprint'].vertices()
            elif C and C.location:
                V += C.location.footprint.vertices()
@@ -2356,7 +2441,126 @@ if __name__ == '__main__':
 import unittest
 
 class AgentTest(unittest.TestCase):
-    pass
+    def setUp(self):
+        from sandbox_world import sandbox
+        self.box = sandbox('testEchelonAnzio.xml', gametag='Agent Test', headless=True)
+
+    def testStaffQueueOnce(self):
+        # An OPORD and a SITREP from a subordinate, each processed at one pulse only
+        unit = [i for i in self.box.OOB if i.GetHQ()][0]
+        HQ = unit.GetHQ()
+        A = HQ['agent']
+        seen = []
+        process = A.Process
+        def Process(msg):
+            seen.append(msg)
+            process(msg)
+        A.Process = Process
+        unit['agent'].clock = A.clock = self.box.clock
+        opord = OPORD(HQ, HQ)
+        HQ.IssueOrder(opord)
+        unit['agent'].PrepareSITREP(False)
+        sitrep = HQ['staff queue'][-1]
+        A.ProcessSTAFF_QUEUE()
+        self.assertEqual([id(i) for i in seen], [id(opord), id(sitrep)])
+        for i in range(3):
+            A.ProcessSTAFF_QUEUE()
+        self.assertEqual([[id(i) for i in seen if i is opord or i is sitrep], len(HQ['staff queue'])], [[id(opord), id(sitrep)], 0])
+
+    def testStaffQueueDropsOthers(self):
+        # A message for another unit isn't processed, nor kept in the queue
+        unit = [i for i in self.box.OOB if i.GetHQ()][0]
+        HQ = unit.GetHQ()
+        A = HQ['agent']
+        seen = []
+        A.Process = lambda msg: seen.append(msg)
+        opord = OPORD(HQ, unit)
+        HQ['staff queue'].append(opord)
+        A.ProcessSTAFF_QUEUE()
+        self.assertEqual([seen, HQ['staff queue']], [[], []])
+
+    def testCOMMArchive(self):
+        # Headless, the processed COMMs are archived by the writer only
+        HQ = self.box.OOB[0]
+        HQ['agent'].clock = self.box.clock
+        opord = OPORD(HQ, HQ)
+        self.box.BroadcastSignal(opord, HQ.GetInnerCOMMnet())
+        HQ['agent'].ProcessSTAFF_QUEUE()
+        fname = os.path.join(HQ.FolderName(), 'COMMnet', opord.ArchiveName())
+        self.assertEqual([os.path.exists(fname), 'COMM on net %s'%(HQ.GetInnerCOMMnet()) in self.box.writer.Read(fname)], [False, True])
+
+    def testOrderWithoutNet(self):
+        # An order issued directly isn't broadcast, it is archived on the inner net
+        HQ = self.box.OOB[0]
+        HQ['agent'].clock = self.box.clock
+        opord = OPORD(HQ, HQ)
+        HQ.IssueOrder(opord)
+        HQ['agent'].ProcessSTAFF_QUEUE()
+        fname = os.path.join(HQ.FolderName(), 'COMMnet', opord.ArchiveName())
+        self.assertTrue('COMM on net %s'%(HQ.GetInnerCOMMnet()) in self.box.writer.Read(fname))
+
+    def testTransitTime(self):
+        unit = self.box.OOB[0]
+        p = unit['position'].AsVect()
+        path = [p, p + vect_5D(1.0, 1.0)]
+        frict = unit['movement'].friction_dict()
+        t = unit['agent'].EstimateTransitTime(path)
+        self.assertAlmostEqual(t, self.box.map.EffectivePathLength(path, frict=frict) / unit['movement']['speed'])
+        self.assertTrue(t > 0.0)
+
+    def testUnscheduledINTSUM(self):
+        # No INTSUM in the reporting instructions, nor a previous schedule
+        HQ = self.box.OOB[0]
+        HQ['agent'].clock = self.box.clock
+        HQ['OPORD']['EXECUTION']['COORDINATING INSTRUCTION']['REPORTING'] = {}
+        HQ['agent'].PrepareINTSUM()
+        self.assertFalse(HQ['agent'].data.has_key('next INTSUM'))
+
+    def testSparseContacts(self):
+        # Contacts seldom carry a side, a nature or an echelon footprint
+        HQ = [i for i in self.box.OOB if i.EchelonSubordinates()][0]
+        HQ['agent'].clock = self.box.clock
+        for i in self.box.OOB:
+            if i is not HQ:
+                cnt = sandbox_contact(i)
+                cnt.status = 'direct'
+                HQ.WriteContact(cnt)
+        CO = agent_CO(HQ, HQ['agent'].map)
+        CO.clock = self.box.clock
+        out, eny, friends = CO.REPORT_Contacts()
+        self.assertEqual(len(eny), len(self.box.OOB) - 1)
+        self.assertTrue(CO.SolveFootprint().Area() > 0.0)
+        HQ['agent'].PrepareINTSUM()
+        self.assertEqual(len(HQ['staff queue'][-1]['contacts']), len(self.box.OOB))
+
+    def testSITREPRecipient(self):
+        unit = [i for i in self.box.OOB if i.GetHQ() and not i.EchelonSubordinates()][0]
+        unit['agent'].clock = self.box.clock
+        unit['agent'].PrepareSITREP()
+        sitrep = unit.GetHQ()['staff queue'][-1]
+        self.assertEqual([sitrep.Sender() is unit, sitrep.IsRecipient(unit.GetHQ().GetName())], [True, True])
+
+    def testReportContactWithoutTimeStamp(self):
+        unit = self.box.OOB[0]
+        unit['agent'].clock = self.box.clock
+        cnt = sandbox_contact(self.box.OOB[1])
+        cnt.status = 'direct'
+        self.assertFalse(unit['agent'].SolveReportContact(cnt))
+
+    def testEchelonSITREP(self):
+        HQ = [i for i in self.box.OOB if i.EchelonSubordinates()][0]
+        HQ['agent'].clock = self.box.clock
+        sitrep = HQ['agent'].PrepareSITREP()
+        self.assertTrue(sitrep.report.find('Logistics Report') != -1)
+        self.assertTrue(sitrep.report.find('Capacity and Strenght') != -1)
+        # The inventory is summed over the subordinates
+        cargo = HQ.GetCargo() * 1.0
+        for i in HQ.Subordinates() + [HQ]:
+            cargo = cargo + i.GetCargo()
+        self.assertTrue(sitrep.report.find(' %.2f STON'%(float(cargo))) != -1)
+        self.assertTrue(sitrep.report.find('of our TOE allocation') != -1)
+
+
 
 if __name__ == '__main__':
     # suite
@@ -2367,4 +2571,4 @@ if __name__ == '__main__':
     
     # collate all and run
     allsuite = unittest.TestSuite(testsuite)
-    unittest.TextTestRunner(verbosity=2).run(allsuite)
\ No newline at end of file
+    unittest.TextTestRunner(verbosity=2).run(allsuite)
\ No newline at end of file
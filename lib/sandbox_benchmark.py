@@ -0,0 +1,414 @@
+#!/usr/bin/python
+'''
+    Benchmark -- Synthetic scenarios of N units and timing of the simulation.
+    OPCON Sandbox -- Extensible Operational level military simulation.
+    Copyright (C) 2007 Christian Blouin
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 2 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+if __name__ == '__main__':
+  import syspathlib
+  import os
+  os.chdir('..')
+
+# Import
+import os
+import os.path
+import sys
+import random
+import resource
+import socket
+from time import time
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+from vector import vect_3D
+from sandbox_XML import sandboXML
+from sandbox_map import sandbox_map
+import sandbox_keywords
+
+# Sides of the generated scenarios, and their colors
+bench_sides = [['Blue',[10,10,255]], ['Red',[255,10,10]], ['Green',[10,160,10]], ['Yellow',[230,230,10]]]
+
+
+class sandbox_scenario_generator:
+  '''! \brief Write a scenario of N units per side on a map.
+
+       The units of a side form a chain of command of a given depth (the first unit is the top HQ,
+       unit i reports to unit (i-1)/b where b is the smallest branching that fits N units in depth
+       echelons). HQs use the hq template, the other units one of the leaf templates. The sides
+       are deployed in vertical bands across the map, on passable terrain only.
+
+       Each unit gets a task drawn from mix, a dictionary of relative weights over 'idle', 'Redeploy'
+       and 'Relocate'. The tasks are written in the orders node of the scenario and are issued by
+       IssueOrders() after the scenario is loaded.
+
+       \param units Number of units per side.
+       \param seed All random draws are made from this seed.
+  '''
+  def __init__(self, units = 10, sides = 2, depth = 3, mapname = 'Anzio', mix = None, seed = 0,
+               hq = 'US-light-scout-section', leaves = ['FireTeam']):
+    self.units = int(units)
+    self.sides = int(sides)
+    self.depth = max(1, int(depth))
+    self.mapname = mapname
+    self.mix = mix or {'idle':1.0, 'Redeploy':1.0, 'Relocate':2.0}
+    self.seed = seed
+    self.hq = hq
+    self.leaves = leaves
+
+  def Name(self):
+    return 'bench_%s_%du_%ds_%dd_%d'%(self.mapname, self.units, self.sides, self.depth, self.seed)
+
+  def Branching(self):
+    '''! \brief The smallest branching factor that fits the units in depth echelons.
+    '''
+    if self.depth == 1 or self.units <= 1:
+      return max(1, self.units - 1)
+    b = 1
+    while sum([b**i for i in range(self.depth)]) < self.units:
+      b = b + 1
+    return b
+
+  def Write(self, fname = None):
+    '''! \brief Write the scenario in the scenarios folder.
+         \return The file name, relative to the scenarios folder.
+    '''
+    if fname == None:
+      fname = self.Name() + '.xml'
+    out = str(self.ToXML())
+    with open(os.path.join(os.getcwd(), 'scenarios', fname), 'w') as fout:
+      fout.write(out)
+    return fname
+
+  def ToXML(self):
+    rng = random.Random(self.seed)
+    self.map = sandbox_map(self.mapname)
+    width = float(self.map.data['width'])
+    height = self.map.graphics.size[1] / self.map.m
+    branch = self.Branching()
+
+    doc = sandboXML('scenario')
+    doc.SetAttribute('version', '0.7', doc.root)
+    doc.AddField('reset', 1, doc.root)
+    doc.AddField('name', self.Name(), doc.root)
+    doc.AddNode(doc.DateTime('clock', datetime(2010, 1, 3, 7, 0)))
+    doc.AddField('map', self.mapname, doc.root)
+    data = doc.NewNode('data')
+    doc.SetAttribute('filename', 'base.xml', data)
+    doc.AddNode(data)
+    orders = doc.NewNode('orders')
+
+    for s in range(self.sides):
+      sname, color = bench_sides[s % len(bench_sides)]
+      if s >= len(bench_sides):
+        sname = '%s%d'%(sname, s / len(bench_sides))
+      side = doc.NewNode('side')
+      doc.AddField('name', sname, side)
+      doc.AddField('color', color, side, type='RGB')
+      oob = doc.NewNode('OOB')
+
+      # The band of the map for this side
+      band = [width * s / self.sides, width * (s + 1) / self.sides]
+      positions = []
+      for i in range(self.units):
+        unit = doc.NewNode('unit')
+        name = '%s-%d'%(sname, i)
+        level = self.Level(i, branch)
+        if level < self.depth - 1 and i * branch + 1 < self.units:
+          doc.SetAttribute('template', self.hq, unit)
+          doc.AddField('command_echelon', self.Echelon(level), unit)
+        else:
+          doc.SetAttribute('template', rng.choice(self.leaves), unit)
+        doc.SetAttribute('identity', name, unit)
+
+        # Near the HQ
+        if i == 0:
+          pos = self.Passable(rng, band, [0.0, height])
+        else:
+          hq = positions[(i - 1) / branch]
+          pos = self.Passable(rng, [max(band[0], hq.x - 3.0), min(band[1], hq.x + 3.0)], [max(0.0, hq.y - 3.0), min(height, hq.y + 3.0)])
+        positions.append(pos)
+        doc.AddField('location', self.map.MGRS.AsString(pos, 5), unit, type='coordinates')
+
+        if i:
+          coc = doc.NewNode('chain_of_command')
+          doc.AddField('HIGHER', '%s-%d'%(sname, (i - 1) / branch), coc)
+          doc.AddNode(coc, unit)
+        doc.AddNode(unit, oob)
+
+        # Orders
+        task = self.DrawTask(rng)
+        if task != 'idle':
+          order = doc.NewNode('order')
+          doc.SetAttribute('side', sname.upper(), order)
+          doc.SetAttribute('unit', name, order)
+          doc.SetAttribute('task', task, order)
+          if task == 'Redeploy':
+            doc.SetAttribute('final_stance', rng.choice(['transit', 'deliberate defense', 'offense']), order)
+          else:
+            # Toward the middle of the map
+            dest = self.Passable(rng, [width * 0.25, width * 0.75], [0.0, height])
+            doc.SetAttribute('destination', self.map.MGRS.AsString(dest, 5), order)
+          doc.AddNode(order, orders)
+
+      doc.AddNode(oob, side)
+      doc.AddNode(side)
+    doc.AddNode(orders)
+    return doc
+
+  # Private methods
+  def Level(self, i, branch):
+    # Depth of unit i in the chain of command
+    level = 0
+    while i > 0:
+      i = (i - 1) / branch
+      level = level + 1
+    return level
+
+  def Echelon(self, level):
+    # Top HQ is the highest echelon, one step down for each level
+    sizes = sandbox_keywords.dch_size_denomination
+    return sizes[max(2, sizes.index('Plt') + self.depth - 2 - level)]
+
+  def DrawTask(self, rng):
+    total = sum(self.mix.values())
+    x = rng.random() * total
+    keys = self.mix.keys()
+    keys.sort()
+    for k in keys:
+      x = x - self.mix[k]
+      if x < 0.0:
+        return k
+    return keys[-1]
+
+  def Passable(self, rng, xr, yr):
+    '''! \brief A random point in the box which isn't impassable (or the last draw).
+    '''
+    for i in range(50):
+      pos = vect_3D(rng.uniform(xr[0], xr[1]), rng.uniform(yr[0], yr[1]))
+      if self.map.CostsUnder([pos])[0] < 1000.0:
+        break
+    return pos
+
+
+def IssueOrders(sbox, scenario):
+  '''! \brief Issue the orders node of a generated scenario to the units of a loaded world.
+  '''
+  doc = sandboXML(read=os.path.join('.', 'scenarios', scenario))
+  orders = doc.Get(doc.root, 'orders')
+  if not orders:
+    return 0
+  return sbox.IssueOrdersFromXML(doc, orders)
+
+
+
+def RunBenchmark(job):
+  '''! \brief Load a scenario, issue its orders and simulate it with the profiler on.
+       \param job A tuple (scenario, hours)
+       \return A dictionary of the metrics.
+
+       Meant to run in a fresh process (see sandbox_benchmark.Run), so that the peak RSS is the
+       one of this scenario.
+  '''
+  from sandbox_world import sandbox
+  scenario, hours = job
+  out = {'scenario':scenario, 'hours':hours}
+
+  t = time()
+  sbox = sandbox(scenario)
+  out['orders'] = IssueOrders(sbox, scenario)
+  out['load'] = time() - t
+  out['units'] = len(sbox.OOB)
+
+  sbox.Profile()
+  t = time()
+  sbox.SimulateScheduled(timedelta(hours=hours))
+  sbox.writer.Flush()
+  out['run'] = time() - t
+  sbox.Profile(False)
+
+  # Per phase, unit level and path finding timings
+  phases = {}
+  pulses = {}
+  for clock, kind, calls, seconds in sbox.profiler.PulseTable():
+    pulses[clock] = 1
+    if not kind in phases:
+      phases[kind] = [0, 0.0]
+    phases[kind][0] += calls
+    phases[kind][1] += seconds
+  out['phases'] = phases
+  out['pulses'] = len(pulses)
+  out['pulses per second'] = len(pulses) / max(out['run'], 1e-9)
+  # In kB on Linux
+  out['peak rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+  sbox.DeleteFolder(sbox.OS['savepath'])
+  return out
+
+
+class sandbox_benchmark:
+  '''! \brief Run benchmark scenarios and keep the results in a XML file, one run node per scenario.
+
+       \param label Identifies the release (or the change) being measured.
+       \param fname The results file (Simulations/benchmarks.xml by default).
+  '''
+  def __init__(self, label = '', fname = None):
+    self.label = label or datetime.now().strftime('%Y%m%d%H%M')
+    if fname == None:
+      fname = os.path.join(os.getcwd(), 'Simulations', 'benchmarks.xml')
+    self.fname = fname
+    self.results = []
+
+  def Run(self, scenarios, hours = 2.0, isolate = True):
+    '''! \brief Run each scenario (in a fresh process if isolate) and record the results.
+    '''
+    for s in scenarios:
+      if isolate:
+        pool = Pool(1, maxtasksperchild=1)
+        res = pool.apply(RunBenchmark, ((s, hours),))
+        pool.close()
+        pool.join()
+      else:
+        res = RunBenchmark((s, hours))
+      res['label'] = self.label
+      res['date'] = datetime.now().strftime('%Y-%m-%d %H:%M')
+      res['host'] = socket.gethostname()
+      self.results.append(res)
+    return self.results
+
+  def Report(self, res):
+    '''! \brief One line summary of a run.
+    '''
+    top = res['phases'].items()
+    top.sort(key = lambda x: -x[1][1])
+    phases = ', '.join(['%s %.2fs'%(k, v[1]) for k, v in top if k.startswith('Phase')][:4])
+    return '%s: %d units, %d pulses, %.2f pulses/s, load %.1fs, peak RSS %.0f MB (%s)'%(res['scenario'], res['units'],
+            res['pulses'], res['pulses per second'], res['load'], res['peak rss'] / 1024.0, phases)
+
+  # Storage
+  def Save(self):
+    '''! \brief Append the results to the results file.
+    '''
+    if os.path.exists(self.fname):
+      doc = sandboXML(read=self.fname)
+    else:
+      doc = sandboXML('benchmarks')
+    for res in self.results:
+      node = doc.NewNode('run')
+      for k in ['label', 'date', 'host', 'scenario', 'units', 'orders', 'hours', 'pulses', 'load', 'run', 'pulses per second', 'peak rss']:
+        doc.SetAttribute(k.replace(' ','_'), res[k], node)
+      keys = res['phases'].keys()
+      keys.sort()
+      for k in keys:
+        ph = doc.NewNode('phase')
+        doc.SetAttribute('name', k, ph)
+        doc.SetAttribute('calls', res['phases'][k][0], ph)
+        doc.SetAttribute('seconds', '%.6f'%(res['phases'][k][1]), ph)
+        doc.AddNode(ph, node)
+      doc.AddNode(node)
+    with open(self.fname, 'w') as fout:
+      fout.write(str(doc))
+    return self.fname
+
+  def Load(self, label = None):
+    '''! \brief The runs in the results file (for label only, if given), as dictionaries.
+    '''
+    out = []
+    if not os.path.exists(self.fname):
+      return out
+    doc = sandboXML(read=self.fname)
+    for node in doc.Get(doc.root, 'run', True):
+      res = doc.AttributesAsDict(node)
+      if label != None and str(res['label']) != str(label):
+        continue
+      res['phases'] = {}
+      for ph in doc.Get(node, 'phase', True):
+        res['phases'][doc.Get(ph, 'name')] = [float(doc.Get(ph, 'calls')), float(doc.Get(ph, 'seconds'))]
+      out.append(res)
+    return out
+
+  def Compare(self, base, new):
+    '''! \brief Ratios new/base of the seconds of each phase, for the scenarios run under both labels.
+         \return {scenario:{phase:ratio}} with the overall 'pulses per second' ratio.
+    '''
+    A = dict([(r['scenario'], r) for r in self.Load(base)])
+    B = dict([(r['scenario'], r) for r in self.Load(new)])
+    out = {}
+    for s in A:
+      if not s in B:
+        continue
+      out[s] = {'pulses per second':float(B[s]['pulses_per_second']) / max(float(A[s]['pulses_per_second']), 1e-9)}
+      for ph in A[s]['phases']:
+        if ph in B[s]['phases'] and A[s]['phases'][ph][1] > 0.0:
+          out[s][ph] = B[s]['phases'][ph][1] / A[s]['phases'][ph][1]
+    return out
+
+
+import unittest
+class BenchmarkTest(unittest.TestCase):
+  def setUp(self):
+    self.gen = sandbox_scenario_generator(units=7, sides=2, depth=3, mapname='blankworld', seed=1)
+    self.scenario = self.gen.Write()
+
+  def tearDown(self):
+    os.remove(os.path.join('scenarios', self.scenario))
+
+  def testBranching(self):
+    self.assertEqual([self.gen.Branching(), sandbox_scenario_generator(units=13, depth=3).Branching(), sandbox_scenario_generator(units=5, depth=1).Branching()], [2, 3, 4])
+
+  def testGeneratedScenarioLoads(self):
+    from sandbox_world import sandbox
+    sbox = sandbox(self.scenario)
+    top = sbox.GetOOB(color='BLUE', top_level=True)
+    sbox.DeleteFolder(sbox.OS['savepath'])
+    self.assertEqual([len(sbox.OOB), len(top), len(top[0].AllSubordinates())], [14, 1, 6])
+
+  def testBenchmarkRecords(self):
+    fname = os.path.join('Simulations', 'test_benchmarks.xml')
+    bench = sandbox_benchmark('test', fname)
+    bench.Run([self.scenario], hours = 0.5, isolate = False)
+    bench.Save()
+    bench.Save()
+    cmp = bench.Compare('test', 'test')
+    os.remove(fname)
+    self.assertEqual([bench.results[0]['pulses'], 'PhaseStepAll' in bench.results[0]['phases'], cmp[self.scenario]['pulses per second']], [3, True, 1.0])
+
+
+if __name__ == '__main__':
+  # Check for the number of argument
+  if len(sys.argv) < 3:
+    print 'sandbox_benchmark.py label units[,units...] [hours] [sides] [depth] [map]'
+    sys.exit()
+
+  label = sys.argv[1]
+  sizes = [int(i) for i in sys.argv[2].split(',')]
+  hours = 2.0
+  sides = 2
+  depth = 3
+  mapname = 'Anzio'
+  if len(sys.argv) > 3:
+    hours = float(sys.argv[3])
+  if len(sys.argv) > 4:
+    sides = int(sys.argv[4])
+  if len(sys.argv) > 5:
+    depth = int(sys.argv[5])
+  if len(sys.argv) > 6:
+    mapname = sys.argv[6]
+
+  bench = sandbox_benchmark(label)
+  scenarios = [sandbox_scenario_generator(n, sides, depth, mapname).Write() for n in sizes]
+  for res in bench.Run(scenarios, hours):
+    print bench.Report(res)
+  print 'Results appended to %s'%(bench.Save())
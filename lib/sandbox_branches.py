@@ -0,0 +1,201 @@
+'''
+    Branches -- What-if evaluation of courses of action from the current turn.
+    OPCON Sandbox -- Extensible Operational level military simulation.
+    Copyright (C) 2007 Christian Blouin
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 2 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+# Import
+import os
+import traceback
+from cStringIO import StringIO
+from multiprocessing import Process, Queue, cpu_count
+from Queue import Empty
+
+from sandbox_XML import sandboXML
+from sandbox_writer import sandbox_memory_writer
+from sandbox_montecarlo import Outcomes
+import sandbox_checkpoint
+
+
+# The world being branched, inherited by the forked workers
+_world = None
+
+# Seconds between two checks of the worker processes while waiting for their results
+POLL = 1.0
+
+def RunCourse(job):
+  '''! \brief Issue a course of action to the world of this process and simulate it.
+       \param job A tuple (index, orders, hours, keep), orders being a XML orders node (a string).
+       \return A dictionary with the index, final clock and outcome of each unit (or the error),
+               and the checkpoint of the branch if keep is set.
+
+       In a forked worker, _world is the copy-on-write image of the world being branched: it is
+       modified in place and the memory pages are copied by the system as they are written.
+  '''
+  index, orders, hours, keep = job
+  out = {'index':index, 'units':[], 'error':'', 'checkpoint':None}
+  world = _world
+  try:
+    doc = sandboXML(read=StringIO(orders))
+    out['orders'] = world.IssueOrdersFromXML(doc, doc.root)
+    out['clock'], out['units'] = Outcomes(world, hours)
+    if keep:
+      out['checkpoint'] = sandbox_checkpoint.Dumps(world)
+  except:
+    out['error'] = traceback.format_exc()
+  return out
+
+def RunCourseWorker(job, queue):
+  queue.put(RunCourse(job))
+
+
+class sandbox_branches:
+  '''! \brief Evaluate several courses of action from the current state of a world.
+
+       Each course is an orders node (see sandbox.IssueOrdersFromXML) issued to its own branch of the
+       world, which is then simulated for the same time. Where the system can fork, each branch runs
+       in a worker process that inherits the world copy-on-write, so nothing is pickled or loaded to
+       start a branch. Elsewhere, or with processes = 1, the branches are in memory copies made by
+       sandbox.Fork() and run one after the other. The world itself isn't modified.
+
+       \param world The world to branch from.
+       \param processes The number of worker processes (number of CPUs if None).
+       \param keep Keep the checkpoint of each branch (see Adopt).
+  '''
+  def __init__(self, world, processes = None, keep = False):
+    self.world = world
+    self.processes = processes or cpu_count()
+    self.keep = keep
+
+    # The branches, sorted by index
+    self.results = []
+
+  def Run(self, courses, hours):
+    '''! \brief Simulate each course of action (a list of XML orders nodes) for a number of hours.
+         A worker process that exits without posting its result makes its branch a failure.
+         \return The list of branches.
+    '''
+    global _world
+    jobs = [(i, courses[i], hours, self.keep) for i in range(len(courses))]
+    self.world.writer.Flush()
+    if self.processes == 1 or not hasattr(os, 'fork'):
+      self.results = []
+      for job, branch in zip(jobs, self.world.Fork(len(jobs))):
+        _world = branch
+        self.results.append(RunCourse(job))
+      _world = None
+    else:
+      # One process per branch, forked with the world as a branch: headless, without its autosave history
+      writer, archive, headless = self.world.writer, self.world.archive, self.world.headless
+      self.world.writer, self.world.archive, self.world.headless = sandbox_memory_writer(keep=False), None, True
+      _world = self.world
+      queue = Queue()
+      running = {}
+      self.results = []
+      try:
+        while jobs or running:
+          while jobs and len(running) < self.processes:
+            job = jobs.pop(0)
+            running[job[0]] = Process(target=RunCourseWorker, args=(job, queue))
+            running[job[0]].start()
+          try:
+            res = queue.get(timeout=POLL)
+          except Empty:
+            # A worker that exited without posting its result (killed by the system, crashed)
+            res = None
+            for index, p in running.items():
+              if p.exitcode != None and queue.empty():
+                res = {'index':index, 'units':[], 'error':'The branch process exited (code %d) without a result'%(p.exitcode), 'checkpoint':None}
+                break
+            if res == None:
+              continue
+          running.pop(res['index']).join()
+          self.results.append(res)
+      finally:
+        for p in running.values():
+          p.terminate()
+        _world = None
+        self.world.writer, self.world.archive, self.world.headless = writer, archive, headless
+    self.results.sort(key = lambda x: x['index'])
+    return self.results
+
+  def Failures(self):
+    return [r for r in self.results if r['error']]
+
+  def Table(self):
+    '''! \brief The outcome of each unit in each branch, as tab separated text.
+    '''
+    metrics = ['personel', 'casualties', 'vehicle', 'vehicle losses', 'supply', 'supply used', 'destroyed', 'objective', 'position']
+    out = 'branch\tside\tunit\t%s\n'%('\t'.join(metrics))
+    for rep in self.results:
+      for u in rep['units']:
+        out = out + '%d\t%s\t%s\t%s\n'%(rep['index'], u['side'], u['name'], '\t'.join([str(u[m]) for m in metrics]))
+    return out
+
+  def Adopt(self, index):
+    '''! \brief Replace the state of the world by the one at the end of a branch (kept with keep).
+    '''
+    sandbox_checkpoint.Loads(self.world, self.results[index]['checkpoint'])
+    return self.world
+
+
+import unittest
+class BranchesTest(unittest.TestCase):
+  def setUp(self):
+    from sandbox_world import sandbox
+    self.sbox = sandbox('testTwoFireTeamsUTM.xml', gametag='Branches Test', headless=True)
+    unit = self.sbox.OOB[0]
+    self.courses = ['<orders/>', '<orders><order side="%s" unit="%s" task="Redeploy" final_stance="transit"/></orders>'%(unit['side'], unit.GetName())]
+
+  def testFork(self):
+    a, b = self.sbox.Fork(2)
+    a.OOB[0]['stance'] = 'changed'
+    self.assertEqual([a.map is self.sbox.map, a.data is self.sbox.data, a.OOB[0] is self.sbox.OOB[0], b.OOB[0]['stance'] == 'changed', self.sbox.OOB[0]['stance'] == 'changed', a.OS['gametag']],
+                     [True, True, False, False, False, 'Branches Test branch 1'])
+
+  def testBranchesInProcess(self):
+    clock = self.sbox.GetClock()
+    br = sandbox_branches(self.sbox, processes=1)
+    br.Run(self.courses, 0.5)
+    self.assertEqual([br.Failures(), [r['orders'] for r in br.results], self.sbox.GetClock()], [[], [0, 1], clock])
+
+  def testBranchesForked(self):
+    if not hasattr(os, 'fork'):
+      return
+    br = sandbox_branches(self.sbox, processes=2, keep=True)
+    br.Run(self.courses, 0.5)
+    self.assertEqual([br.Failures(), [len(r['units']) for r in br.results]], [[], [2, 2]])
+    clock = br.results[1]['clock']
+    br.Adopt(1)
+    self.assertEqual([self.sbox.GetClock(), self.sbox.OOB[0].sim is self.sbox], [clock, True])
+
+  def testWorkerDies(self):
+    # The worker of the second branch exits without posting its result
+    global RunCourse
+    if not hasattr(os, 'fork'):
+      return
+    run = RunCourse
+    def Dying(job):
+      if job[0] == 1:
+        os._exit(1)
+      return run(job)
+    RunCourse = Dying
+    try:
+      br = sandbox_branches(self.sbox, processes=2)
+      br.Run(self.courses, 0.5)
+    finally:
+      RunCourse = run
+    self.assertEqual([[r['index'] for r in br.Failures()], len(br.results[0]['units'])], [[1], 2])
@@ -0,0 +1,431 @@
+'''
+    Checkpoint -- Binary snapshot of the state of a simulation.
+    OPCON Sandbox -- Extensible Operational level military simulation.
+    Copyright (C) 2007 Christian Blouin
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 2 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+# Import
+import copy_reg
+import types
+import zlib
+import os
+import os.path
+from hashlib import md5
+from datetime import datetime
+from cPickle import Pickler, Unpickler, HIGHEST_PROTOCOL, dumps, loads
+from cStringIO import StringIO
+
+from sandbox_map import sandbox_map
+from sandbox_entity import sandbox_entity
+from sandbox_writer import SharedWriter
+from sandbox_profiler import SharedProfiler
+from sandbox_data import sandbox_data_server
+from sandbox_exception import SandboxException
+
+# Header of the files, with the version of the format
+MAGIC = 'OPCONCKPT4\n'
+
+# Bound methods (the events in the scheduler) are pickled as their instance and name
+def ReduceMethod(m):
+  return (getattr, (m.im_self, m.im_func.__name__))
+copy_reg.pickle(types.MethodType, ReduceMethod)
+
+# The maps of this process, by name
+_maps = {}
+
+# The attributes of the world that depend on the process running it, not on the state
+TRANSIENT = ['archive', 'headless']
+
+
+def Externals(world):
+  '''! \brief The objects pickled as references: the world, its map, writer, profiler and data server.
+  '''
+  return [world, world.map, world.writer, world.profiler, world.data]
+
+def Dumps(world):
+  '''! \brief The binary checkpoint of a simulation (a string).
+
+       The state of the world is pickled, including the OOB, contacts, OPORDs, scheduled events
+       and engagements. The map (with its path cache), the writer, the profiler and the data server
+       (the templates) are pickled as references and are attached again when restored: the map is
+       taken from this process if already loaded, or from its folder, and the world keeps its writer
+       and data server. The references are entries of the pickler's memo, which costs nothing per
+       pickled object.
+
+  '''
+  buf = StringIO()
+  pickler = Pickler(buf, HIGHEST_PROTOCOL)
+  for i, obj in enumerate(Externals(world)):
+    pickler.memo[id(obj)] = (i, obj)
+  state = dict(world.__dict__)
+  for k in TRANSIENT:
+    state.pop(k, None)
+  pickler.dump(state)
+  _maps[world.map.mapenv] = world.map
+  return MAGIC + world.map.mapenv + '\n' + zlib.compress(buf.getvalue(), 1)
+
+def Loads(world, data):
+  '''! \brief Restore a checkpoint into the world instance (its state is replaced).
+  '''
+  if not data.startswith(MAGIC):
+    raise SandboxException('CheckpointError', 'Not a checkpoint (or an other version)')
+  mapenv, data = data[len(MAGIC):].split('\n', 1)
+  if not mapenv in _maps:
+    _maps[mapenv] = sandbox_map(mapenv)
+  
+  # The references, in the order of Externals()
+  world.map, world.profiler = _maps[mapenv], SharedProfiler()
+  if not hasattr(world, 'writer'):
+    world.writer = SharedWriter()
+  if not hasattr(world, 'data'):
+    world.data = sandbox_data_server()
+
+  unpickler = Unpickler(StringIO(zlib.decompress(data)))
+  unpickler.memo = dict(enumerate(Externals(world)))
+  world.__dict__.update(unpickler.load())
+  return world
+
+
+class sandbox_archive:
+  '''! \brief The autosave history of a simulation: a snapshot, then what changed at each turn.
+  
+       Each unit is cut into its fields (the items and the attributes of the entity), pickled one
+       by one with the units as references. The messages in the staff queues, which are shared
+       by all the units on a net, are pickled once per turn and referred to by the queues. A turn
+       stores the fields whose pickle changed since the previous turn, likewise for the attributes
+       of the world, and the messages if they changed. A full snapshot is stored every keyframe
+       turns (and after a rewind) so that restoring any turn replays a bounded number of turns.
+       Other objects shared by two units are restored as copies.
+       
+       Turns are files in the Autosave folder named after the clock and their rank in index.txt,
+       which lists them. A turn saved after a rewind replaces the turns that followed the one
+       restored. They are posted to the writer and read back from it if it keeps them in memory,
+       else from the disk.
+       
+       \param folder The Autosave folder.
+       \param writer The writer of the simulation.
+       \param keyframe The number of turns from a snapshot to the next.
+  '''
+  def __init__(self, folder, writer, keyframe = 24):
+    self.folder = folder
+    self.writer = writer
+    self.keyframe = keyframe
+    # The lines of index.txt (read when first needed) and the rank of the turn restored
+    self.index = None
+    self.restored = None
+    self.Reset()
+    
+  def Reset(self):
+    '''! \brief The next turn is a snapshot.
+    '''
+    # Digests of the last turn, {uid:{key:digest}}, the world's {key:digest} and the messages'
+    self.last = {}
+    self.lastworld = {}
+    self.lastcomms = None
+    # Turns stored since the snapshot
+    self.turns = 0
+  
+  # Interface
+  def Write(self, world):
+    '''! \brief Post the turn of the world at its clock to the writer.
+         \return The name of the file.
+    '''
+    full = self.turns % self.keyframe == 0
+    if full:
+      self.Reset()
+    data = zlib.compress(dumps(self.Delta(world, full), HIGHEST_PROTOCOL), 1)
+    self.turns += 1
+    
+    # The turns after the one restored are cut off
+    index = self.Index()
+    if self.restored != None:
+      del index[self.restored + 1:]
+      self.writer.Write(os.path.join(self.folder, 'index.txt'), ''.join(index))
+      self.restored = None
+    
+    # The rank makes the name unique, even for two turns at the same clock
+    name = '%s.%d.delta'%(world.GetClock().strftime('%H%MZ.%d%b%y'), len(index))
+    line = '%s\t%s\t%d\n'%(world.GetClock().strftime('%Y-%m-%d %H:%M:%S'), name, full)
+    self.writer.Write(os.path.join(self.folder, name), data, 'wb')
+    self.writer.Append(os.path.join(self.folder, 'index.txt'), line)
+    index.append(line)
+    return name
+    
+  def Turns(self):
+    '''! \brief The turns in the order they were written, [clock, file, snapshot].
+    '''
+    out = []
+    for line in self.Index():
+      clock, name, full = line.rstrip('\n').split('\t')
+      out.append([datetime.strptime(clock, '%Y-%m-%d %H:%M:%S'), name, full == '1'])
+    return out
+    
+  def Restore(self, world, clock):
+    '''! \brief Replace the state of the world by the last turn stored at clock.
+    '''
+    # The turns from the snapshot
+    turns = self.Turns()
+    last = None
+    for i in range(len(turns)):
+      if turns[i][0] == clock:
+        last = i
+    if last == None:
+      raise SandboxException('ArchiveError', 'No turn at %s'%(clock))
+    first = last
+    while not turns[first][2]:
+      first -= 1
+      
+    # Replay
+    units = {}
+    state = {}
+    comms = None
+    for i in range(first, last + 1):
+      delta = loads(zlib.decompress(self.Read(turns[i][1])))
+      self.Merge(state, delta['world'])
+      if delta['comms'] != None:
+        comms = delta['comms']
+      for uid in delta['removed']:
+        del units[uid]
+      for uid in delta['units']:
+        self.Merge(units.setdefault(uid, {}), delta['units'][uid])
+            
+    # The units, the messages, then the fields of the units and the world
+    shells = {}
+    for uid in units:
+      shells[uid] = sandbox_entity.__new__(sandbox_entity)
+    for i, comm in enumerate(self.Load(world, shells, comms)):
+      shells['COMM%d'%(i)] = comm
+    for uid in units:
+      for k, v in units[uid].items():
+        if k[0]:
+          shells[uid].__dict__[k[1]] = self.Load(world, shells, v)
+        else:
+          dict.__setitem__(shells[uid], k[1], self.Load(world, shells, v))
+    for k, v in state.items():
+      world.__dict__[k] = self.Load(world, shells, v)
+    self.Reset()
+    self.restored = last
+    return world
+    
+  # Private methods
+  def Index(self):
+    '''! \brief The lines of index.txt.
+    '''
+    if self.index == None:
+      data = self.Read('index.txt')
+      self.index = []
+      if data != None:
+        self.index = [line + '\n' for line in data.splitlines()]
+    return self.index
+    
+  def Delta(self, world, full):
+    '''! \brief The fields that changed since the last turn, the world if it changed and the units removed.
+    '''
+    out = {'clock':world.GetClock(), 'full':full, 'world':{}, 'comms':None, 'units':{}, 'removed':[]}
+    index = world.index_uid
+    def UnitID(obj):
+      if isinstance(obj, sandbox_entity) and index.get(obj.get('uid')) is obj:
+        return obj['uid']
+      return None
+    
+    # The messages, once
+    comms = []
+    serial = {}
+    for unit in world.OOB:
+      for comm in unit['staff queue']:
+        if not id(comm) in serial:
+          serial[id(comm)] = 'COMM%d'%(len(comms))
+          comms.append(comm)
+    data = self.Dump(world, comms, UnitID)
+    digest = md5(data).digest()
+    if digest != self.lastcomms:
+      out['comms'] = data
+      self.lastcomms = digest
+    def PersistentID(obj):
+      if id(obj) in serial:
+        return serial[id(obj)]
+      return UnitID(obj)
+    
+    # The units
+    current = {}
+    for unit in world.OOB:
+      uid = unit['uid']
+      fields = [((0, k), v) for k, v in unit.items()] + [((1, k), v) for k, v in unit.__dict__.items()]
+      current[uid], changed = self.Changed(world, fields, self.last.get(uid, {}), PersistentID)
+      if changed:
+        out['units'][uid] = changed
+    out['removed'] = [uid for uid in self.last if not uid in current]
+    self.last = current
+    
+    # The world, without the transient attributes
+    fields = [(k, v) for k, v in world.__dict__.items() if not k in TRANSIENT]
+    self.lastworld, out['world'] = self.Changed(world, fields, self.lastworld, PersistentID)
+    return out
+    
+  def Changed(self, world, fields, last, pid):
+    '''! \brief The digests of the fields and the pickles of those that changed (None if deleted).
+    '''
+    digests = {}
+    changed = {}
+    for k, v in fields:
+      data = self.Dump(world, v, pid)
+      digests[k] = md5(data).digest()
+      if last.get(k) != digests[k]:
+        changed[k] = data
+    for k in last:
+      if not k in digests:
+        changed[k] = None
+    return digests, changed
+    
+  def Read(self, name):
+    '''! \brief The content of a file of the archive, or None.
+    '''
+    fname = os.path.join(self.folder, name)
+    if hasattr(self.writer, 'Read'):
+      return self.writer.Read(fname)
+    if not os.path.exists(fname):
+      return None
+    fin = open(fname, 'rb')
+    data = fin.read()
+    fin.close()
+    return data
+    
+  def Merge(self, fields, changed):
+    '''! \brief Apply the fields changed by a delta, in place (None deletes the field).
+    '''
+    for k, v in changed.items():
+      if v == None:
+        del fields[k]
+      else:
+        fields[k] = v
+    
+  def Dump(self, world, obj, pid):
+    buf = StringIO()
+    pickler = Pickler(buf, HIGHEST_PROTOCOL)
+    for i, x in enumerate(Externals(world)):
+      pickler.memo[id(x)] = (i, x)
+    pickler.inst_persistent_id = pid
+    pickler.dump(obj)
+    return buf.getvalue()
+  
+  def Load(self, world, shells, data):
+    unpickler = Unpickler(StringIO(data))
+    unpickler.memo = dict(enumerate(Externals(world)))
+    unpickler.persistent_load = shells.__getitem__
+    return unpickler.load()
+
+
+import unittest
+class CheckpointTest(unittest.TestCase):
+  def setUp(self):
+    from datetime import timedelta
+    from sandbox_world import sandbox
+    self.sbox = sandbox('testTwoFireTeamsUTM.xml')
+    self.sbox.SimulateScheduled(timedelta(minutes=30))
+
+  def tearDown(self):
+    self.sbox.writer.Flush()
+    self.sbox.DeleteFolder(self.sbox.OS['savepath'])
+
+  def Restored(self):
+    from sandbox_world import sandbox
+    out = sandbox()
+    return Loads(out, Dumps(self.sbox))
+
+  def testReferencesAttached(self):
+    new = self.Restored()
+    self.assertEqual([new.map is self.sbox.map, new.writer is SharedWriter(), new.OOB[0].sim is new, new.OOB[0] is self.sbox.OOB[0]],
+                     [True, True, True, False])
+
+  def testState(self):
+    new = self.Restored()
+    self.assertEqual([new.GetClock(), [u.GetName() for u in new.OOB], [float(u.GetCargo()) for u in new.OOB], new.AsEntity(new.OOB[1]['uid']) is new.OOB[1]],
+                     [self.sbox.GetClock(), [u.GetName() for u in self.sbox.OOB], [float(u.GetCargo()) for u in self.sbox.OOB], True])
+
+  def testRestoredWorldRuns(self):
+    from datetime import timedelta
+    new = self.Restored()
+    new.SimulateScheduled(timedelta(minutes=30))
+    self.sbox.SimulateScheduled(timedelta(minutes=30))
+    self.assertEqual([new.GetClock(), len(new.scheduler)], [self.sbox.GetClock(), len(self.sbox.scheduler)])
+
+  def testNotACheckpoint(self):
+    self.assertRaises(SandboxException, Loads, self.sbox, '<scenario/>')
+
+
+class ArchiveTest(unittest.TestCase):
+  def setUp(self):
+    from sandbox_world import sandbox
+    self.sbox = sandbox('testTwoFireTeamsUTM.xml')
+    self.turns = []
+    for i in range(4):
+      self.Turn()
+
+  def tearDown(self):
+    self.sbox.writer.Flush()
+    self.sbox.DeleteFolder(self.sbox.OS['savepath'])
+
+  def Turn(self):
+    from datetime import timedelta
+    self.sbox.SimulateScheduled(timedelta(minutes=30))
+    self.sbox.Save()
+    self.turns.append([self.sbox.GetClock(), [float(u.GetCargo()) for u in self.sbox.OOB]])
+
+  def Size(self, name):
+    return os.path.getsize(os.path.join(self.sbox.archive.folder, name))
+
+  def testIndex(self):
+    turns = self.sbox.archive.Turns()
+    self.assertEqual([[i[0] for i in turns], [i[2] for i in turns]], [[i[0] for i in self.turns], [True, False, False, False]])
+
+  def testDeltaSmallerThanSnapshot(self):
+    turns = self.sbox.archive.Turns()
+    self.assertTrue(self.Size(turns[-1][1]) < self.Size(turns[0][1]))
+
+  def testRewind(self):
+    clock, cargo = self.turns[1]
+    self.sbox.Rewind(clock)
+    self.assertEqual([self.sbox.GetClock(), [float(u.GetCargo()) for u in self.sbox.OOB], self.sbox.AsEntity(self.sbox.OOB[1]['uid']) is self.sbox.OOB[1], self.sbox.OOB[0].sim is self.sbox],
+                     [clock, cargo, True, True])
+
+  def testRewindAndRun(self):
+    self.sbox.Rewind(self.turns[0][0])
+    self.Turn()
+    self.assertEqual([self.sbox.GetClock(), self.sbox.archive.Turns()[-1][2]], [self.turns[1][0], True])
+
+  def testNoTurn(self):
+    from datetime import timedelta
+    self.assertRaises(SandboxException, self.sbox.Rewind, self.turns[0][0] - timedelta(days=1))
+    
+  def testSameClock(self):
+    # A snapshot then a delta at the same clock
+    clock, cargo = self.turns[0]
+    self.sbox.Rewind(clock)
+    self.sbox.Save()
+    self.sbox.Save()
+    self.sbox.Rewind(clock)
+    self.assertEqual([self.sbox.GetClock(), [float(u.GetCargo()) for u in self.sbox.OOB], [i[1] for i in self.sbox.archive.Turns()]],
+                     [clock, cargo, [self.sbox.archive.Turns()[0][1]] + ['%s.%d.delta'%(clock.strftime('%H%MZ.%d%b%y'), i) for i in [1, 2]]])
+    
+  def testRewindThenSave(self):
+    # A new timeline from the first turn replaces the turns that followed it
+    self.sbox.Rewind(self.turns[0][0])
+    self.sbox.OOB[0]['name'] = 'NEW TIMELINE'
+    self.Turn()
+    self.assertEqual([i[0] for i in self.sbox.archive.Turns()], [self.turns[0][0], self.turns[1][0]])
+    self.assertRaises(SandboxException, self.sbox.Rewind, self.turns[2][0])
+    self.sbox.Rewind(self.turns[1][0])
+    self.assertEqual(self.sbox.OOB[0]['name'], 'NEW TIMELINE')
@@ -22,7 +22,7 @@ from copy import deepcopy
 import os
 import os.path
 
-from random import random
+from sandbox_random import random
 from vector import vect_5D
 
 from sandbox_tasks import *
@@ -33,6 +33,8 @@ from sandbox_exception import SandboxException
 
 # function (debug conveniences mostly)
   
+# The templates read so far, by name
+_templates = {}
 
 # classes
 class sandbox_COMM(dict):
@@ -101,10 +103,13 @@ class sandbox_COMM(dict):
     '''
     if not tname:
       tname = self.template
-    try:
-      self.report = open(os.path.join(os.environ['OPCONhome'],'COMM',tname)).read()
-    except:
-      raise SandboxException('COMMTemplateNotFound',tname)
+    if not tname in _templates:
+      try:
+        _templates[tname] = open(os.path.join(os.environ['OPCONhome'],'COMM',tname)).read()
+      except:
+        raise SandboxException('COMMTemplateNotFound',tname)
+    self.report = _templates[tname]
+
     
   def FillField(self, field_name, content):
     ''' replace a field (without the ## optionally) by the text in content.
@@ -898,7 +903,7 @@ class OPORD(sandbox_COMM):
        Add a task to the queue
     '''
     task['opord'] = self
-    self.SetData(['EXECUTION','MANEUVER TASKS','sequence']).append(task)
+    self.GetData(['EXECUTION','MANEUVER TASKS','sequence']).append(task)
     self.AutoCursor()
 
       
@@ -943,7 +948,7 @@ class OPORD(sandbox_COMM):
     if not self.GetData(['EXECUTION','MANEUVER TASKS','sequence']):
       return None
     # If there is no tasks, the cursor should be None, not 0.
-    i = self,GetData(['EXECUTION','MANEUVER TASKS','cursor'])
+    i = self.GetData(['EXECUTION','MANEUVER TASKS','cursor'])
     if i == None:
       return None
     
@@ -1258,6 +1263,22 @@ class TestCaseOPORD(unittest.TestCase):
     temp = O.GetSupplyPolicies()
     
     self.assert_(temp['minimum']==1.0 and temp['maximum']==2.0)
+    
+  def testCurrentTask(self):
+    from sandbox_tasks import sandbox_task
+    opord = OPORD()
+    tasks = [sandbox_task(), sandbox_task()]
+    opord.SetData(['EXECUTION','MANEUVER TASKS','sequence'], tasks)
+    opord.AutoCursor()
+    self.assertTrue(opord.GetCurrentTask() is tasks[0])
+    
+  def testAddTask(self):
+    from sandbox_tasks import sandbox_task
+    opord = OPORD()
+    tasks = [sandbox_task(), sandbox_task()]
+    for i in tasks:
+      opord.AddTask(i)
+    self.assertEqual([len(opord.GetTaskList()), opord.GetCurrentTask() is tasks[0], tasks[1]['opord'] is opord], [2, True, True])
 
 if __name__ == '__main__':
     # suite
@@ -42,17 +42,38 @@ from sandbox_TOE import sandbox_component_state
 import sandbox_keywords
 
 from sandbox_exception import SandboxException
+from sandbox_profiler import SharedProfiler
+from sandbox_random import random
+
 
 
 from vector import *
 from GUIMapSym import MapSym
 
 from datetime import datetime
+from cStringIO import StringIO
 
 # function
 
 
 # classes
+class sandbox_model_method(object):
+  '''! \brief A method of the entity that is a method of one of its models (see sandbox_entity.BuildDispatch).
+  
+       A non-data descriptor: an attribute of the instance of the same name still comes first.
+  '''
+  def __init__(self, model, name):
+    self.model = model
+    self.name = name
+    
+  def __get__(self, E, cls = None):
+    if E is None:
+      return self
+    try:
+      return getattr(E[self.model], self.name)
+    except AttributeError:
+      # A model of another class
+      return E.__getattr__(self.name)
 
 '''
    The entity, or unit, is the item that the simulator is going to manipulate. 
@@ -127,6 +148,9 @@ class sandbox_entity(dict):
     self['staff queue'] = []
     self['OPORD'] = OPORD()
     
+    # Dormancy (see Sleep), None while the unit is stepped every pulse
+    self.dormant = None
+    
     # Location, heading, speed and disposition (non-templated)
     self.SetPosition( position_descriptor() ) #vect_5D()
     self['stance'] = 'deployed'
@@ -159,6 +183,12 @@ class sandbox_entity(dict):
     if not self.cargo:
       self.cargo = self.GetBasicLoad(self)
 
+  # The models scanned for the attributes the entity doesn't have, in order
+  models = ['C4I','combat','intelligence','logistics','movement']
+  
+  # Method name : the model defining it (see BuildDispatch)
+  dispatch = {}
+  
   def __getattr__(self, name):
     '''! \brief Attempt direct access to the models.
     
@@ -167,17 +197,39 @@ class sandbox_entity(dict):
          alternative solution.
          
          A special attention must be paid if there is a attribute name clash.
+         
+         The methods of the model classes don't get here (see BuildDispatch). Anything else (data
+         members, methods of a specialized model) is scanned for in the models, in order.
     '''
-    # Models to scan for
-    models = ['C4I','combat','intelligence','logistics','movement']
-    
-    for M in models:
+    for M in sandbox_entity.models:
       if hasattr(self[M], name):
         return getattr(self[M], name)
       
     # All else fail  
     raise AttributeError, name
   
+  @classmethod
+  def BuildDispatch(cls, classes):
+    '''! \brief Delegate the public methods of the model classes to their model, once.
+         \param classes A dictionary model name : class of the model.
+         
+         Each method becomes a sandbox_model_method of the class, so E.GetRCP is found by the normal
+         attribute lookup instead of failing it and scanning the models in __getattr__. The first
+         model in the scanning order wins a name defined by several, as in __getattr__. The names
+         defined by the entity itself are left out.
+    '''
+    for name in cls.dispatch:
+      delattr(cls, name)
+    cls.dispatch = {}
+    for M in reversed(cls.models):
+      for name in dir(classes[M]):
+        if not name.startswith('_') and callable(getattr(classes[M], name)) and not hasattr(cls, name):
+          cls.dispatch[name] = M
+    for name in cls.dispatch:
+      setattr(cls, name, sandbox_model_method(cls.dispatch[name], name))
+
+
+  
   def GetName(self, filenamesafe=False, asuniqueID=False):
     ''' Returns the unit's name. '''
     if filenamesafe:
@@ -241,7 +293,7 @@ class sandbox_entity(dict):
     mytask = self['OPORD'].GetCurrentTask()
     if mytask:
       if mytask.CanBegin(self.sim.clock,self['OPORD'].GetHhour()):
-        mytask.Step(self)
+        SharedProfiler().Call(mytask.__class__.__name__, None, mytask.Step, self)
     elif self['TOE'] != 'LOGPAC':
       # Weird, don't remmber why this is here -- CHECKOUT
       self['agent'].sustaintask.Step(self)
@@ -264,6 +316,52 @@ class sandbox_entity(dict):
       self['agent'].log('Taking Fatigue due to a supply shortage.','personel')
       self.AdjustFatigue(dmg)
     
+  # Dormancy
+  def IsDormant(self):
+    return self.dormant != None
+  
+  def Sleep(self, clock, until = None):
+    '''! \brief Stop stepping the unit until a wake condition fires.
+         \param clock The pulse the unit was last stepped.
+         \param until When the unit must be stepped again (None if no time is set).
+         
+         The simulator skips a dormant unit in the NewPulse, Engagements, StepAll, Regroup and Staffwork
+         phases. It still detects and is detected. Other wake conditions are a new message in the staff
+         queue, a sighting of another side and an engagement.
+    '''
+    self.dormant = {'since':clock, 'until':until, 'queue':len(self['staff queue'])}
+    
+  def MustWake(self, clock):
+    '''! \brief True if the wake up time is reached or if a message was queued.
+    '''
+    if self.dormant['until'] != None and clock >= self.dormant['until']:
+      return True
+    return len(self['staff queue']) != self.dormant['queue']
+    
+  def Settle(self, clock):
+    '''! \brief Apply the effects of the pulses after the last one settled, up to clock.
+    
+         A dormant unit is idle, the only per-pulse effect left is the idle expenditure of supply,
+         which is linear in time. Regroup has nothing to do as the agent only lets a unit sleep
+         without suppression or supply deficit.
+    '''
+    delta = clock - self.dormant['since']
+    hours = delta.days * 24.0 + delta.seconds / 3600.0
+    if hours > 0.0:
+      cost = self['logistics'].SupplyExpenditure(1, ['idle'], hours, self)
+      self.AdjustSupply(cost * -1.0)
+      self.dormant['since'] = clock
+      
+  def Wake(self, clock):
+    '''! \brief Settle the pulses spent dormant and step the unit again, from the pulse at clock.
+    '''
+    if not self.dormant:
+      return
+    self.Settle(clock - self.sim.pulse)
+    self.dormant = None
+    self['agent'].log('Resuming activities after a quiet period.','operations')
+    self.NewPulse(clock)
+    
   # C4I - Human Factors
   def AdjustMorale(self, val):
     '''! \brief Adjust the value of morale by some value
@@ -411,6 +509,7 @@ class sandbox_entity(dict):
     if subord not in self['subordinates']:
       self['subordinates'].append(subord)
       self.sim.COMMnets[self.GetInnerCOMMnet()].append(subord)
+      self.FootprintChanged()
 
 
   def DeleteSubordinate(self, sub):
@@ -423,6 +522,7 @@ class sandbox_entity(dict):
     if sub in self['subordinates']:
       self['subordinates'].remove(sub)
       out = True
+      self.FootprintChanged()
       # remove from the comm net
       try:
         self.sim.COMMnets[self.GetInnerCOMMnet()].remove(sub)
@@ -514,6 +614,8 @@ class sandbox_entity(dict):
 
     # Connect to the new HQ
     self['HQ'] = HQ
+    if self.sim:
+      self.sim.ChainOfCommandChanged()
     
     # Get the HQ to connect 
     if HQ:
@@ -633,9 +735,25 @@ class sandbox_entity(dict):
   # Echelon code
   def DeleteEchelonFootprint(self):
     '''! \brief Remove the footprint from the C4I model so it can be recomputed.
+    
+         The footprints of the higher echelons include it, they are removed too. A missing echelon
+         footprint is thus the dirty flag of the echelon: if it is missing, it is missing all the way up.
+         A unit without subordinates stores none, use FootprintChanged() to mark its higher echelons.
     '''
     if self.has_key('Echelon Footprint'):
       del self['Echelon Footprint']
+      self.HigherEchelonsChanged()
+      
+  def FootprintChanged(self):
+    '''! \brief The footprint of the unit changed, the echelon footprints including it will be recomputed.
+    '''
+    self.DeleteEchelonFootprint()
+    self.HigherEchelonsChanged()
+    
+  def HigherEchelonsChanged(self):
+    for hq in [self['HQ'], self['OPCON']]:
+      if isinstance(hq, sandbox_entity):
+        hq.DeleteEchelonFootprint()
       
   def EchelonFootprint(self, force= False):
     '''! \brief return the footprint for the entire echelon.
@@ -643,13 +761,15 @@ class sandbox_entity(dict):
          If there is no Echelon Footprint, but an echelon, compute it recursively.
          
          To get the percieved footprint, ask agent_CO.SolveFootprint()
+         
+         Unless forced, only the echelons marked by FootprintChanged() are recomputed.
     '''
     # Echelon Test
     if self.Echelon() and self.Subordinates():
       if self.has_key('Echelon Footprint') and not force:
         return self['Echelon Footprint']
       else:
-        V = self.Footprint().vertices()
+        V = list(self.Footprint().vertices())
         for i in self.Subordinates():
            V += i.EchelonFootprint(force).vertices()
         
@@ -727,9 +847,10 @@ class sandbox_entity(dict):
     k = cnt.unit['side']+cnt.unit.GetName()
     self['contacts'][k] = cnt
     
-  def Detection(self, other):
+  def Detection(self, other, reach = None):
     '''!
        Handle all the detection and classification as called by the simulator
+       reach --> The overlap of the sensors with other, if known (see intelligence.SensorReach)
     '''
     if other.has_key('delete me'):
       return
@@ -740,7 +861,15 @@ class sandbox_entity(dict):
       contact = sandbox_contact(other)
       
     # Acquisition
-    self['intelligence'].AcquireTarget(self, other)
+    stamp = contact.GetTimeStamp()
+    self['intelligence'].AcquireTarget(self, other, reach)
+    
+    # A dormant unit wakes up at the next pulse if it sights another side
+    if self.dormant and other['side'] != self['side']:
+      contact = self.Contact(other)
+      if contact and contact.GetTimeStamp() != stamp:
+        self.dormant['until'] = self.sim.clock
+
 
   
 
@@ -808,6 +937,8 @@ class sandbox_entity(dict):
       self['position'] = pos
     elif isinstance(pos, vect_3D):
       self['position'].Set(pos)   
+    if self.sim:
+      self.sim.UpdateSpatialIndex(self)
     
   
   def SetFootprint(self, fp):
@@ -824,6 +955,8 @@ class sandbox_entity(dict):
     self['position'].SetFootprint(fp)
     if dv:
       dv.AoI = self.Footprint()
+    if self.sim:
+      self.sim.UpdateSpatialIndex(self)
         
   def PointInFootprint(self, point):
     # Geometric implementation (replacing the circle assumption from the original design)
@@ -1000,7 +1133,7 @@ class sandbox_entity(dict):
     
     # Position descriptor ###################################
     # Fetch the node, either a pos_desc or location
-    ploc = doc.Get(node, 'location')
+    ploc = doc.Get(node, 'location', raw_nodes=True)
     if ploc != '':
       # Check for type of location
       loctype = doc.Get(ploc, 'type')
@@ -1008,10 +1141,10 @@ class sandbox_entity(dict):
         raise SandboxException('NoTypedLocation',self.GetName())
       if loctype == 'coordinates':
         # Get the content of the node
-        coord = doc.Get(ploc)
+        coord = str(ploc.firstChild.nodeValue).strip()
       elif loctype == 'named_location':
         # Get the coordinate from the network
-        nd = self.sim.network.GetNode(doc.Get(ploc))
+        nd = self.sim.network.GetNode(str(ploc.firstChild.nodeValue).strip())
         # Get the coordinate from the node
         coord = nd.Coordinates()
       else:
@@ -1092,9 +1225,10 @@ class sandbox_entity(dict):
         # The HIGHER unit
         x = self.sim.GetEntity(self['side'],hq)
         if x:
-          self['HQ'] = x
+          self.ReportToHQ(x)
         elif hq:
           self['HQ'] = hq
+        self.sim.ChainOfCommandChanged()
         
         # The OPCON unit
         x = self.sim.GetEntity(self['side'],opcon)
@@ -1124,11 +1258,20 @@ class sandbox_entity(dict):
             self['contacts'][key] = cnt
       
   def fileAppendLogs(self):
-    fout = open(os.path.join(self['folder'],'logs.txt'),'a')
+    fname = os.path.join(self['folder'],'logs.txt')
+    # Post to the writer thread of the simulator
+    if self.sim:
+      buf = StringIO()
+      self['log'].fileUpdate(buf)
+      self.sim.writer.Append(fname, buf.getvalue())
+      return
+    fout = open(fname,'a')
     self['log'].fileUpdate(fout)
     fout.close()
     
 
+# Resolve the methods delegated to the models once
+sandbox_entity.BuildDispatch({'C4I':C4I, 'combat':combat, 'intelligence':intelligence, 'logistics':logistics, 'movement':movement})
   
 
 import unittest
@@ -1156,6 +1299,15 @@ class EntityTest(unittest.TestCase):
     unit = sandbox_entity(template='FireTeam', sim=self.sim)
     self.assertFalse(False)
     
+  def testDispatchAsScan(self):
+    unit = sandbox_entity(template='FireTeam', sim=self.sim)
+    for name in sandbox_entity.dispatch:
+      scan = [getattr(unit[M], name) for M in sandbox_entity.models if hasattr(unit[M], name)][0]
+      self.assertEqual(getattr(unit, name), scan)
+    self.assertEqual([sandbox_entity.dispatch['AsStringMorale'], sandbox_entity.dispatch['GetRCP'], 'keys' in sandbox_entity.dispatch], ['C4I', 'combat', False])
+    self.assertRaises(AttributeError, getattr, unit, 'NoSuchMethod')
+    
+
   def testWrongEchelonLabel(self):
     unit = sandbox_entity(command_echelon= 'bogus', template='FireTeam')
     self.assertFalse(unit['command_echelon']=='Team')
@@ -1241,6 +1393,72 @@ class EntityTest(unittest.TestCase):
     
     self.assertTrue(unit.GetName())
     
+  def testDormantIdleUnitSettlesSupply(self):
+    from datetime import timedelta
+    units = []
+    for lazy in [True, False]:
+      sim = self.sim.__class__()
+      sim.lazy = lazy
+      unit = sandbox_entity(template='FireTeam', sim=sim)
+      sim.AddEntity(unit)
+      sim.SimulateScheduled(timedelta(hours=3))
+      units.append(unit)
+    self.assertEqual([units[0].IsDormant(), units[1].IsDormant()], [True, False])
+    self.assertAlmostEqual(float(units[0].GetCargo()), float(units[1].GetCargo()), 6)
+    
+  def testDormantUntilTaskBegins(self):
+    from datetime import timedelta
+    from sandbox_tasks import taskRedeploy
+    unit = sandbox_entity(template='FireTeam', sim=self.sim)
+    self.sim.AddEntity(unit)
+    self.sim.SimulateScheduled(timedelta(hours=1))
+    
+    # An order wakes the unit up, which sleeps again until the task can begin
+    order = OPORD(unit, unit)
+    task = taskRedeploy()
+    task['final_stance'] = 'deliberate defense'
+    task['set begin time'] = self.sim.clock + timedelta(hours=1)
+    order.AddTask(task)
+    unit.IssueOrder(order)
+    out = [unit.MustWake(self.sim.clock)]
+    self.sim.SimulateScheduled(timedelta(minutes=30))
+    out.append(unit.dormant['until'] == task['set begin time'])
+    self.sim.SimulateScheduled(timedelta(hours=1))
+    out.append(unit.IsDormant())
+    self.assertEqual(out + [task['begin time']], [True, True, False, task['set begin time']])
+    
+  def testLoadLocation(self):
+    # Both types of location nodes place the unit
+    from sandbox_world import sandbox
+    for fname, coord in [('testOneFireTeamUTM.xml', '33T UG 2500'), ('testOneFireTeamNameLoc.xml', None)]:
+      sim = sandbox(fname, gametag='Load Location Test', headless=True)
+      if coord == None:
+        coord = sim.network.GetNode('LIRL').Coordinates()
+      self.assertEqual(sim.OOB[0]['position'].AsVect(), sim.map.MGRS.AsVect(coord))
+    
+  def testChainOfCommandOnLoad(self):
+    # The HQs of a loaded scenario know their subordinates
+    from sandbox_world import sandbox
+    sim = sandbox('testEchelonAnzio.xml', gametag='Chain Of Command Test', headless=True)
+    units = [i for i in sim.OOB if i.GetHQ()]
+    self.assertTrue(units)
+    for i in units:
+      self.assertTrue(i in i.GetHQ().Subordinates())
+    
+  def testUnknownModeFriction(self):
+    unit = sandbox_entity(template='FireTeam', sim=self.sim)
+    self.sim.AddEntity(unit)
+    unit['movement']['mode'] = 'hovercraft'
+    self.assertTrue(unit['movement'].friction_dict() is self.sim.map.frictions[''])
+    
+  def testVehicleModes(self):
+    # The modes of the vehicles come from their kit
+    unit = sandbox_entity(template='US-light-scout-section', sim=self.sim)
+    kits = [i.GetKit().GetMode() for i in unit['movement'].vehicles]
+    self.assertTrue(kits)
+    self.assertEqual(sorted(unit['movement'].GetModes()), sorted(set(kits + [unit['movement']['mode']])))
+    
+
 if __name__ == '__main__':
     # suite
     testsuite = []
@@ -1250,4 +1468,4 @@ if __name__ == '__main__':
     
     # collate all and run
     allsuite = unittest.TestSuite(testsuite)
-    unittest.TextTestRunner(verbosity=2).run(allsuite)
\ No newline at end of file
+    unittest.TextTestRunner(verbosity=2).run(allsuite)
\ No newline at end of file
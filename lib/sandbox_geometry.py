@@ -7,13 +7,14 @@
 from vector import vect_3D, vect_5D, NormalizeAngle
 from algo_DP import Dynamic_Programming
 
+import numpy
 from numpy import array
 from numpy.linalg import det
 
-from random import random, gauss, randint
+from sandbox_random import random, gauss, randint
 from copy import copy, deepcopy
 
-from math import pi, cos, acos, sin
+from math import pi, cos, acos, sin, sqrt
 
 class geometry_rubberband:
     '''! \brief Compute a rubberband for an arbitrary set of vertices.
@@ -21,36 +22,32 @@ class geometry_rubberband:
     def Solve(self, V):
         '''! \brief Solve for the convex polygon inscribing all vertices in V.
              \return The set of V defining the convex polygon
+             
+             Monotone chain: the vertices are sorted by x (then y), the upper hull is built from left to
+             right and the lower hull back, each dropping the vertices that don't make a right turn. The
+             polygon is clockwise from the leftmost vertex, without collinear vertices. V isn't modified.
         '''
         # If 3 or less vertices, return as polygon
         if len(V) <= 3:
             return base_polygon(V)
         
-        # Kernelize all vertices within the extrema
-        # Prune the Dataset from interior vertices, keep extrema vertices
-        box = self.Extrema(V)
-        if len(box) > 2:
-            V = self.KernelizeConvexPolygon(V,box, False)
-            
-        # Define tracking vars
-        # Angle of last "matching"
-        A = 0.0
-        out = [box[0]]
-        V.remove(box[0])
-        while(len(V)):
-            # Find next vertex
-            A, nextv = self.Next(A, out[-1], V)
-            
-            # Add to solution
-            if nextv:
-                out.append(nextv)
-                V.remove(nextv)
-                
-            # Kernelize
-            if len(out) > 2:
-                V = self.KernelizeConvexPolygon(V, out)
-                
-        return base_polygon(out)
+        pts = sorted(V, key = lambda v: (v.x, v.y))
+        upper = self.Chain(pts)
+        pts.reverse()
+        lower = self.Chain(pts)
+        
+        # The ends of each chain are the start of the other
+        return base_polygon(upper[:-1] + lower[:-1])
+    
+    def Chain(self, pts):
+        '''! \brief Half of the hull, turning right from pts[0] to pts[-1].
+        '''
+        out = []
+        for v in pts:
+            while len(out) > 1 and Cross(out[-2], out[-1], v) >= 0.0:
+                out.pop()
+            out.append(v)
+        return out
                 
     def Next(self, A, C, V):
         '''! \brief Find the next vertex to add to the rubberbanding
@@ -226,6 +223,261 @@ def ConvexPolygon(V):
             
             
 
+def Cross(O, A, B):
+    '''! \brief z of the cross product OA x OB: positive if O, A, B turn left (counter-clockwise).
+    '''
+    return (A.x-O.x)*(B.y-O.y) - (A.y-O.y)*(B.x-O.x)
+
+# Distance to an edge under which a point is on it (km)
+ON_EDGE = 1e-9
+
+def AsPoints(points):
+    '''! \brief An (M,2) array of x, y from a list of vect_XD (or an array).
+    '''
+    if isinstance(points, numpy.ndarray):
+        return points.reshape(-1, 2)
+    return array([(p.x, p.y) for p in points], float).reshape(-1, 2)
+
+def PointsInPolygon(P, V):
+    '''! \brief Even/odd crossing test of points against a polygon, all edges at once.
+         \param P The points, a (M,2) array.
+         \param V The vertices of the polygon, a (N,2) array.
+         \return A boolean array of M, True for the points inside or on an edge.
+         
+         Each edge counts as crossed if it straddles the horizontal line of the point (one end strictly
+         above, the other not) to the right of the point. A vertex is thus counted once, and the result
+         doesn't depend on any random ray.
+    '''
+    if len(V) == 0:
+        return numpy.zeros(len(P), bool)
+    cross, onedge = EdgeTests(P[:,0:1], P[:,1:2], V, numpy.roll(V, 1, 0))
+    return (cross.sum(1) % 2 == 1) | onedge.any(1)
+
+def EdgeTests(x, y, A, B):
+    '''! \brief Test points against edges, the arrays broadcast as numpy does.
+         \param x, y The coordinates of the points.
+         \param A, B The ends of the edges, (N,2) arrays.
+         \return Whether the ray going east from the point crosses each edge, and whether the point is
+                 on it (close to its line, within its box).
+    '''
+    ax, ay, bx, by = A[:,0], A[:,1], B[:,0], B[:,1]
+    straddle = (ay > y) != (by > y)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        cross = straddle & (x < bx + (y - by) * (ax - bx) / (ay - by))
+    ex = ax - bx
+    ey = ay - by
+    length = numpy.sqrt(ex*ex + ey*ey)
+    onedge = (abs(ex * (y - by) - ey * (x - bx)) <= ON_EDGE * numpy.maximum(length, 1.0)) & \
+             (x >= numpy.minimum(ax, bx) - ON_EDGE) & (x <= numpy.maximum(ax, bx) + ON_EDGE) & \
+             (y >= numpy.minimum(ay, by) - ON_EDGE) & (y <= numpy.maximum(ay, by) + ON_EDGE)
+    return cross, onedge
+
+def PointInPolygons(pt, polygons):
+    '''! \brief Whether a point is inside each of a list of polygons, in one pass.
+         \return A list of booleans.
+         
+         The circles are tested on their radius, the edges of all other polygons are stacked and tested
+         as in PointsInPolygon. Anything else (an operational area) is asked with its PointInside.
+    '''
+    out = [False] * len(polygons)
+    circles = []
+    others = []
+    for i in range(len(polygons)):
+        if isinstance(polygons[i], circle):
+            circles.append(i)
+        elif not isinstance(polygons[i], base_polygon):
+            out[i] = bool(polygons[i].PointInside(pt))
+        elif len(polygons[i]):
+            others.append(i)
+
+    if circles:
+        c = array([(polygons[i].center.x, polygons[i].center.y, polygons[i].radius) for i in circles])
+        d = (c[:,0] - pt.x)**2 + (c[:,1] - pt.y)**2 <= c[:,2]**2
+        for i, val in zip(circles, d.tolist()):
+            out[i] = val
+    if others:
+        # The edges of all polygons, with the polygon of each
+        A = numpy.concatenate([polygons[i].xy for i in others])
+        B = numpy.concatenate([numpy.roll(polygons[i].xy, 1, 0) for i in others])
+        owner = numpy.repeat(numpy.arange(len(others)), [len(polygons[i]) for i in others])
+        cross, onedge = EdgeTests(pt.x, pt.y, A, B)
+        inside = (numpy.bincount(owner, cross, len(others)).astype(int) % 2 == 1) | (numpy.bincount(owner, onedge, len(others)) > 0)
+
+        for i, val in zip(others, inside.tolist()):
+            out[i] = val
+    return out
+
+def SegmentDistances(x, y, A, B):
+    '''! \brief The squared distance of points to segments, the arrays broadcast as in EdgeTests.
+    '''
+    ax, ay, bx, by = A[:,0], A[:,1], B[:,0], B[:,1]
+    ex = ax - bx
+    ey = ay - by
+    L = ex*ex + ey*ey
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        t = numpy.clip(((x - bx) * ex + (y - by) * ey) / L, 0.0, 1.0)
+    t = numpy.where(L > 0.0, t, 0.0)
+    dx = bx + t * ex - x
+    dy = by + t * ey - y
+    return dx*dx + dy*dy
+
+def BoxesOverlap(a, b):
+    return not (a[0] > b[2] or a[2] < b[0] or a[1] > b[3] or a[3] < b[1])
+
+def Overlap(A, B):
+    '''! \brief Whether two shapes overlap, touching included.
+    
+         Circles are tested analytically (on the distance between centers, or from the center to the
+         edges of a polygon), two convex polygons on their separating axes. The other polygons are
+         tested on their vertices and crossing edges (OverlapByEdges). Anything that isn't a polygon (a
+         position or an operational area) is asked with its Overlaps.
+    '''
+    if not isinstance(A, base_polygon):
+        return A.Overlaps(B)
+    if not isinstance(B, base_polygon):
+        return B.Overlaps(A)
+    if isinstance(B, circle) and not isinstance(A, circle):
+        A, B = B, A
+    if not isinstance(B, circle) and len(B) == 0:
+        return False
+    if not BoxesOverlap(A.BoundingBox(), B.BoundingBox()):
+        return False
+    if isinstance(A, circle):
+        if isinstance(B, circle):
+            dx = B.center.x - A.center.x
+            dy = B.center.y - A.center.y
+            return dx*dx + dy*dy <= (A.radius + B.radius)**2
+        return CircleOverlapsPolygon(A.center, A.radius, B)
+    if A.IsConvex() and B.IsConvex():
+        return not Separated(A.Coords(), B.Coords())
+    return OverlapByEdges(A, B)
+
+def CircleOverlapsPolygon(center, radius, P):
+    '''! \brief A circle overlaps P if its center is inside, or if an edge of P is within radius of it.
+    '''
+    if P.PointInside(center):
+        return True
+    x = center.x
+    y = center.y
+    r2 = (radius + ON_EDGE)**2
+    coords = P.Coords()
+    bx, by = coords[-1]
+    for ax, ay in coords:
+        ex = ax - bx
+        ey = ay - by
+        L = ex*ex + ey*ey
+        t = 0.0
+        if L > 0.0:
+            t = min(1.0, max(0.0, ((x - bx) * ex + (y - by) * ey) / L))
+        dx = bx + t * ex - x
+        dy = by + t * ey - y
+        if dx*dx + dy*dy <= r2:
+            return True
+        bx, by = ax, ay
+    return False
+
+def Separated(P, Q):
+    '''! \brief Separating axis test of two convex polygons, lists of (x, y).
+         \return True if the projections on the normal of one of the edges don't overlap.
+    '''
+    for V in (P, Q):
+        bx, by = V[-1]
+        for ax, ay in V:
+            nx = by - ay
+            ny = ax - bx
+            pa = [nx * x + ny * y for x, y in P]
+            pb = [nx * x + ny * y for x, y in Q]
+            eps = ON_EDGE * max(sqrt(nx*nx + ny*ny), 1.0)
+            if max(pa) < min(pb) - eps or max(pb) < min(pa) - eps:
+                return True
+            bx, by = ax, ay
+    return False
+
+def OverlapByEdges(A, B):
+    '''! \brief Overlap of any two polygons: a vertex of one inside the other, or two edges crossing.
+    '''
+    # Any vertice into the other
+    for i in A.vertices():
+        if B.PointInside(i):
+            return True
+    for j in B.vertices():
+        if A.PointInside(j):
+            return True
+        
+    # Any edge crossing another.
+    sv = A.vertices()
+    ov = B.vertices()
+    for s in range(len(sv)):
+        for o in range(len(ov)):
+            if Intersect([sv[s-1],sv[s]],[ov[o-1],ov[o]]) != None:
+                return True
+    return False
+
+def Overlapping(shape, shapes):
+    '''! \brief Overlap of a shape with each of a list of shapes (footprints), in one pass.
+         \return A list of booleans.
+         
+         The boxes are tested at once. For a circle, the other circles are tested on their centers and
+         the polygons on the distance to all their edges, stacked. A polygon is tested at once against
+         the circles, and one by one (see Overlap) against the polygons left by the boxes.
+    '''
+    out = [False] * len(shapes)
+    if not isinstance(shape, base_polygon):
+        return [bool(shape.Overlaps(i)) for i in shapes]
+    if not isinstance(shape, circle) and len(shape.xy) == 0:
+        return out
+    candidates = []
+    for i, s in enumerate(shapes):
+        if not isinstance(s, base_polygon):
+            out[i] = bool(Overlap(shape, s))
+        elif isinstance(s, circle) or len(s.xy):
+            candidates.append(i)
+    if not candidates:
+        return out
+    
+    # The boxes
+    box = shape.BoundingBox()
+    boxes = array([shapes[i].BoundingBox() for i in candidates])
+    inbox = ((boxes[:,0] <= box[2]) & (boxes[:,2] >= box[0]) & (boxes[:,1] <= box[3]) & (boxes[:,3] >= box[1])).tolist()
+    candidates = [i for i, ok in zip(candidates, inbox) if ok]
+    circles = [i for i in candidates if isinstance(shapes[i], circle)]
+    polygons = [i for i in candidates if not isinstance(shapes[i], circle)]
+
+    if circles:
+        c = array([(shapes[i].center.x, shapes[i].center.y, shapes[i].radius) for i in circles])
+        if isinstance(shape, circle):
+            d = (c[:,0] - shape.center.x)**2 + (c[:,1] - shape.center.y)**2 <= (c[:,2] + shape.radius)**2
+        else:
+            # The centers inside, or the edges of the polygon within the radius
+            A = shape.xy
+            d2 = SegmentDistances(c[:,0:1], c[:,1:2], A, numpy.roll(A, 1, 0)).min(1)
+            d = PointsInPolygon(c[:,0:2], A) | (d2 <= (c[:,2] + ON_EDGE)**2)
+        for i, val in zip(circles, d.tolist()):
+            out[i] = val
+    
+    if polygons and isinstance(shape, circle):
+        # The nearest edge within the radius. The edges of all polygons are stacked, each vertex with
+        # the previous one of its polygon.
+        x = shape.center.x
+        y = shape.center.y
+        A = numpy.concatenate([shapes[i].xy for i in polygons])
+        sizes = array([len(shapes[i].xy) for i in polygons])
+        starts = numpy.cumsum(sizes) - sizes
+        prev = numpy.arange(len(A)) - 1
+        prev[starts] = starts + sizes - 1
+        d2 = numpy.minimum.reduceat(SegmentDistances(x, y, A, A[prev]), starts)
+        for i, val in zip(polygons, (d2 <= (shape.radius + ON_EDGE)**2).tolist()):
+            # Or the center inside
+            if not val:
+                b = shapes[i].BoundingBox()
+                val = b[0] <= x <= b[2] and b[1] <= y <= b[3] and shapes[i].PointInside(shape.center)
+
+            out[i] = val
+    elif polygons:
+        for i in polygons:
+            out[i] = Overlap(shape, shapes[i])
+    return out
+
 def Intersect(A,B):
     '''
        return the intersecting point of two lines OR none
@@ -310,21 +562,32 @@ def InterceptPoint(P, A, B):
         X = A + (AB * r)
         return X    
         
-class base_polygon:
+class base_polygon(object):
     '''! \brief A polygon object
     
          \param pts a list of vect_XD instances.
          
          Access the internal data through .vertices rather than self.pts because some inherited class do not have explicit pts defined (such as the circle).
          
+         The vertices are kept as a (N,2) array of x, y (self.xy) and the transformations work on the
+         array. The bounding box, centroid and area are computed once and kept until the vertices change
+         (see Changed). vertices() and pts are a list of vect_5D made from the array when first asked
+         for, assign pts (see SetVertices) to change the vertices.
     '''
     def __init__(self, pts = None):
-        self.pts = pts
+        self.SetVertices(pts)
         self.SortPts(pts)
 
+    def __getstate__(self):
+        # Don't save what can be computed again
+        out = self.__dict__.copy()
+        for k in ['_vertices', '_coords', '_bbox', '_centroid', '_area', '_convex', '_ring']:
+            if k in out:
+                out[k] = None
+        return out
 
     def __nonzero__(self):
-        return bool(self.pts)
+        return len(self.xy) > 0
     def __mul__(self, other):
         # returns a scaled copy of the polygon
         if type(other) == type(1) or type(other) == type(1.0):
@@ -336,39 +599,67 @@ class base_polygon:
 
     
     def __len__(self):
-        if self.pts:
-            return len(self.pts)
-        return 0
+        return len(self.xy)
+    
+    # Vertices
+    def SetVertices(self, pts):
+        '''! \brief Replace the vertices by a list of vect_XD, a (N,2) array or the vertices of another polygon.
+        '''
+        if isinstance(pts, base_polygon):
+            pts = pts.xy
+        if isinstance(pts, numpy.ndarray):
+            self.xy = array(pts, float).reshape(-1, 2)
+        else:
+            self.xy = array([(v.x, v.y) for v in pts or []], float).reshape(-1, 2)
+        self.Changed()
+    
+    def GetPts(self):
+        return base_polygon.vertices(self)
+    
+    pts = property(GetPts, SetVertices)
+    
+    def Changed(self):
+        '''! \brief Forget the quantities derived from the vertices, to be called when self.xy changes.
+        '''
+        self._vertices = None
+        self._coords = None
+        self._bbox = None
+        self._centroid = None
+        self._area = None
+        self._convex = None
     
     # Properties
     def Radius(self):
         '''! \brief Average distance from the centroid
         '''
-        # from the centroid
-        center = self.Centroid()
-        v = self.vertices()
-        cum = 0.0
-        for i in v:
-            cum += (center-i).length()
-        return cum / len(v)
+        d = self.xy - self.CentroidXY()
+        return float(numpy.sqrt((d*d).sum(1)).mean())
     
     def Area(self):
         '''! \brief Triangulate then sum the area of all triangles.
+        
+             Kept until the shape changes (a translation or a rotation keeps it).
         '''
-        out = 0.0
+        if self._area == None:
+            out = 0.0
 
-        # triangle
-        T = self.Triangulate()
-        
-        for i in T:
-            out += i.Area()
+            # triangle
+            T = self.Triangulate()
             
-        return out
+            for i in T:
+                out += i.Area()
+                
+            self._area = out
+        return self._area
     
     def BoundingBox(self, pts = None):
         ''' Can overide pts with self.pts'''
         if pts == None:
-            pts = self.pts
+            if self._bbox == None:
+                low = self.xy.min(0)
+                high = self.xy.max(0)
+                self._bbox = [float(low[0]), float(low[1]), float(high[0]), float(high[1])]
+            return list(self._bbox)
             
         # Not enough points
         if len(pts) == 1:
@@ -395,81 +686,94 @@ class base_polygon:
         return [minx,miny,maxx,maxy]
     
     def Centroid(self):
-        '''! \brief Runtime computation of the centroid.
+        '''! \brief The mean of the vertices.
         '''
-        out = vect_3D()
-        for i in self.pts:
-            out = out + i
-        return out * (1.0/len(self.pts))
+        ct = self.CentroidXY()
+        return vect_3D(ct[0], ct[1])
+    
+    def CentroidXY(self):
+        if self._centroid is None:
+            self._centroid = self.xy.mean(0)
+        return self._centroid
     
     def vertices(self):
-        return self.pts
+        if self._vertices == None:
+            self._vertices = [vect_5D(x, y) for x, y in self.xy.tolist()]
+        return self._vertices
+    
+    def Signature(self):
+        '''! \brief A value that changes with the shape or position of the polygon.
+        '''
+        return self.xy.tostring()
+    
+    def Coords(self):
+        '''! \brief The vertices as a list of (x, y), for the tests written as loops.
+        '''
+        if self._coords == None:
+            self._coords = self.xy.tolist()
+        return self._coords
+    
+    def IsConvex(self):
+        '''! \brief All turns are on the same side and the outline goes around once.
+        '''
+        if self._convex == None:
+            E = numpy.roll(self.xy, -1, 0) - self.xy
+            # Ignore the repeated vertices
+            E = E[(E != 0.0).any(1)]
+            if len(E) < 4:
+                self._convex = True
+            else:
+                z = E[:,0] * numpy.roll(E[:,1], -1) - E[:,1] * numpy.roll(E[:,0], -1)
+                z = z[abs(z) > 1e-12 * (E*E).sum(1).max()]
+                # The direction changes of sign at most twice along x and along y
+                flips = [numpy.sign(d[d != 0.0]) for d in (E[:,0], E[:,1])]
+                flips = [(s != numpy.roll(s, 1)).sum() for s in flips]
+                self._convex = bool(((z >= 0.0).all() or (z <= 0.0).all()) and max(flips) <= 2)
+        return self._convex
     
     # Tests
     def Overlaps(self, other):
         '''
-           Return True is other overlaps self.
+           Return True is other overlaps self (see Overlap).
         '''
-        # Stage 1 - Bounding box
-        me = self.BoundingBox()
-        it = other.BoundingBox()
-        
-        # Boxes have no overlap
-        if me[0] > it[2] or me[2] < it[0] or me[1] > it[3] or me[3] < it[1]:
-            return False
-        
-        # Any vertice into the other
-        for i in self.vertices():
-            if other.PointInside(i):
-                return True
-        for j in other.vertices():
-            if self.PointInside(j):
-                return True
-            
-        # Any edge crossing another.
-        sv = self.vertices()
-        ov = other.vertices()
-        for s in range(len(sv)):
-            for o in range(len(ov)):
-                if Intersect([sv[s-1],sv[s]],[ov[o-1],ov[o]]) != None:
-                    return True
-        
-        return False
+        return Overlap(self, other)
+    
+    def OverlapsAny(self, others):
+        '''! \brief Overlaps for a list of shapes (see Overlapping).
+        '''
+        return Overlapping(self, others)
+    
     def PointInside(self, pt):
-        '''! \brief based on the method of even/odd crossing of edges.
-             Choose a random ray betwee 0 and pi and hope that no vertices aren't in the way.
+        '''! \brief based on the method of even/odd crossing of edges (see PointsInPolygon).
+             A point on an edge or a vertex is inside.
+             
+             The same test as EdgeTests, in a loop: for one point, cheaper than the array operations.
         '''
-        # Accumulate bearing
-        B = []
-        for v in self.vertices():
-            bear = pt.BearingTo(v)
-            if bear[1] == 0.0:
-                # Point matching exactly this vertex
-                return True
-            B.append(bear[0])
-        
-        # Count crossing
-        crossing = 0
-        
-        # Pick a ray between 0 and 1 radian
-        ray = 0.0
-        while ray in B:
-            ray = random()
-            
-        for i in xrange(len(B)):
-            mn = min(B[i-1],B[i])
-            mx = max(B[i-1],B[i])
-            if mn < ray and mx > ray and mx-mn < pi:
-                crossing += 1
-            elif mx-mn == pi:
-                return True
-                
-        # 0 or even crossing is false
-        if crossing == 0:
+        coords = self.Coords()
+        if not coords:
             return False
-        
-        # Inside if odd number
-        return int(crossing) % 2
+        x = pt.x
+        y = pt.y
+        inside = False
+        bx, by = coords[-1]
+        for ax, ay in coords:
+            if ((ay > y) != (by > y)) and x < bx + (y - by) * (ax - bx) / (ay - by):
+                inside = not inside
+            if min(ax, bx) - ON_EDGE <= x <= max(ax, bx) + ON_EDGE and min(ay, by) - ON_EDGE <= y <= max(ay, by) + ON_EDGE:
+                ex = ax - bx
+                ey = ay - by
+                if abs(ex * (y - by) - ey * (x - bx)) <= ON_EDGE * max(sqrt(ex*ex + ey*ey), 1.0):
+                    return True
+            bx, by = ax, ay
+        return inside
+    
+    def PointsInside(self, points):
+        '''! \brief PointInside for many points at once.
+             \param points A list of vect_XD or a (M,2) array.
+             \return A list of booleans.
+        '''
+        return PointsInPolygon(AsPoints(points), self.xy).tolist()
+
 
     
 
@@ -478,8 +782,9 @@ class base_polygon:
         '''! \brief Find the nearest point to all segments of a polygon.
         '''
         d = None
-        for i in range(len(self.pts)-1):
-            temp = DistancePointToSegment(P, self.pts[i], self.pts[i+1])
+        v = self.vertices()
+        for i in range(len(v)-1):
+            temp = DistancePointToSegment(P, v[i], v[i+1])
             if d == None or temp < d:
                 d = temp
         return d
@@ -502,62 +807,59 @@ class base_polygon:
         return out
     
     # Transformation
+    # The array is replaced, never changed in place: copies (see __mul__) share it.
     def Normalize(self):
         '''! \brief Bring centroid to coordinate origin
         '''
-        ct = self.Centroid()
-        for i in range(len(self.pts)):
-            self.pts[i] = self.pts[i] - ct
+        ct = self.CentroidXY()
+        self.Translate(vect_3D(-ct[0], -ct[1]))
             
     def Translate(self, offset):
-   
-        v = self.vertices()
-        for i in range(len(v)):
-            v[i] = v[i] + offset
+        # Same shape, the derived quantities move along
+        bbox, ct, area = self._bbox, self._centroid, self._area
+        self.xy = self.xy + (offset.x, offset.y)
+        self.Changed()
+        self._area = area
+        if bbox:
+            self._bbox = [bbox[0]+offset.x, bbox[1]+offset.y, bbox[2]+offset.x, bbox[3]+offset.y]
+        if ct is not None:
+            self._centroid = ct + (offset.x, offset.y)
             
     def Rotate(self, angle, center = None):
-        # By default scale to centroid
+        '''! \brief Rotate clockwise by angle (radians, as the bearings) around the center (centroid by default).
+        '''
         if center == None:
             center = self.Centroid()
         
-        v = self.vertices()
-        for i in range(len(v)):
-            diff = center.BearingTo(v[i])
-            diff[0] += angle
-            v[i] = center.ToBearing(diff)
+        c = array([center.x, center.y])
+        d = self.xy - c
+        ca = cos(angle)
+        sa = sin(angle)
+        area = self._area
+        self.xy = c + numpy.column_stack((d[:,0]*ca + d[:,1]*sa, d[:,1]*ca - d[:,0]*sa))
+        self.Changed()
+        self._area = area
             
     def Scale(self, factor, center = None):
         # By default scale to centroid
         if center == None:
             center = self.Centroid()
         
-        v = self.vertices()
-        for i in range(len(v)):
-            diff = (v[i] - center) * factor
-            v[i] = center + diff
-        
-            
+        c = array([center.x, center.y])
+        self.xy = c + (self.xy - c) * factor
+        self.Changed()
         
     def Extend(self, offset):
         # Make the polygon extend by offset for each vertice from the centroid
         # such that the bounding box is twice as large.
         box = self.BoundingBox()
-        # Original dimentions
-        dx = box[2] - box[0]
-        dy = box[3] - box[1]
-        # New corner
-        ncx = box[0] - offset
-        ncy = box[1] - offset
-        # New dimentions
-        ndx = dx + 2*offset
-        ndy = dy + 2*offset
-        
-        # reposition all vertices.
-        for i in range(len(self.pts)):
-            tempx = (self.pts[i].x - box[0])/dx
-            tempy = (self.pts[i].y - box[1])/dy
-            self.pts[i].x = ncx + (ndx*tempx)
-            self.pts[i].y = ncy + (ndy*tempy)
+        # Original corner and dimentions
+        low = array(box[:2])
+        size = array([box[2] - box[0], box[3] - box[1]])
+        
+        # reposition all vertices in the new box.
+        self.xy = (low - offset) + (size + 2*offset) * ((self.xy - low) / size)
+        self.Changed()
         
 
     
@@ -570,8 +872,8 @@ class base_polygon:
         ''' Write itself as a polygon in a XML document
         '''
         out = doc.NewNode('polygon')
-        for i in self.pts:
-            doc.AddField('point', '%f,%f'%(i.x, i.y), out)
+        for x, y in self.xy.tolist():
+            doc.AddField('point', '%f,%f'%(x, y), out)
         return out
         
         
@@ -776,15 +1078,16 @@ class triangle(base_polygon):
             bearing.append(self.PositiveAngle(self.centroid.BearingTo(pts[i])[0]))
 
         # index
-        self.pts = []
+        out = []
         while bearing:
             val = min(bearing)
             for i in range(len(bearing)):
                 if val == bearing[i]:
-                    self.pts.append(pts[i])
+                    out.append(pts[i])
                     pts.remove(pts[i])
                     bearing.remove(val)
                     break
+        self.pts = out
 
 
 
@@ -796,6 +1099,8 @@ class circle(base_polygon):
         base_polygon.__init__(self, [center])
         self.center = center
         self.radius = radius
+        # The virtual polygon, with the signature of the circle it was made for
+        self._ring = None
     def __nonzero__(self):
         return bool(self.radius)
     def Centroid(self):
@@ -806,6 +1111,11 @@ class circle(base_polygon):
     def PointInside(self, pt):
         return (pt-self.center).length() <= self.radius
     
+    def PointsInside(self, points):
+        d = AsPoints(points) - (self.center.x, self.center.y)
+        return ((d*d).sum(1) <= self.radius**2).tolist()
+
+    
     def Area(self):
         return pi*(self.radius**2)
     
@@ -813,12 +1123,19 @@ class circle(base_polygon):
         c = self.center
         r = self.radius
         return [c.x-r,c.y-r,c.x+r,c.y+r]
+    def Signature(self):
+        return (self.center.x, self.center.y, self.radius)
+
     def vertices(self):
-        out = []
-        a = 2*pi/circle.vertice_resolution
-        for i in range(circle.vertice_resolution):
-            out.append( self.center.ToBearing([i*a,self.radius]) )
-        return out
+        # Kept until the center or radius change
+        if self._ring == None or self._ring[0] != self.Signature():
+            out = []
+            a = 2*pi/circle.vertice_resolution
+            for i in range(circle.vertice_resolution):
+                out.append( self.center.ToBearing([i*a,self.radius]) )
+            self._ring = (self.Signature(), out)
+        return self._ring[1]
+
     
     def Rotate(self, angle, center = None):
         '''
@@ -877,12 +1194,10 @@ class morphable_polygon(base_polygon):
         # randomly insert point duplicates
         while len(self.start) < len(self.end):
             r = randint(0,len(self.start)-1)
-            self.start.pts.insert(r,self.start.pts[r] * 1.0)
+            self.start.pts = numpy.insert(self.start.xy, r, self.start.xy[r], 0)
         while len(self.end) < len(self.start):
             r = randint(0,len(self.end)-1)
-            self.end.pts.insert(r,self.end.pts[r] * 1.0)
-            
-        self.pts = range(len(self.end))
+            self.end.pts = numpy.insert(self.end.xy, r, self.end.xy[r], 0)
             
         # Set Delta to 0
         self.SetDelta(0.0)
@@ -926,8 +1241,8 @@ class morphable_polygon(base_polygon):
         
     def SetDelta(self, D):
         self.delta = D
-        for i in range(len(self.pts)):
-            self.pts[i] = (self.end.vertices()[i] * self.delta) + (self.start.vertices()[i] * (1-self.delta)) 
+        self.pts = (self.end.xy * self.delta) + (self.start.xy * (1-self.delta))
+
         
 # Test Units
 import unittest
@@ -964,6 +1279,23 @@ class GeometryTest(unittest.TestCase):
         a = base_polygon([v1,v2,v3])
         self.assert_(a.PointInside(vect_3D(0.0,0.0)))
         
+    def testbPolygonPointRayOnVertex(self):
+        # The ray from the point passes through a vertex, the answer is the same every time
+        a = base_polygon([vect_3D(0.0,0.0), vect_3D(2.0,1.0), vect_3D(0.0,2.0)])
+        pts = [vect_3D(1.0,1.0), vect_3D(-1.0,1.0), vect_3D(-1.0,0.0), vect_3D(1.0,0.5)]
+        self.assertEqual([[a.PointInside(p) for p in pts] for i in range(5)], [[True, False, False, True]] * 5)
+        
+    def testbPolygonPointsInside(self):
+        a = base_polygon([vect_3D(0,0),vect_3D(3,0),vect_3D(3,3),vect_3D(1.5,1),vect_3D(0,3)])
+        pts = [vect_3D(0.25*i, 0.25*j) for i in range(-1,14) for j in range(-1,14)]
+        self.assertEqual(a.PointsInside(pts), [a.PointInside(p) for p in pts])
+        
+    def testPointInPolygons(self):
+        polys = [base_polygon([vect_3D(0,0),vect_3D(1,0),vect_3D(0,1)]), circle(vect_3D(1,1), 0.5), base_polygon([]),
+                 base_polygon([vect_3D(0,0),vect_3D(1,0),vect_3D(1,1),vect_3D(0,1)])]
+        for p in [vect_3D(0.5,0.5), vect_3D(0.9,0.9), vect_3D(0.1,0.1), vect_3D(2,2)]:
+            self.assertEqual(PointInPolygons(p, polys), [i.PointInside(p) for i in polys])
+        
     def testbPolygonCentroid(self):
         v1 = vect_3D(0.0, 0.0)
         v2 = vect_3D(1.0, 0.0)
@@ -1121,6 +1453,30 @@ class GeometryTest(unittest.TestCase):
         B = base_polygon([vect_3D(1,0.1),vect_3D(0,1.0),vect_3D(1,1)])
         self.assertEqual(A.Overlaps(B),False)
 
+    def testOverlapConcave(self):
+        # B sits in the notch of A: the boxes overlap, the shapes don't
+        A = base_polygon([vect_3D(0,0),vect_3D(3,0),vect_3D(3,3),vect_3D(1.5,1),vect_3D(0,3)])
+        B = base_polygon([vect_3D(1.4,2),vect_3D(1.6,2),vect_3D(1.5,2.5)])
+        C = base_polygon([vect_3D(1.4,0.5),vect_3D(1.6,0.5),vect_3D(1.5,2.5)])
+        self.assertEqual([A.IsConvex(), B.IsConvex(), A.Overlaps(B), A.Overlaps(C), C.Overlaps(A)], [False, True, False, True, True])
+        
+    def testOverlapCircle(self):
+        # Inside, touching an edge, around, outside near a corner, and circles
+        P = base_polygon([vect_3D(0,0),vect_3D(1,0),vect_3D(1,1),vect_3D(0,1)])
+        shapes = [circle(vect_3D(0.5,0.5),0.1), circle(vect_3D(0.5,-0.5),0.5), circle(vect_3D(0.5,0.5),5.0), circle(vect_3D(1.5,1.5),0.7),
+                  circle(vect_3D(2.0,0.0),1.0), circle(vect_3D(4.1,0.0),1.0)]
+
+        self.assertEqual([P.Overlaps(c) for c in shapes], [True, True, True, False, True, False])
+        self.assertEqual([c.Overlaps(P) for c in shapes[:4]], [True, True, True, False])
+
+        self.assertEqual(shapes[4].Overlaps(shapes[5]), False)
+        
+    def testOverlapsAny(self):
+        shapes = [base_polygon([vect_3D(0.1*i,0),vect_3D(0.1*i+0.5,0.2),vect_3D(0.1*i,0.4)]) for i in range(20)] + \
+                 [circle(vect_3D(0.2*i,0.6),0.15) for i in range(10)] + [base_polygon([])]
+        for S in [circle(vect_3D(1.0,0.3),0.4), base_polygon([vect_3D(0.5,0.1),vect_3D(1.5,0.1),vect_3D(1.0,1.0)])]:
+            self.assertEqual(S.OverlapsAny(shapes), [Overlap(S, i) for i in shapes])
+
     def testVerticesPoly(self):
         v1 = vect_3D(-10.0, 0.0)
         v2 = vect_3D(1.0, -10.0)
@@ -1203,6 +1559,26 @@ class GeometryTest(unittest.TestCase):
         a = base_polygon([v0,v1,v2,v3])
         a.Translate(vect_3D(-0.5, -0.5))
         self.assertEqual(a.Centroid(),vect_3D())
+    def testPolyCachedQuantities(self):
+        a = base_polygon([vect_3D(0,1),vect_3D(1,1),vect_3D(1,0),vect_3D(0,0)])
+        a.BoundingBox(), a.Centroid(), a.Area(), a.vertices()
+        a.Translate(vect_3D(1.0, 2.0))
+        moved = [a.BoundingBox(), a.Centroid(), a.Area(), a.vertices()[0]]
+        b = base_polygon(a.vertices())
+        self.assertEqual(moved, [b.BoundingBox(), b.Centroid(), b.Area(), vect_3D(1,3)])
+        a.Scale(2.0)
+        self.assertEqual([a.BoundingBox(), a.Area()], [[0.5,1.5,2.5,3.5], 4.0])
+        
+    def testPolyCopyIndependent(self):
+        import pickle
+        a = base_polygon([vect_3D(0,1),vect_3D(1,1),vect_3D(1,0),vect_3D(0,0)])
+        a.vertices()
+        b = a * 2.0
+        c = pickle.loads(pickle.dumps(a, 2))
+        # The cached vertices aren't saved
+        self.assertEqual(c._vertices, None)
+        self.assertEqual([a.Area(), b.Area(), c.Area()], [1.0, 4.0, 1.0])
+        
     def testPolyRotatecentroid(self):
         v0 = vect_3D(0,1)
         v1 = vect_3D(1,1)
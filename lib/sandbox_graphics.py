@@ -234,9 +234,12 @@ class operational_area(operational_graphic):
         return self.shape.Centroid()
     def Overlaps(self, other):
         return self.shape.Overlaps(other)
+    def OverlapsAny(self, others):
+        return self.shape.OverlapsAny(others)
 
     def PointInside(self, P):
         return self.shape.PointInside(P)
+
     def ExternalCoordinates(self, flatland):
         ''' Convert all relevant point to UTM for serialization
         '''
@@ -25,18 +25,28 @@
 import os.path
 import os
 from pickle import loads, dumps, HIGHEST_PROTOCOL
-from math import pi, ceil
+from math import pi, ceil, floor
 from copy import deepcopy, copy
 from string import digits
 from time import time
+from hashlib import md5
+from heapq import heappush, heappop, heapify
+
+import sqlite3
 
 
 import Image
 import ImageDraw
 
+from numpy import asarray, bincount, dot, empty, load, ogrid, save, unique, zeros
+from numpy import float32, float64, uint8, uint32, memmap
+
+
 from vector import *
 from FlatLand import FlatLand
+from algo_Astar import Grid_Astar, Grid_HPA
 from sandbox_XML import sandboXML
+from sandbox_profiler import SharedProfiler
 
 # Variables
 Sf = {}
@@ -47,6 +57,9 @@ Sf['severely restricted'] = 1/10.0
 Sf['impassable'] = 1/100000.0
 Sf['water'] = 1/100000.0
 
+# Memory-mapped cost rasters by file and stamp, shared by the maps of a process (each map holds a file open)
+mapped_rasters = {}
+
 # function
 
 # classes
@@ -383,6 +396,11 @@ class sandbox_map:
     
     # Metadata
     self.data = {'climate':'temperate','width':100,'ref XY':vect_3D(),'ref coord':'00d00\'00" 00d00\'00"'}
+    # Path finding algorithm (astar or kink) and the size of the search grid's cells in km
+    self.data['pathfinding'] = 'astar'
+    self.data['path resolution'] = 0.2
+    # Side of the clusters of the hierarchical search in grid cells (0 for a flat search)
+    self.data['path cluster'] = 32
     self.frictions = {}
     # Catch missing data, create default structures
     self.CreateMap()
@@ -395,7 +413,7 @@ class sandbox_map:
       self.data['climate'] = 'temperate'
       
     # Path Cache
-    self.pathcache = PathCACHE(self.MGRS,os.path.join(self.path,'path_cache.dat'))
+    self.pathcache = PathCACHE(os.path.join(self.path,'path_cache.db'), stamp=self.PathStamp())
     self.pathcache.Load()
     
   def Name(self):
@@ -445,71 +463,19 @@ class sandbox_map:
   
   def SampleTerrain(self, poly):
     '''! \brief Read the terrain under the polygon.
+         \return a dictionary of terrain and their (normalized) proportion in the polygon.
     '''
-    # Bounding box
-    box = poly.BoundingBox()
-    minpoint = self.PixelCoord(vect_3D(box[0],box[1]))
-    maxpoint = self.PixelCoord(vect_3D(box[2],box[3]))
-    box = [minpoint[0], minpoint[1], maxpoint[0], maxpoint[1]]
+    return self._terrainfromcounts(self._polygonclasscounts(poly))
+  
+  def SampleTerrainMany(self, polys):
+    '''! \brief SampleTerrain for each polygon, returns a list of dictionaries.
     
-    # If this is a very small footprint (1px)
-    if minpoint == maxpoint:
-      data = [self.terrain.getpixel(minpoint)]
-    else:
-      # Polygon
-      mypoly = []
-      for i in poly.vertices():
-        pt = self.PixelCoord(i)
-        mypoly.append( (pt[0]-minpoint[0], pt[1]-minpoint[1] ) )
-  
-      # Subset of data
-      temp = self.terrain.crop(box).copy()
-      
-      # Mask (Negative of a mask)
-      msk = Image.new('L',temp.size,color = 256)
-      ImageDraw.Draw(msk).polygon(mypoly,fill=0,outline=0)
-      voidcolor = (13,13,13)
-      temp.paste(voidcolor,(0,0)+temp.size,msk)
-      
-      # Get the pixel data
-      data = list(temp.getdata())
-    
-    # Extract the data
-    out = {}
-    for i in sandbox_map.code_terrain.values():
-      out[tuple(i)] = 0
-    
-    for i in data:
-      try:
-        out[i] = out[i] + 1
-      except:
-        if i != voidcolor:
-          pass
-          #print i
-        pass # Mask pixels 
-    
-    # Summarise
-    tot = float(sum(out.values()))
-    if tot != 0:
-      for i in out:
-        out[i] = out[i]/tot 
-      
-    # Clean list
-    for i in out.keys():
-      if out[i] == 0.0:
-        del out[i]
-        
-    # Rebuild with string litterals
-    final = {}
-    for i in sandbox_map.code_terrain.keys():
-      if sandbox_map.code_terrain[i] in out.keys():
-        final[i] = out[sandbox_map.code_terrain[i]]
-        
-    if final == {}:
-      final['off map'] = 1.0
-      
-    # return normalized sample
-    return final
+         A convenience wrapper, each polygon reads its own window of the raster.
+    '''
+    out = []
+    for poly in polys:
+      out.append(self._terrainfromcounts(self._polygonclasscounts(poly)))
+    return out
   
   def SampleTerrain_(self, pt, radius):
     '''!
@@ -517,73 +483,171 @@ class sandbox_map:
        pt --> vect_5D
        radius --> in Km
     '''
-    # Bounding box
-    c = self.PixelCoord(pt)
-    r = max (1,int(radius * self.m))
-    box = [c[0]-r,c[1]-r,c[0]+r,c[1]+r]
-
-    # Subset of data
-    temp = self.terrain.crop(box).copy()
-    
-    # Mask (Negative of a mask)
-    msk = Image.new('L',temp.size,color = 256)
-    ImageDraw.Draw(msk).ellipse(temp.getbbox(),fill=0,outline=0)
-    voidcolor = (13,13,13)
-    temp.paste(voidcolor,(0,0)+temp.size,msk)
-    
-    # Get the pixel data
-    data = list(temp.getdata())
-    
-    # Extract the data
-    out = {}
-    for i in sandbox_map.code_terrain.values():
-      out[i] = 0
-    
-    for i in data:
-      try:
-        out[i] = out[i] + 1
-      except:
-        if i != voidcolor:
-          print i
-        pass # Mask pixels 
-    
-    # Summarise
-    tot = float(sum(out.values()))
-    if tot != 0:
-      for i in out:
-        out[i] = out[i]/tot 
-      
-    # Clean list
-    for i in out.keys():
-      if out[i] == 0.0:
-        del out[i]
-        
-    # Rebuild with string litterals
-    final = {}
-    for i in sandbox_map.code_terrain.keys():
-      if sandbox_map.code_terrain[i] in out.keys():
-        final[i] = out[sandbox_map.code_terrain[i]]
-        
-    if final == {}:
-      final['off map'] = 1.0
-      
-    # return normalized sample
-    return final
-    
+    return self._terrainfromcounts(self._circleclasscounts(pt, radius))
     
   def MeanFriction(self,poly, mode='LOS'):
     '''
        compute the mean friction in the polygon "poly"
     '''
-    # Terrain profile
-    terrain = self.SampleTerrain(poly)
-    
-    # Mean friction from terrain alone (no
-    out = 0.0
-    for i in terrain:
-      out = out + (self.frictions[mode][i] * terrain[i])
+    return self._meanfriction(self._polygonclasscounts(poly), self.FrictionVector(mode))
+  
+  def MeanFrictionMany(self, polys, mode='LOS'):
+    '''! \brief MeanFriction for each polygon, returns a list of mean frictions.
     
+         A convenience wrapper, only the friction vector is shared, each polygon reads its own
+         window of the raster.
+    '''
+    vec = self.FrictionVector(mode)
+    out = []
+    for poly in polys:
+      out.append(self._meanfriction(self._polygonclasscounts(poly), vec))
     return out
+  
+  def FrictionVector(self, mode):
+    '''! \brief The frictions of a mode as an array indexed by terrain class.
+         \param mode Either the name of a mode or a friction dictionary.
+    
+         Reverts to the base mode if mode isn't defined and to unrestricted for missing 
+         terrains (as in system_movement.GetFriction).
+    '''
+    if type(mode) == type({}):
+      frict = mode
+      mode = self.FrictionProfile(frict)
+    else:
+      frict = self.frictions.get(mode, self.frictions[''])
+    if not mode in self.friction_vectors:
+      default = frict.get('unrestricted', 1.0)
+      vec = zeros(len(self.terrain_classes), dtype=float64)
+      for i in range(len(self.terrain_classes)):
+        vec[i] = frict.get(self.terrain_classes[i], default)
+      self.friction_vectors[mode] = vec
+    return self.friction_vectors[mode]
+  
+  def FrictionProfile(self, frict):
+    '''! \brief A hashable key that is the same for all equal friction dictionaries.
+    '''
+    return tuple(sorted(frict.items()))
+  
+  def CostVector(self, frict):
+    '''! \brief Cost per km (1/friction) of each terrain class, as in _effectivepathlength.
+    
+         Kept per friction profile, as the cost rasters.
+    '''
+    key = frict
+    if type(frict) == type({}):
+      key = self.FrictionProfile(frict)
+    if not key in self.cost_vectors:
+      vec = self.FrictionVector(frict)
+      out = zeros(len(vec), dtype=float64)
+      out.fill(1000000.0)
+      out[vec != 0] = 1.0 / vec[vec != 0]
+      self.cost_vectors[key] = out
+    return self.cost_vectors[key]
+
+  def FrictionMode(self, frict):
+    '''! \brief The name of the map's mode for a friction dictionary, None if it isn't one of them.
+    '''
+    for mode in self.frictions:
+      if self.frictions[mode] is frict:
+        return mode
+    key = self.FrictionProfile(frict)
+    for mode in self.frictions:
+      if mode != 'sameas' and self.FrictionProfile(self.frictions[mode]) == key:
+        return mode
+    return None
+
+  def CostRaster(self, frict):
+    '''! \brief The raster of cost per km (1/friction) for a friction dictionary, indexed as [y,x].
+
+         Uses the memory-mapped raster of the mode if frict is one of the map's modes.
+    '''
+    mode = self.FrictionMode(frict)
+    if mode in self.cost_rasters:
+      return self.cost_rasters[mode]
+    key = self.FrictionProfile(frict)
+    if not key in self.cost_rasters:
+      self.cost_rasters[key] = self.CostVector(frict).astype(float32)[self.terrain_raster]
+    return self.cost_rasters[key]
+
+  def FrictionRasterFile(self, mode):
+    '''! \brief The path to the cost raster of a mode.
+    '''
+    return os.path.join(self.path, 'friction_%s.npy'%(self._modetag(mode)))
+
+  def _modetag(self, mode):
+    if mode == '':
+      mode = 'base'
+    return mode.replace(' ','_')
+
+  def FrictionRasterStamp(self):
+    '''! \brief Digest of the files from which the cost rasters are computed.
+    '''
+    out = md5()
+    for f in [os.path.join(self.path,'main.xml'), self.terrainfile]:
+      if not os.access(f, os.F_OK):
+        continue
+      fin = open(f,'rb')
+      out.update(fin.read())
+      fin.close()
+    return out.hexdigest()
+
+  def PrepareFrictionRasters(self, force = False):
+    '''! \brief Write one float32 cost raster per mode of locomotion into the map folder.
+
+         The rasters are only regenerated if main.xml or the terrain file changed since the last
+         time (or if force). Each file is written under a temporary name then renamed so that
+         other processes never map an incomplete raster.
+         \return True if the rasters are up to date.
+    '''
+    stampfile = os.path.join(self.path, 'friction.stamp')
+    stamp = self.friction_stamp = self.FrictionRasterStamp()
+    if not force and os.access(stampfile, os.F_OK):
+      fin = open(stampfile)
+      current = fin.read().strip()
+      fin.close()
+      if current == stamp:
+        for mode in self.frictions:
+          if mode != 'sameas' and not os.access(self.FrictionRasterFile(mode), os.F_OK):
+            break
+        else:
+          return True
+
+    try:
+      for mode in self.frictions:
+        if mode == 'sameas':
+          continue
+        fname = self.FrictionRasterFile(mode)
+        temp = '%s.%d.tmp'%(fname, os.getpid())
+        fout = open(temp, 'wb')
+        save(fout, self.CostVector(mode).astype(float32)[self.terrain_raster])
+        fout.close()
+        os.rename(temp, fname)
+
+      temp = '%s.%d.tmp'%(stampfile, os.getpid())
+      fout = open(temp, 'w')
+      fout.write(stamp + '\n')
+      fout.close()
+      os.rename(temp, stampfile)
+    except (IOError, OSError):
+      # Read-only map folder, the rasters will be computed in memory.
+      return False
+    return True
+
+  def LoadFrictionRasters(self):
+    '''! \brief Memory-map the cost rasters of all modes (pages are shared by processes on one host).
+    
+         A raster is mapped once per process, the maps with the same files and stamp share it.
+    '''
+    self.cost_rasters = {}
+    if not hasattr(self, 'terrain_raster') or not self.PrepareFrictionRasters():
+      return
+    for mode in self.frictions:
+      if mode != 'sameas':
+        key = (self.FrictionRasterFile(mode), self.friction_stamp)
+        if not key in mapped_rasters:
+          mapped_rasters[key] = load(key[0], mmap_mode='r')
+        self.cost_rasters[mode] = mapped_rasters[key]
+  
   def Initialize(self):
     '''! \brief Read in the XML definition and take appropriate action
     '''
@@ -605,6 +669,13 @@ class sandbox_map:
     # Load friction data
     self.frictions = {'':{}}
     self.ParseXMLfrictions( doc, doc.Get(doc.root, 'friction') )
+    self.friction_vectors = {}
+    self.cost_vectors = {}
+    self.cost_grids = {}
+    self.path_graphs = {}
+
+    # Memory-mapped cost rasters for each mode
+    self.LoadFrictionRasters()
 
     # Metadata and linear parameters
     self.ParseXMLData(doc, doc.root)
@@ -634,6 +705,11 @@ class sandbox_map:
     # ref XY
     self.data['ref XY'] = doc.SafeGet(node, 'ref_XY', self.data['ref XY'])
     
+    # Path finding
+    self.data['pathfinding'] = doc.SafeGet(node, 'pathfinding', self.data['pathfinding'])
+    self.data['path resolution'] = float(doc.SafeGet(node, 'path_resolution', self.data['path resolution']))
+    self.data['path cluster'] = int(doc.SafeGet(node, 'path_cluster', self.data['path cluster']))
+    
     # LatLon
     if doc.Get(node, 'LatLonQuad'):
       coord = doc.Get(doc.Get(node, 'LatLonQuad'), 'coordinates')
@@ -682,12 +758,50 @@ class sandbox_map:
         nm = doc.Get(i,'name')
         rgb = doc.Get(i,'color')
         self.code_terrain[nm] = rgb
+      
+      # Raster of terrain classes
+      self.DecodeTerrain()
+  
+  def DecodeTerrain(self):
+    '''! \brief Decode the terrain image once into a raster of terrain class indices.
+    
+         Class 0 is 'off map' and stands for any colour that isn't a terrain class. The raster is 
+         indexed as [y,x], pixels beyond the edges read as black, as did the cropping of the image.
+    '''
+    # Class table (index to name and name to index)
+    self.terrain_classes = ['off map'] + self.code_terrain.keys()
+    self.terrain_index = {}
+    colours = {}
+    for i in range(len(self.terrain_classes)):
+      nm = self.terrain_classes[i]
+      self.terrain_index[nm] = i
+      if i:
+        rgb = self.code_terrain[nm]
+        colours[(rgb[0] << 16) | (rgb[1] << 8) | rgb[2]] = i
+    
+    # Pack each pixel into a single integer, then translate the few distinct colours.
+    rgb = asarray(self.terrain.convert('RGB'), dtype=uint32)
+    packed = (rgb[:,:,0] << 16) | (rgb[:,:,1] << 8) | rgb[:,:,2]
+    values, inverse = unique(packed, return_inverse=True)
+    lut = zeros(len(values), dtype=uint8)
+    for i in range(len(values)):
+      lut[i] = colours.get(int(values[i]), 0)
+    self.terrain_raster = lut[inverse].reshape(packed.shape)
+    
+    # Class of the area beyond the edges of the map
+    self.terrain_offmap = colours.get(0, 0)
+    
+    # Frictions are indexed by class as well
+    self.friction_vectors = {}
+    self.cost_vectors = {}
+    self.cost_grids = {}
+    self.path_graphs = {}
+    self.cost_rasters = {}
     
 
     
   def FlushCache(self):
-    del self.pathcache
-    self.pathcache = PathCACHE(self.MGRS,os.path.join(self.path,'path_cache.dat'))
+    self.pathcache.ClearAll()
 
     
   def DrawCache(self):
@@ -720,6 +834,10 @@ class sandbox_map:
     doc.AddField('ref_coord', self.data['ref coord'],root)
     # ref XY
     doc.AddNode(doc.write_vector_5D('ref_XY',self.data['ref XY']), root)
+    # Path finding
+    doc.AddField('pathfinding', self.data['pathfinding'], root)
+    doc.AddField('path_resolution', self.data['path resolution'], root)
+    doc.AddField('path_cluster', self.data['path cluster'], root)
     
     # Terrain definition
     F = doc.NewNode('terrain')
@@ -779,6 +897,11 @@ class sandbox_map:
        The full routine and PathCACHING
        route must be a prepare list of vectors
     '''
+    return SharedProfiler().Call('FindPath', None, self.FindRoute, route, friction)
+  
+  def FindRoute(self, route, friction):
+    '''! \brief Join the waypoints of route with cached or solved segments.
+    '''
     wp = route
     out = []
     i = 0
@@ -787,18 +910,144 @@ class sandbox_map:
       temp = self.pathcache.Query(wp[i],wp[i+1], friction)
       if temp == None:
           t = time()
-          temp = self.KinkSegment(wp[i],wp[i+1], frict=friction)
-          temp = self.OptimizePath(temp, frict=friction)
-          dtime = time() - t
-          # Cache the solution if the pathfinding took more than 0.5s
-          if dtime > 0.5:
-              self.pathcache.Add(temp,friction,dtime)
+          temp = SharedProfiler().Call('SolveSegment', None, self.SolveSegment, wp[i], wp[i+1], friction)
+          # Cache the solution, weighted by the time it took
+          self.pathcache.Add(temp,friction,time() - t)
       if out:
           temp = temp[1:]
       out = out + temp
       i = i + 1
     return out
   
+  def SolveSegment(self, wp1, wp2, frict = Sf):
+    '''! \brief Find a path between two waypoints with the map's path finding algorithm.
+         \return a list of waypoints from wp1 to wp2
+    '''
+    if self.data['pathfinding'] == 'kink':
+      temp = self.KinkSegment(wp1, wp2, frict=frict)
+      return self.OptimizePath(temp, frict=frict)
+    
+    # Search on the grid, hierarchical if the map has clusters
+    search = self.GridSearch(frict)
+    if self.data['path cluster']:
+      cells, cost = self.PathGraph(frict).Solve(self.GridCell(wp1), self.GridCell(wp2))
+    else:
+      cells, cost = search.Solve(self.GridCell(wp1), self.GridCell(wp2))
+    cells = search.StringPull(cells)
+    
+    # Cell centers between the exact end points
+    out = [wp1]
+    for i in cells[1:-1]:
+      out.append(self.GridCenter(i))
+    out.append(wp2)
+    return out
+  
+  def GridSearch(self, frict):
+    '''! \brief The A* search engine on the cost grid for a friction dictionary.
+    '''
+    key = self.FrictionProfile(frict)
+    if not key in self.cost_grids:
+      self.cost_grids[key] = Grid_Astar(self.CostGrid(frict))
+    return self.cost_grids[key]
+  
+  def PathGraph(self, frict):
+    '''! \brief The abstract graph of the hierarchical search for a friction dictionary.
+    
+         Graphs of the map's modes are stored next to path_cache.db and rebuilt only if the
+         terrain, the frictions, the resolution or the cluster size changed.
+    '''
+    key = self.FrictionProfile(frict)
+    if key in self.path_graphs:
+      return self.path_graphs[key]
+    
+    search = self.GridSearch(frict)
+    mode = self.FrictionMode(frict)
+    if mode is None:
+      self.path_graphs[key] = Grid_HPA(search, self.data['path cluster'])
+      return self.path_graphs[key]
+    
+    # Load from file
+    fname = self.PathGraphFile(mode)
+    stamp = (self.FrictionRasterStamp(), key, self.GridStep(), self.data['path cluster'])
+    try:
+      fin = open(fname,'rb')
+      dat = loads(fin.read())
+      fin.close()
+      if dat[0] == stamp:
+        graph = dat[1]
+        graph.search = search
+        self.path_graphs[key] = graph
+        return graph
+    except:
+      pass
+    
+    # Build and save
+    graph = Grid_HPA(search, self.data['path cluster'])
+    self.path_graphs[key] = graph
+    try:
+      temp = '%s.%d.tmp'%(fname, os.getpid())
+      fout = open(temp,'wb')
+      fout.write(dumps([stamp, graph], HIGHEST_PROTOCOL))
+      fout.close()
+      os.rename(temp, fname)
+    except (IOError, OSError):
+      pass
+    return graph
+  
+  def PathStamp(self):
+    '''! \brief Version of the terrain, frictions and path finding parameters, for the stored paths.
+    '''
+    out = md5(self.FrictionRasterStamp())
+    out.update(repr((self.data['pathfinding'], self.data['path resolution'], self.data['path cluster'])))
+    return out.hexdigest()
+  
+  def PathGraphFile(self, mode):
+    '''! \brief The path to the abstract graph of a mode.
+    '''
+    return os.path.join(self.path, 'path_graph_%s.dat'%(self._modetag(mode)))
+  
+  def PreparePathGraphs(self):
+    '''! \brief Build the abstract graphs of all modes ahead of time.
+    '''
+    for mode in self.frictions:
+      if mode != 'sameas':
+        self.PathGraph(self.frictions[mode])
+  
+  def CostGrid(self, frict):
+    '''! \brief The mean cost per km of the pixels in each cell of the search grid.
+    '''
+    k = self.GridStep()
+    # Pad the raster to a whole number of cells
+    h, w = self.terrain_raster.shape
+    H = int(ceil(h / float(k)))
+    W = int(ceil(w / float(k)))
+    cls = self._rasterwindow(0, 0, W*k, H*k)
+    # Mean of the block
+    cost = self.CostVector(frict)[cls]
+    return cost.reshape(H, k, W, k).mean(axis=3).mean(axis=1)
+  
+  def GridStep(self):
+    '''! \brief Size of a grid cell in pixels.
+    '''
+    return max(1, int(round(self.data['path resolution'] * self.m)))
+  
+  def GridCell(self, coord):
+    '''! \brief The cell of the search grid under coord (clamped to the map).
+    '''
+    k = self.GridStep()
+    x, y = self.PixelCoord(coord)
+    h, w = self.terrain_raster.shape
+    x = min(max(x, 0), w - 1)
+    y = min(max(y, 0), h - 1)
+    return (x // k, y // k)
+  
+  def GridCenter(self, cell):
+    '''! \brief The center of a grid cell in km.
+    '''
+    k = self.GridStep()
+    c = self.KmCoord([(cell[0] + 0.5) * k, (cell[1] + 0.5) * k])
+    return vect_5D(c[0], c[1])
+  
   def PathLength(self, path):
     '''
        Returns the physical distance in km
@@ -833,35 +1082,53 @@ class sandbox_map:
        Private methods that accepts samples instread of high level wp in km coord.
     '''
     sample = (allsamples[1]-allsamples[0]).length()
-    frictions = []
-    for i in allsamples:
-      f = self.TerrainUnder(i)
-      if frict[f]:
-        frictions.append(sample * (1.0/frict[f]))
-      else:
-        frictions.append(sample * (1000000))
-        
-    return sum(frictions)
+    return sample * float(self.CostsUnder(allsamples, frict).sum())
+
+  def CostsUnder(self, coords, frict = Sf):
+    '''! \brief The cost per km (1/friction) under a list of coordinates in km.
+         \return a float array
+    '''
+    raster = self.CostRaster(frict)
+    px, py = self.PixelCoords(coords)
+    h, w = raster.shape
+    out = empty(len(px), dtype=float64)
+    out.fill(self.CostVector(frict)[self.terrain_offmap])
+    on = (px >= 0) & (px < w) & (py >= 0) & (py < h)
+    out[on] = raster[py[on], px[on]]
+    return out
   
   def TerrainUnder(self, coord):
     '''
        Process any coordinate and return a terrain.
        INPUT : 
            coord --> in km coord
-          return impasable if out of the map.
+          return the terrain of a black pixel if out of the map.
     '''
-    # Slow implementation
-    C = self.PixelCoord(coord)
-    if not self.PointOnMap(coord):
-      # Out of map
-      mypix = (0,0,0)
-    else:
-      mypix = self.terrain.getpixel(C)
-      if mypix == (0,255,0):
-        print 1
-    
-    # Translate into string
-    return self._terrainfrompixels(mypix)
+    x, y = self.PixelCoord(coord)
+    h, w = self.terrain_raster.shape
+    if x >= 0 and x < w and y >= 0 and y < h:
+      return self.terrain_classes[self.terrain_raster[y, x]]
+    return self.terrain_classes[self.terrain_offmap]
+  
+  def TerrainUnderMany(self, coords):
+    '''! \brief Batch version of TerrainUnder, returns a list of terrain.
+    '''
+    out = []
+    for i in self.TerrainClassesUnder(coords):
+      out.append(self.terrain_classes[i])
+    return out
+  
+  def TerrainClassesUnder(self, coords):
+    '''! \brief Terrain class indices under a list of coordinates (in km).
+         \return an uint8 array, use terrain_classes to translate.
+    '''
+    px, py = self.PixelCoords(coords)
+    h, w = self.terrain_raster.shape
+    out = empty(len(px), dtype=uint8)
+    out.fill(self.terrain_offmap)
+    on = (px >= 0) & (px < w) & (py >= 0) & (py < h)
+    out[on] = self.terrain_raster[py[on], px[on]]
+    return out
   
   #
   # Arbitrary conventions  
@@ -874,19 +1141,80 @@ class sandbox_map:
       if pix == t:
         return i
     return 'off map'
+  
+  def _rasterwindow(self, x0, y0, x1, y1):
+    '''! \brief The classes in the pixel box [x0,x1[ by [y0,y1[, padded with the off map class.
+    '''
+    h, w = self.terrain_raster.shape
+    out = empty((max(0, y1-y0), max(0, x1-x0)), dtype=uint8)
+    out.fill(self.terrain_offmap)
+    cx0, cy0 = max(x0, 0), max(y0, 0)
+    cx1, cy1 = min(x1, w), min(y1, h)
+    if cx0 < cx1 and cy0 < cy1:
+      out[cy0-y0:cy1-y0, cx0-x0:cx1-x0] = self.terrain_raster[cy0:cy1, cx0:cx1]
+    return out
+  
+  def _polygonclasscounts(self, poly):
+    '''! \brief Count the pixels of each terrain class under a polygon.
+    '''
+    # Bounding box
+    box = poly.BoundingBox()
+    minpoint = self.PixelCoord(vect_3D(box[0],box[1]))
+    maxpoint = self.PixelCoord(vect_3D(box[2],box[3]))
+    
+    # If this is a very small footprint (1px)
+    if minpoint == maxpoint:
+      data = self._rasterwindow(minpoint[0], minpoint[1], minpoint[0]+1, minpoint[1]+1).ravel()
+    else:
+      window = self._rasterwindow(minpoint[0], minpoint[1], maxpoint[0], maxpoint[1])
+      if window.size:
+        # Polygon mask
+        mypoly = []
+        for i in poly.vertices():
+          pt = self.PixelCoord(i)
+          mypoly.append( (pt[0]-minpoint[0], pt[1]-minpoint[1] ) )
+        msk = Image.new('L', (window.shape[1], window.shape[0]), color = 0)
+        ImageDraw.Draw(msk).polygon(mypoly, fill=1, outline=1)
+        data = window[asarray(msk) != 0]
+      else:
+        data = window.ravel()
+      
+    return bincount(data, minlength=len(self.terrain_classes))
+  
+  def _circleclasscounts(self, pt, radius):
+    '''! \brief Count the pixels of each terrain class in a circle.
+    '''
+    c = self.PixelCoord(pt)
+    r = max(1, int(radius * self.m))
+    window = self._rasterwindow(c[0]-r, c[1]-r, c[0]+r, c[1]+r)
+    
+    # Circular mask around the pixel centers
+    dy, dx = ogrid[-r:r, -r:r]
+    msk = (dx + 0.5)**2 + (dy + 0.5)**2 <= r**2
+    
+    return bincount(window[msk], minlength=len(self.terrain_classes))
+  
+  def _terrainfromcounts(self, counts):
+    '''! \brief Normalized terrain dictionary from class counts, off map pixels are ignored.
     '''
-    if pix[0]:
-      if pix[1]:
-        if pix[2]:
-          return 'unrestricted'
-        return 'restricted'
-      elif pix[2]:
-        return 'urban'
-      return 'severely restricted'
-    if pix[2]:
-      return 'water'
-    return 'impassable'
+    final = {}
+    tot = float(counts[1:].sum())
+    if tot:
+      for i in counts[1:].nonzero()[0] + 1:
+        final[self.terrain_classes[i]] = counts[i] / tot
+        
+    if final == {}:
+      final['off map'] = 1.0
+      
+    return final
+  
+  def _meanfriction(self, counts, vec):
+    '''! \brief Mean of the friction vector weighted by the class counts.
     '''
+    tot = counts[1:].sum()
+    if not tot:
+      return float(vec[0])
+    return float(dot(counts[1:], vec[1:])) / tot
 
   # PathFinding
   def OptimizePathSlide(self, path, frict = Sf):
@@ -1187,14 +1515,8 @@ class sandbox_map:
     samples = self.SamplePath([p1,p2])
 
     # Get all friction factors
-    fr = []
-    for i in samples:
-      tunder = self.TerrainUnder(i)
-      if frict[tunder]:
-        fr.append(1.0/frict[tunder])
-      else:
-        fr.append(1000000)
-      
+    fr = self.CostsUnder(samples, frict).tolist()
+
     # Too short
     if len(samples) == 2:
       return samples, fr, None # Will be ignored anyway
@@ -1259,6 +1581,18 @@ class sandbox_map:
     '''
     return ( int((coord.x-self.B[0])*self.m) , int((coord.y-self.B[1])*self.m) )
   
+  def PixelCoords(self, coords):
+    '''
+       Convert a list of coordinates in km into two arrays of pixels (x and y)
+    '''
+    xy = zeros((len(coords), 2), dtype=float64)
+    for i in range(len(coords)):
+      xy[i,0] = coords[i].x
+      xy[i,1] = coords[i].y
+    px = ((xy[:,0] - self.B[0]) * self.m).astype(int)
+    py = ((xy[:,1] - self.B[1]) * self.m).astype(int)
+    return px, py
+  
   def KmCoord(self, coord):
     '''
        Pixels to Km
@@ -1379,17 +1713,78 @@ class sandbox_map:
     return mysurf
     
 class PathCACHE:
-  def __init__(self, translator, fname=''):
-    # The MGRS-base mapping structure key = MGRS
-    self._key = {} # MGRS as key
-    # The data
-    self._paths = {} # ID as Keys
+  '''! \brief Solved path segments keyed by friction profile and end points.
+  
+       End points are quantized to a square of side quantum (km) and a segment is found in both
+       directions. When over budget (entries or waypoints), the entries with the least solve time
+       per waypoint that haven't been used lately are evicted first (GreedyDual-Size).
+       
+       Segments are also written one by one to a sqlite file shared by all processes using the map,
+       and read from it on a miss. Rows of another version stamp (terrain, frictions) are deleted
+       when the file is opened.
+  '''
+  def __init__(self, fname='', max_entries = 1000, max_points = 100000, quantum = 0.1, stamp = ''):
+    # The data, key : [path, solve time, priority]
+    self._paths = {}
+    # Priority queue of (priority, key), stale items are skipped
+    self._queue = []
     # The file location
     self._archive = fname
-    # Translator
-    self.translator = translator
-    # ID cursor
-    self.cursor = 0
+    self.stamp = stamp
+    # Connection to the store and the process that opened it
+    self._db = None
+    self._pid = None
+    
+    # Budget
+    self.max_entries = max_entries
+    self.max_points = max_points
+    self.quantum = quantum
+    self.points = 0
+    # Aging of priorities, the priority of the last eviction
+    self.inflation = 0.0
+    
+    # Friction dictionaries already hashed, id(dict) : (dict, ID)
+    self._profiles = {}
+    
+    # Counters
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.reads = 0
+    self.writes = 0
+  
+  def __getstate__(self):
+    out = self.__dict__.copy()
+    out['_db'] = None
+    out['_profiles'] = {}
+    return out
+    
+  def ProfileID(self, friction):
+    '''! \brief A canonical ID for a friction dictionary (the same for equal dictionaries).
+    
+         The ID is kept for each dictionary object. Call FrictionsChanged() if one is modified in place.
+    '''
+    temp = self._profiles.get(id(friction))
+    if temp and temp[0] is friction:
+      return temp[1]
+    out = md5(repr(tuple(sorted(friction.items())))).hexdigest()[:16]
+    self._profiles[id(friction)] = (friction, out)
+    return out
+  
+  def FrictionsChanged(self):
+    '''! \brief Forget the IDs of the friction dictionaries.
+    '''
+    self._profiles = {}
+  
+  def Key(self, begin, end, friction):
+    '''! \brief The key of a segment and whether it is stored in the reverse direction.
+    '''
+    q = self.quantum
+    b = (int(floor(begin.x / q)), int(floor(begin.y / q)))
+    e = (int(floor(end.x / q)), int(floor(end.y / q)))
+    if e < b:
+      return (self.ProfileID(friction), e, b), True
+    return (self.ProfileID(friction), b, e), False
     
   def Add(self, path, friction, dtime):
     '''
@@ -1397,147 +1792,501 @@ class PathCACHE:
        This path is conditional to a friction dictionary.
        The time required to solve this path is also stored to be used later for pruning.
     '''
-    # Begin
-    begin = self.translator.AsString(path[0],2)
-    end = self.translator.AsString(path[-1],2)
-    
-    # Make sure it doesn't exist
-    temp = self.Query(path[0], path[-1], friction)
+    key, reverse = self.Key(path[0], path[-1], friction)
+    if key in self._paths:
+      return False
     
-    if temp == None:
-      # Add the path
-      self._paths[self.cursor] = [path,friction,1,dtime]
-      
-      # Default
-      if not self._key.has_key(begin):
-        self._key[begin] = []
-      if not self._key.has_key(end):
-        self._key[end] = []
-        
-      # Add the keys
-      self._key[begin].append(self.cursor)
-      self._key[end].append(self.cursor)
-      
-      # update cursor
-      self.cursor = self.cursor + 1
-      return True
-    return False
+    path = list(path)
+    if reverse:
+      path.reverse()
+    self.Insert(key, path, dtime)
+    self.Write(key, path, dtime)
+    return True
+  
+  def Insert(self, key, path, dtime):
+    '''! \brief Keep a path in memory.
+    '''
+    self._paths[key] = [path, dtime, 0.0]
+    self.points = self.points + len(path)
+    self.Touch(key)
+    self.Prune()
   
   def Query(self, begin, end, friction):
     '''
        Return a Path or None
     '''
-    # Begin
-    try:
-      lbegin = self._key[self.translator.AsString(begin,2)]
-    except:
-      return None
-    # End 
-    try:
-      lend = self._key[self.translator.AsString(end,2)]
-    except:
+    key, reverse = self.Key(begin, end, friction)
+    if key in self._paths:
+      self.Touch(key)
+    elif not self.Read(key):
+      self.misses = self.misses + 1
       return None
+    self.hits = self.hits + 1
     
-    # Find a mathing pair
-    soln = None
-    for b in lbegin:
-      for e in lend:
-        if b == e:
-          if self._paths[b][1] == friction:
-            mypath = self._paths[b][0]
-            self._paths[b][2] = self._paths[b][2] + 1
-            # Determine the direction
-            pbegin = self.translator.AsString(mypath[0],2)
-            if pbegin == self.translator.AsString(begin,2):
-              return mypath
-            else:
-              mypath.reverse()
-              return mypath
-    return None
+    # A new list, between the exact end points
+    mypath = self._paths[key][0]
+    if reverse:
+      mypath = mypath[::-1]
+    return [begin] + mypath[1:-1] + [end]
   
-  def Prune(self, N = 1000):
+  def Touch(self, key):
+    '''! \brief Raise the priority of an entry.
+    '''
+    entry = self._paths[key]
+    entry[2] = self.inflation + max(entry[1], 1E-6) / len(entry[0])
+    heappush(self._queue, (entry[2], key))
+    # Drop the stale items once they outnumber the entries
+    if len(self._queue) > 2 * len(self._paths) + 16:
+      self._queue = [(entry[2], k) for k, entry in self._paths.items()]
+      heapify(self._queue)
+  
+  def Prune(self, N = None):
     ''' 
-       Delete such that there is only N path.
+       Evict until there is at most N paths (max_entries by default) and max_points waypoints.
+    '''
+    if N == None:
+      N = self.max_entries
+    while self._queue and (len(self._paths) > N or self.points > self.max_points):
+      priority, key = heappop(self._queue)
+      if key in self._paths and self._paths[key][2] == priority:
+        self.inflation = priority
+        self.Remove(key)
+        self.evictions = self.evictions + 1
+      
+  def Stats(self):
+    '''! \brief Counters of the cache.
     '''
-    # Don't bother for less than N
-    if len(self._paths) < N:
-      return False
-    
-    # List all saved time values
-    T = []
-    for f in self._paths.keys():
-      i  = self._paths[f]
-      T.append(i[2]*i[3])
-      # Decay the benefit of existing path to get a chance of getting rid of long old paths
-      i[2] = i[2] * 0.8
-    T.sort()
-    
-    cutoff = T[999]
-    
-    # Remove all path ID which are less than the cutoff (may delete less than needed, oh well...)
-    to_delete = []
-    for i in self._paths.keys():
-      t = self._paths[i]
-      if t[2]*t[3] < cutoff:
-        to_delete.append(i)
-        
-    # remove all relevant path
-    for i in to_delete:
-      self.Remove(i)
+    return {'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions, 'entries':len(self._paths), 'points':self.points,
+            'reads':self.reads, 'writes':self.writes}
       
   def ClearAll(self):
+    '''! \brief Forget all paths, in memory and in the store.
+    '''
     for i in self._paths.keys():
       self.Remove(i)
+    self._queue = []
+    self.Execute('DELETE FROM paths')
       
   def Remove(self, ID):
-    beg = self.translator.AsString(self._paths[ID][0][0],2)
-    end = self.translator.AsString(self._paths[ID][0][-1],2)
-    
-    # remove map in _key
-    self._key[beg].remove(ID)
-    self._key[end].remove(ID)
-    
-    if len(self._key[beg]) == 0:
-      del self._key[beg]
-    if len(self._key[end]) == 0:
-      del self._key[end]
-    
+    self.points = self.points - len(self._paths[ID][0])
     del self._paths[ID]
       
-      
   def Save(self):
     '''
-       Save.
+       Save, the store is written as paths are added, only prune the memory.
     '''
-    # Clean up just in case
     self.Prune()
-    # Save
-    fh = open(self._archive,'wb')
-    fh.write(dumps([self._key,self._paths,self.cursor],HIGHEST_PROTOCOL))
-    fh.close()
   
   def Load(self):
+    '''! \brief Open the store and delete the paths of other versions of the map.
+    '''
+    self.Execute('CREATE TABLE IF NOT EXISTS paths (profile TEXT, b0 INTEGER, b1 INTEGER, e0 INTEGER, e1 INTEGER, '
+                 'stamp TEXT, dtime REAL, path BLOB, PRIMARY KEY (profile, b0, b1, e0, e1))')
+    self.Execute('DELETE FROM paths WHERE stamp != ?', (self.stamp,))
+  
+  # Store
+  def Connection(self):
+    '''! \brief The connection to the store, opened once per process.
+    '''
+    if self._db == None or self._pid != os.getpid():
+      self._db = sqlite3.connect(self._archive, timeout = 30.0, isolation_level = None)
+      self._db.execute('PRAGMA journal_mode=WAL')
+      self._db.execute('PRAGMA synchronous=NORMAL')
+      self._pid = os.getpid()
+    return self._db
+  
+  def Execute(self, sql, args = ()):
+    '''! \brief Run a statement on the store.
+         \return the rows, None if the store can't be used (no file name, read-only folder, etc).
+    '''
+    if not self._archive:
+      return None
     try:
-      fh = open(self._archive,'rb')
-      dat = loads(fh.read())
-      self._key = dat[0]
-      self._paths = dat[1]
-      self.cursor = dat[2]
-    except:
-      self.Save()
-      #fh = open(self._archive,'w')
-      #fh.close()
+      return self.Connection().execute(sql, args).fetchall()
+    except sqlite3.Error:
+      return None
   
+  def Write(self, key, path, dtime):
+    '''! \brief Add a path to the store.
+    '''
+    data = dumps([(i.x, i.y, i.z) for i in path], HIGHEST_PROTOCOL)
+    if self.Execute('INSERT OR IGNORE INTO paths VALUES (?,?,?,?,?,?,?,?)', 
+                    (key[0], key[1][0], key[1][1], key[2][0], key[2][1], self.stamp, dtime, sqlite3.Binary(data))) != None:
+      self.writes = self.writes + 1
+  
+  def Read(self, key):
+    '''! \brief Load a path from the store into memory.
+         \return True if it was found.
+    '''
+    rows = self.Execute('SELECT path, dtime FROM paths WHERE profile=? AND b0=? AND b1=? AND e0=? AND e1=? AND stamp=?',
+                        (key[0], key[1][0], key[1][1], key[2][0], key[2][1], self.stamp))
+    if not rows:
+      return False
+    self.reads = self.reads + 1
+    path = [vect_5D(x, y, z) for x, y, z in loads(str(rows[0][0]))]
+    self.Insert(key, path, rows[0][1])
+    return True
     
 
+import unittest
+import shutil
+import tempfile
+
+TEST_MAP = '''<?xml version="1.0" ?>
+<map>
+	<name>%(name)s</name>
+	<filename>terrain.png</filename>
+	<width>6</width>
+	<path_cluster>%(cluster)d</path_cluster>
+	<terrain filename="terrain.png">
+		<class name="restricted"><color type="RGB">255,255,0</color></class>
+		<class name="water"><color type="RGB">0,0,255</color></class>
+		<class name="unrestricted"><color type="RGB">255,255,255</color></class>
+		<class name="impassable"><color type="RGB">0,0,0</color></class>
+	</terrain>
+	<friction>
+		<mode name="base">
+			<terrain name="restricted">0.5</terrain>
+			<terrain name="water">%(water)s</terrain>
+			<terrain name="unrestricted">1.0</terrain>
+			<terrain name="impassable">0.0</terrain>
+		</mode>
+		<mode name="leg">
+			<terrain name="water">0.05</terrain>
+		</mode>
+	</friction>
+</map>
+'''
+
+def WriteTestMap(name, cluster = 0, water = 0.1):
+  '''! \brief A map of 60 by 40 pixels at 10 pixels per km, in the maps folder.
+  
+       Open ground, a river (x from 2.8 to 3.2 km) with a ford along the top edge, a black corner (5 to 6
+       km by 3 to 4 km) and a pixel of an unknown colour at (5,5).
+  '''
+  folder = os.path.join(os.environ['OPCONhome'], 'maps', name)
+  if not os.path.exists(folder):
+    os.mkdir(folder)
+  img = Image.new('RGB', (60, 40), (255,255,255))
+  for x in range(60):
+    for y in range(40):
+      if 28 <= x < 32 and y >= 4:
+        img.putpixel((x,y), (0,0,255))
+      elif x >= 50 and y >= 30:
+        img.putpixel((x,y), (0,0,0))
+  img.putpixel((5,5), (1,2,3))
+  img.save(os.path.join(folder, 'terrain.png'))
+  fout = open(os.path.join(folder, 'main.xml'), 'w')
+  fout.write(TEST_MAP%{'name':name, 'cluster':cluster, 'water':water})
+  fout.close()
+  return folder
+
+class MapTestCase(unittest.TestCase):
+  '''! \brief Tests on the map written by WriteTestMap, removed afterward.
+  '''
+  cluster = 0
+  def setUp(self):
+    self.name = 'test_map_%d'%(os.getpid())
+    self.folder = WriteTestMap(self.name, self.cluster)
+    self.map = sandbox_map(self.name)
+    
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+class TerrainTest(MapTestCase):
+  def testDecodeTerrain(self):
+    m = self.map
+    names = [m.terrain_classes[m.terrain_raster[y, x]] for x, y in [(0,0), (30,20), (30,1), (55,35), (5,5)]]
+    self.assertEqual(names, ['unrestricted', 'water', 'unrestricted', 'impassable', 'off map'])
+    self.assertEqual(m.terrain_classes[0], 'off map')
+    
+  def testSameAsPixels(self):
+    # Every pixel has the class of its colour
+    m = self.map
+    img = m.terrain.convert('RGB')
+    for x in range(0, 60, 3):
+      for y in range(0, 40, 3):
+        self.assertEqual(m.terrain_classes[m.terrain_raster[y, x]], m._terrainfrompixels(img.getpixel((x,y))))
+    
+  def testTerrainUnder(self):
+    m = self.map
+    coords = [vect_5D(1.0, 0.5), vect_5D(3.0, 2.0), vect_5D(-1.0, 1.0), vect_5D(5.5, 3.5), vect_5D(7.0, 1.0)]
+    names = ['unrestricted', 'water', 'impassable', 'impassable', 'impassable']
+    self.assertEqual([m.TerrainUnder(i) for i in coords], names)
+    self.assertEqual(m.TerrainUnderMany(coords), names)
+    
+  def Dense(self, poly, step = 0.05):
+    # TerrainUnder on a fine grid of points inside the polygon, off map pixels left out
+    box = poly.BoundingBox()
+    nx, ny = int((box[2] - box[0]) / step), int((box[3] - box[1]) / step)
+    pts = [vect_5D(box[0] + (i + 0.5) * step, box[1] + (j + 0.5) * step) for i in range(nx) for j in range(ny)]
+    return [i for i in [self.map.TerrainUnder(p) for p in pts if poly.PointInside(p)] if i != 'off map']
+    
+  def Proportions(self, names):
+    return dict([(i, names.count(i) / float(len(names))) for i in set(names)])
+    
+  def Polygons(self):
+    from sandbox_geometry import base_polygon
+    # Across the river and its ford, around the unknown pixel, over the black corner
+    return [base_polygon([vect_5D(2.0, 0.2), vect_5D(3.6, 0.2), vect_5D(3.6, 2.5), vect_5D(2.0, 2.5)]),
+            base_polygon([vect_5D(0.2, 0.2), vect_5D(1.0, 0.3), vect_5D(0.6, 1.0)]),
+            base_polygon([vect_5D(4.5, 2.5), vect_5D(5.8, 3.8), vect_5D(3.0, 3.8)])]
+    
+  def assertSameTerrain(self, sample, dense):
+    self.assertEqual(sorted(sample.keys()), sorted(dense.keys()))
+    for k in dense:
+      self.assertAlmostEqual(sample[k], dense[k], delta=0.05)
+    
+  def testSampleTerrainDense(self):
+    for poly in self.Polygons():
+      self.assertSameTerrain(self.map.SampleTerrain(poly), self.Proportions(self.Dense(poly)))
+    
+  def testSampleTerrainCircleDense(self):
+    from sandbox_geometry import circle
+    for pt, radius in [(vect_5D(3.0, 2.0), 0.6), (vect_5D(5.0, 3.0), 0.5), (vect_5D(1.0, 1.0), 0.3)]:
+      self.assertSameTerrain(self.map.SampleTerrain_(pt, radius), self.Proportions(self.Dense(circle(pt, radius))))
+    
+  def testMeanFrictionDense(self):
+    m = self.map
+    vec = m.FrictionVector('base')
+    for poly in self.Polygons():
+      dense = self.Dense(poly)
+      self.assertAlmostEqual(m.MeanFriction(poly, 'base'), sum([vec[m.terrain_classes.index(i)] for i in dense]) / len(dense), delta=0.05)
+    
+  def testManyAsSingle(self):
+    polys = self.Polygons()
+    self.assertEqual(self.map.SampleTerrainMany(polys), [self.map.SampleTerrain(i) for i in polys])
+    self.assertEqual(self.map.MeanFrictionMany(polys, 'base'), [self.map.MeanFriction(i, 'base') for i in polys])
+    
+class PathFindingTest(MapTestCase):
+  def testFord(self):
+    # Across the river, the ford (y < 0.4) is cheaper than wading
+    a, b = vect_5D(1.0, 2.0), vect_5D(5.0, 2.0)
+    path = self.map.SolveSegment(a, b, self.map.frictions[''])
+    self.assertEqual([path[0], path[-1]], [a, b])
+    self.assertTrue(min([i.y for i in path]) < 0.4)
+    self.assertTrue(self.map.PathLength(path) > 4.5)
+    
+  def testStraight(self):
+    # Open ground pulls to a single leg
+    a, b = vect_5D(0.5, 3.5), vect_5D(2.5, 1.0)
+    self.assertEqual(self.map.SolveSegment(a, b, self.map.frictions['']), [a, b])
+
+class PathGraphTest(PathFindingTest):
+  # Clusters of 4 by 4 cells, the ford is found through the abstract graph
+  cluster = 4
+  def testGraphFile(self):
+    m = self.map
+    graph = m.PathGraph(m.frictions[''])
+    fname = m.PathGraphFile('')
+    inode = os.stat(fname).st_ino
+    # A new instance loads the graph rather than rebuilding it
+    m = sandbox_map(self.name)
+    other = m.PathGraph(m.frictions[''])
+    self.assertEqual([os.stat(fname).st_ino, other.edges, other.search is m.GridSearch(m.frictions[''])], [inode, graph.edges, True])
+    # Not saved for frictions other than the modes
+    m.PathGraph({'water':0.5})
+    self.assertEqual(sorted([i for i in os.listdir(self.folder) if i.startswith('path_graph')]), ['path_graph_base.dat'])
+
+class CostRasterTest(MapTestCase):
+  def testModeRasters(self):
+    # Memory-mapped from the map folder, one per mode
+    m = self.map
+    for mode, water in [('', 10.0), ('leg', 20.0)]:
+      r = m.CostRaster(m.frictions[mode])
+      self.assertTrue(isinstance(r, memmap))
+      self.assertEqual(r.shape, (40, 60))
+      self.assertAlmostEqual(r[20, 30], water, 4)
+      self.assertEqual([r[0, 0], r[35, 55]], [1.0, 1000000.0])
+    # Equal dictionaries share the raster of the mode
+    self.assertTrue(m.CostRaster(dict(m.frictions['leg'])) is m.CostRaster(m.frictions['leg']))
+    # And so do the maps of the process
+    self.assertTrue(sandbox_map(self.name).CostRaster(m.frictions['leg']) is m.CostRaster(m.frictions['leg']))
+    
+  def testCustomFriction(self):
+    # Not a mode of the map, computed in memory once
+    f = {'water':0.5, 'unrestricted':1.0}
+    r = self.map.CostRaster(f)
+    self.assertFalse(isinstance(r, memmap))
+    self.assertAlmostEqual(r[20, 30], 2.0, 4)
+    self.assertTrue(self.map.CostRaster(dict(f)) is r)
+    # And so is the cost vector
+    self.assertTrue(self.map.CostVector(dict(f)) is self.map.CostVector(f))
+    
+  def Stamp(self):
+    fin = open(os.path.join(self.folder, 'friction.stamp'))
+    out = fin.read()
+    fin.close()
+    return out
+    
+  def testStamp(self):
+    fname = self.map.FrictionRasterFile('')
+    inode, stamp = os.stat(fname).st_ino, self.Stamp()
+    # Unchanged map, the rasters are reused
+    m = sandbox_map(self.name)
+    self.assertEqual([os.stat(fname).st_ino, self.Stamp()], [inode, stamp])
+    # New frictions, the rasters are written again
+    WriteTestMap(self.name, water = 0.25)
+    m = sandbox_map(self.name)
+    self.assertNotEqual([os.stat(fname).st_ino, self.Stamp()], [inode, stamp])
+    self.assertAlmostEqual(m.CostRaster(m.frictions[''])[20, 30], 4.0, 4)
+    self.assertAlmostEqual(load(fname)[20, 30], 4.0, 4)
+    
+class PathCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.cache = PathCACHE()
+    self.friction = {'unrestricted':1.0, 'restricted':0.5}
+    self.path = [vect_5D(0.0, 0.0), vect_5D(1.0, 1.0), vect_5D(2.0, 0.5)]
+    
+  def testHeapCompacted(self):
+    self.cache.Add(self.path, self.friction, 0.1)
+    for i in range(1000):
+      self.cache.Query(self.path[0], self.path[-1], self.friction)
+    self.assertEqual([self.cache.hits, len(self.cache._queue) <= 18], [1000, True])
+    
+  def testProfileIDMemo(self):
+    class counted(dict):
+      calls = 0
+      def items(self):
+        counted.calls += 1
+        return dict.items(self)
+    f = counted(self.friction)
+    ID = self.cache.ProfileID(f)
+    for i in range(10):
+      self.cache.ProfileID(f)
+    self.assertEqual([counted.calls, self.cache.ProfileID(dict(self.friction))], [1, ID])
+    # Modified in place
+    f['restricted'] = 0.6
+    self.cache.FrictionsChanged()
+    self.assertNotEqual(self.cache.ProfileID(f), ID)
+    
+  def testReverse(self):
+    # One entry for both directions, the end points are the queried ones
+    self.assertEqual([self.cache.Add(self.path, self.friction, 0.1), self.cache.Add(self.path[::-1], self.friction, 0.1)], [True, False])
+    self.assertEqual(self.cache.Query(self.path[-1], self.path[0], self.friction), self.path[::-1])
+    begin, end = vect_5D(2.05, 0.55), vect_5D(0.01, 0.09)
+    self.assertEqual(self.cache.Query(begin, end, self.friction), [begin, self.path[1], end])
+    
+  def testQuantum(self):
+    self.cache.Add(self.path, self.friction, 0.1)
+    self.assertNotEqual(self.cache.Query(vect_5D(0.09, 0.09), vect_5D(2.0, 0.5), self.friction), None)
+    for begin in [vect_5D(0.1, 0.0), vect_5D(-0.01, 0.0)]:
+      self.assertEqual(self.cache.Query(begin, vect_5D(2.0, 0.5), self.friction), None)
+    self.assertEqual(self.cache.Query(self.path[0], self.path[-1], {'unrestricted':1.0}), None)
+    self.assertEqual([self.cache.hits, self.cache.misses], [1, 3])
+    
+  def Path(self, x, n):
+    return [vect_5D(x, float(i)) for i in range(n)]
+    
+  def testEviction(self):
+    # Least solve time per waypoint first (GreedyDual-Size)
+    cache = PathCACHE(max_entries = 3)
+    cache.Add(self.Path(0.0, 2), self.friction, 0.2)
+    cache.Add(self.Path(1.0, 4), self.friction, 0.2)
+    cache.Add(self.Path(2.0, 2), self.friction, 0.3)
+    cache.Add(self.Path(3.0, 2), self.friction, 0.4)
+    self.assertEqual(cache.Query(vect_5D(1.0, 0.0), vect_5D(1.0, 3.0), self.friction), None)
+    self.assertEqual([cache.evictions, cache.inflation, cache.points], [1, 0.05, 6])
+    # Aging, the entry of x = 3.0 was the most costly to solve but is the oldest
+    cache.Add(self.Path(4.0, 2), self.friction, 0.4)
+    cache.Add(self.Path(5.0, 2), self.friction, 0.22)
+    cache.Add(self.Path(6.0, 2), self.friction, 0.3)
+    left = [x for x in range(7) if cache.Query(vect_5D(x, 0.0), vect_5D(x, 1.0), self.friction)]
+    self.assertEqual([left, cache.evictions], [[4, 5, 6], 4])
+    self.assertAlmostEqual(cache.inflation, 0.2)
+
+    
+  def testMaxPoints(self):
+    cache = PathCACHE(max_points = 10)
+    for i in range(3):
+      cache.Add(self.Path(float(i), 4), self.friction, 0.1 + i)
+    self.assertEqual([cache.points, cache.evictions, cache.Query(vect_5D(0.0, 0.0), vect_5D(0.0, 3.0), self.friction)], [8, 1, None])
+
+class PathStoreTest(PathCacheTest):
+  # The same tests with a store, and the store on its own
+  def setUp(self):
+    PathCacheTest.setUp(self)
+    self.folder = tempfile.mkdtemp()
+    self.fname = os.path.join(self.folder, 'path_cache.db')
+    self.cache = self.Cache()
+    
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+    
+  def Cache(self, stamp = 'v1'):
+    out = PathCACHE(self.fname, stamp = stamp)
+    out.Load()
+    return out
+    
+  def Rows(self):
+    return self.cache.Execute('SELECT COUNT(*) FROM paths')[0][0]
+    
+  def testReadThrough(self):
+    self.cache.Add(self.path, self.friction, 0.1)
+    other = self.Cache()
+    for i in range(2):
+      self.assertEqual(other.Query(self.path[-1], self.path[0], self.friction), self.path[::-1])
+    self.assertEqual([self.cache.writes, other.reads, other.hits, other.misses, self.Rows()], [1, 1, 2, 0, 1])
+    # Evicted from memory, read again
+    other.Prune(0)
+    self.assertNotEqual(other.Query(self.path[0], self.path[-1], self.friction), None)
+    self.assertEqual(other.reads, 2)
+    
+  def testStamp(self):
+    # Another version of the map deletes the paths of this one
+    self.cache.Add(self.path, self.friction, 0.1)
+    other = self.Cache('v2')
+    self.assertEqual([other.Query(self.path[0], self.path[-1], self.friction), self.Rows()], [None, 0])
+    self.assertEqual(self.Cache().Query(self.path[0], self.path[-1], self.friction), None)
+    
+  def testClearAll(self):
+    self.cache.Add(self.path, self.friction, 0.1)
+    self.cache.ClearAll()
+    self.assertEqual([self.cache.Stats()['entries'], self.cache.points, self.Rows()], [0, 0, 0])
+    self.assertEqual(self.Cache().Query(self.path[0], self.path[-1], self.friction), None)
+    
+  def testNoStore(self):
+    # Unusable file names only keep the paths in memory
+    cache = PathCACHE(os.path.join(self.folder, 'missing', 'path_cache.db'))
+    cache.Load()
+    cache.Add(self.path, self.friction, 0.1)
+    self.assertEqual([cache.writes, cache.Query(self.path[0], self.path[-1], self.friction) != None], [0, True])
+    
+class MapPathStoreTest(MapTestCase):
+  def Route(self, m):
+    return m.FindPath([vect_5D(1.0, 2.0), vect_5D(5.0, 2.0)], m.frictions[''])
+    
+  def testReadThrough(self):
+    path = self.Route(self.map)
+    m = sandbox_map(self.name)
+    self.assertEqual([self.Route(m), m.pathcache.reads, m.pathcache.hits], [path, 1, 1])
+    
+  def testNewFrictions(self):
+    self.Route(self.map)
+    WriteTestMap(self.name, water = 0.25)
+    m = sandbox_map(self.name)
+    self.assertNotEqual(m.pathcache.stamp, self.map.pathcache.stamp)
+    self.Route(m)
+    self.assertEqual([m.pathcache.reads, m.pathcache.misses, m.pathcache.writes], [0, 1, 1])
+
+
 
 
 from random import random
+
 CASE = 'DATA'
 if __name__ == '__main__':
   if CASE == 'DATA':
     mymap = sandbox_map('Anzio')
     
+  if CASE == 'PREPROCESS':
+    # Cost rasters and path graphs for all maps
+    for i in os.listdir(os.path.join(os.environ['OPCONhome'],'maps')):
+      if not os.path.isdir(os.path.join(os.environ['OPCONhome'],'maps',i)):
+        continue
+      mymap = sandbox_map(i)
+      mymap.PreparePathGraphs()
+    
   if CASE == 'UTMGRID':
     mymap = sandbox_map('Anzio')
     mymap.DrawMGRSGrid()
@@ -1565,4 +2314,4 @@ if __name__ == '__main__':
     #print mymap.EffectivePathLength(o)
     #mymap.DrawPath(p)
     mymap.DrawPath(o)
-    mymap.copy.show()
\ No newline at end of file
+    mymap.copy.show()
\ No newline at end of file
@@ -0,0 +1,337 @@
+#!/usr/bin/python
+'''
+    Monte Carlo -- Batch replications of a scenario over a process pool.
+    OPCON Sandbox -- Extensible Operational level military simulation.
+    Copyright (C) 2007 Christian Blouin
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 2 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+if __name__ == '__main__':
+  import syspathlib
+  import os
+  os.chdir('..')
+
+# Import
+import os
+import os.path
+import sys
+import random
+import traceback
+from math import ceil
+from datetime import timedelta
+from multiprocessing import Pool, cpu_count
+
+from sandbox_world import sandbox
+from sandbox_XML import sandboXML
+
+
+# Outcome metrics
+def Strength(unit, kind = 'personel'):
+  '''! \brief Head count of personel or vehicles for a unit.
+  '''
+  comp = getattr(unit, kind)
+  return sum([comp[k].GetCount() for k in comp])
+
+def ObjectiveReached(unit):
+  '''! \brief True if the unit had maneuver tasks and all of them are completed.
+  '''
+  tasks = unit['OPORD'].GetTaskList()
+  if not tasks:
+    return False
+  for t in tasks:
+    if not t.IsCompleted():
+      return False
+  return True
+
+def UnitOutcome(sbox, unit, initial, objective):
+  '''! \brief The outcome metrics of a unit at the end of a replication.
+       \param initial [personel, vehicle, supply] when the replication started.
+       \param objective Time to objective in hours, or None.
+  '''
+  out = {'name':unit.GetName(), 'side':unit['side']}
+  out['personel'] = Strength(unit)
+  out['vehicle'] = Strength(unit, 'vehicle')
+  out['casualties'] = initial[0] - out['personel']
+  out['vehicle losses'] = initial[1] - out['vehicle']
+  out['supply'] = float(unit.GetCargo())
+  out['supply used'] = initial[2] - out['supply']
+  out['destroyed'] = not unit in sbox.OOB
+  pos = unit.Position()
+  out['x'], out['y'] = pos.x, pos.y
+  try:
+    out['position'] = unit.PositionAsString()
+  except:
+    out['position'] = ''
+  out['objective'] = objective
+  return out
+
+def Outcomes(sbox, hours):
+  '''! \brief Simulate a loaded world pulse by pulse for a number of hours.
+       \return The final clock and the outcome of each unit present at the start.
+  '''
+  start = sbox.GetClock()
+
+  # Initial state of the units present at the start
+  units = list(sbox.OOB)
+  initial = {}
+  for u in units:
+    initial[u['uid']] = [Strength(u), Strength(u, 'vehicle'), float(u.GetCargo())]
+
+  # Pulse by pulse, to catch the time to objective
+  objective = {}
+  for i in range(int(ceil(hours / sbox.Pulse()))):
+    sbox.SimulateScheduled(sbox.pulse)
+    for u in units:
+      if not u['uid'] in objective and ObjectiveReached(u):
+        delta = sbox.GetClock() - start
+        objective[u['uid']] = delta.days * 24.0 + delta.seconds / 3600.0
+
+  return sbox.GetClock(), [UnitOutcome(sbox, u, initial[u['uid']], objective.get(u['uid'])) for u in units]
+
+
+# Worker
+def RunReplication(job):
+  '''! \brief Run one replication of a scenario in the current process.
+       \param job A tuple (scenario, index, seed, hours, keep).
+       \return A dictionary with the index, seed, final clock and outcome of each unit (or the error).
+
+       The global random module is seeded before the scenario is loaded, so a replication
+       can be reproduced from its seed. Replications run headless (no folder); if keep is set,
+       the files are kept in memory and written with the final checkpoint to
+       Simulations/<tag>.zip afterward, else they are only counted.
+  '''
+  scenario, index, seed, hours, keep = job
+  out = {'index':index, 'seed':seed, 'units':[], 'error':''}
+  random.seed(seed)
+  tag = '%s MC %d %d'%(os.path.splitext(scenario)[0], index, seed)
+  sbox = None
+  try:
+    sbox = sandbox(scenario, gametag=tag, headless=True, keep=keep)
+    out['clock'], out['units'] = Outcomes(sbox, hours)
+  except:
+    out['error'] = traceback.format_exc()
+
+  # The single artefact of the replication
+  if sbox and keep and sbox.OS.has_key('savepath'):
+    try:
+      sbox.Save()
+    except:
+      out['error'] = out['error'] or traceback.format_exc()
+    sbox.writer.Archive(sbox.OS['savepath'] + '.zip', sbox.OS['savepath'])
+
+  return out
+
+
+class sandbox_montecarlo:
+  '''! \brief Replicate a scenario many times with independent seeds and aggregate the outcomes.
+
+       \param scenario The XML file in the scenarios folder.
+       \param replications The number of replications.
+       \param hours The simulated time of each replication.
+       \param seed The master seed from which the replication seeds are drawn (random if None).
+       \param processes The size of the process pool (number of CPUs if None, in process if 1).
+  '''
+  def __init__(self, scenario, replications = 10, hours = 24.0, seed = None, processes = None, keep = False):
+    self.scenario = scenario
+    self.replications = int(replications)
+    self.hours = float(hours)
+    if seed == None:
+      seed = random.SystemRandom().randint(1, 2**31 - 1)
+    self.seed = seed
+    self.processes = processes or cpu_count()
+    self.keep = keep
+
+    # The replications, sorted by index
+    self.results = []
+
+  def Seeds(self):
+    '''! \brief The seed of each replication, drawn from the master seed (all distinct).
+    '''
+    rng = random.Random(self.seed)
+    out = []
+    while len(out) < self.replications:
+      s = rng.randint(1, 2**31 - 1)
+      if not s in out:
+        out.append(s)
+    return out
+
+  def Jobs(self):
+    seeds = self.Seeds()
+    return [(self.scenario, i, seeds[i], self.hours, self.keep) for i in range(self.replications)]
+
+  def Run(self):
+    '''! \brief Run all replications.
+         \return The list of replications.
+    '''
+    jobs = self.Jobs()
+    if self.processes == 1:
+      self.results = map(RunReplication, jobs)
+    else:
+      pool = Pool(min(self.processes, len(jobs)))
+      try:
+        self.results = pool.map(RunReplication, jobs, 1)
+        pool.close()
+      except KeyboardInterrupt:
+        pool.terminate()
+        raise
+      pool.join()
+    self.results.sort(key = lambda x: x['index'])
+    return self.results
+
+  def Failures(self):
+    return [r for r in self.results if r['error']]
+
+  # Aggregation
+  def Summary(self):
+    '''! \brief Statistics of each metric by unit over the replications that ran.
+         \return {(side, name):{metric:[n, mean, std, min, max]}}
+    '''
+    samples = {}
+    for rep in self.results:
+      for u in rep['units']:
+        k = (u['side'], u['name'])
+        if not k in samples:
+          samples[k] = {}
+        for m in ['casualties', 'vehicle losses', 'supply', 'supply used', 'objective']:
+          if u[m] != None:
+            samples[k].setdefault(m, []).append(float(u[m]))
+        samples[k].setdefault('destroyed', []).append(float(u['destroyed']))
+
+    out = {}
+    for k in samples:
+      out[k] = {}
+      for m in samples[k]:
+        out[k][m] = Statistics(samples[k][m])
+    return out
+
+  def ToXML(self):
+    '''! \brief The replications and their summary as a XML document.
+    '''
+    doc = sandboXML('montecarlo')
+    for a, v in [('scenario', self.scenario), ('replications', self.replications), ('hours', self.hours), ('seed', self.seed)]:
+      doc.SetAttribute(a, v, doc.root)
+
+    # Replications
+    for rep in self.results:
+      node = doc.NewNode('replication')
+      doc.SetAttribute('index', rep['index'], node)
+      doc.SetAttribute('seed', rep['seed'], node)
+      if rep['error']:
+        doc.AddField('error', rep['error'], node)
+      else:
+        doc.AddNode(doc.DateTime('clock', rep['clock']), node)
+      for u in rep['units']:
+        unode = doc.NewNode('unit')
+        for a in ['name', 'side', 'personel', 'casualties', 'vehicle', 'vehicle losses', 'supply', 'supply used', 'x', 'y', 'position']:
+          doc.SetAttribute(a.replace(' ','_'), u[a], unode)
+        doc.SetAttribute('destroyed', int(u['destroyed']), unode)
+        if u['objective'] != None:
+          doc.SetAttribute('objective', u['objective'], unode)
+        doc.AddNode(unode, node)
+      doc.AddNode(node)
+
+    # Summary
+    summary = doc.NewNode('summary')
+    stats = self.Summary()
+    keys = stats.keys()
+    keys.sort()
+    for k in keys:
+      unode = doc.NewNode('unit')
+      doc.SetAttribute('side', k[0], unode)
+      doc.SetAttribute('name', k[1], unode)
+      metrics = stats[k].keys()
+      metrics.sort()
+      for m in metrics:
+        mnode = doc.NewNode(m.replace(' ','_'))
+        for a, v in zip(['n', 'mean', 'std', 'min', 'max'], stats[k][m]):
+          doc.SetAttribute(a, v, mnode)
+        doc.AddNode(mnode, unode)
+      doc.AddNode(unode, summary)
+    doc.AddNode(summary)
+    return doc
+
+  def Write(self, fname = None):
+    '''! \brief Write the results file (Simulations/<scenario>_montecarlo.xml by default).
+    '''
+    if fname == None:
+      fname = os.path.join(os.getcwd(), 'Simulations', '%s_montecarlo.xml'%(os.path.splitext(self.scenario)[0]))
+    with open(fname, 'w') as fout:
+      fout.write(str(self.ToXML()))
+    return fname
+
+
+def Statistics(L):
+  '''! \brief [n, mean, std, min, max] of a list of floats (sample standard deviation).
+  '''
+  n = len(L)
+  mean = sum(L) / n
+  std = 0.0
+  if n > 1:
+    std = (sum([(x - mean)**2 for x in L]) / (n - 1)) ** 0.5
+  return [n, mean, std, min(L), max(L)]
+
+
+import unittest
+class MonteCarloTest(unittest.TestCase):
+  def testSeedsDistinctAndRecorded(self):
+    mc = sandbox_montecarlo('testOneFireTeamUTM.xml', replications=50, seed=7)
+    seeds = mc.Seeds()
+    self.assertEqual([len(set(seeds)), seeds], [50, sandbox_montecarlo('testOneFireTeamUTM.xml', replications=50, seed=7).Seeds()])
+
+  def testStatistics(self):
+    self.assertEqual(Statistics([1.0, 2.0, 3.0]), [3, 2.0, 1.0, 1.0, 3.0])
+
+  def testReplicationInProcess(self):
+    mc = sandbox_montecarlo('testTwoFireTeamsUTM.xml', replications=2, hours=0.5, seed=3, processes=1)
+    mc.Run()
+    self.assertEqual([mc.Failures(), [len(r['units']) for r in mc.results]], [[], [2, 2]])
+    summary = mc.Summary()
+    self.assertEqual(summary[('BLUE','A/A/1/2-501')]['casualties'][0], 2)
+
+  def testReplicationFolderRemoved(self):
+    RunReplication(('testOneFireTeamUTM.xml', 0, 11, 0.2, False))
+    self.assertFalse(os.path.exists(os.path.join('Simulations', 'testOneFireTeamUTM_MC_0_11')))
+
+  def testReplicationKeptAsZip(self):
+    import zipfile
+    fname = os.path.join('Simulations', 'testOneFireTeamUTM_MC_0_11.zip')
+    RunReplication(('testOneFireTeamUTM.xml', 0, 11, 0.2, True))
+    try:
+      self.assertEqual([os.path.exists(os.path.join('Simulations', 'testOneFireTeamUTM_MC_0_11')), 'current.bin' in zipfile.ZipFile(fname).namelist()], [False, True])
+    finally:
+      os.remove(fname)
+
+
+
+if __name__ == '__main__':
+  # Check for the number of argument
+  if len(sys.argv) < 3:
+    print 'sandbox_montecarlo.py scenario.xml replications [hours] [seed] [processes]'
+    sys.exit()
+
+  scenario = sys.argv[1]
+  replications = int(sys.argv[2])
+  hours = 24.0
+  seed = None
+  processes = None
+  if len(sys.argv) > 3:
+    hours = float(sys.argv[3])
+  if len(sys.argv) > 4:
+    seed = int(sys.argv[4])
+  if len(sys.argv) > 5:
+    processes = int(sys.argv[5])
+
+  mc = sandbox_montecarlo(scenario, replications, hours, seed, processes)
+  mc.Run()
+  print 'Seed %d, %d replications (%d failed) written to %s'%(mc.seed, replications, len(mc.Failures()), mc.Write())
@@ -0,0 +1,190 @@
+'''
+    Profiler -- Timing of the simulation by phase, unit, task and path finding.
+    OPCON Sandbox -- Extensible Operational level military simulation.
+    Copyright (C) 2007 Christian Blouin
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 2 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+# Import
+from time import time
+
+
+class sandbox_profiler:
+  '''! \brief Nested timers, aggregated per pulse, per unit and per call stack.
+
+       A section has a kind (a phase, Step, Detection, Staffwork, task, FindPath) and optionally
+       the unit it is about. Sections nest: the stack of open sections gives the flame graph
+       (self time of each stack, in microseconds) while the pulse and unit tables report the
+       inclusive time of each kind. Disabled by default, in which case Call() only calls.
+  '''
+  def __init__(self):
+    self.enabled = False
+    self.Reset()
+
+  def Reset(self):
+    # Open sections [kind, label, begin, time in children]
+    self.stack = []
+    # The current pulse
+    self.pulse = None
+    # (pulse, kind) : [calls, seconds]
+    self.pulses = {}
+    # (kind, unit) : [calls, seconds]
+    self.units = {}
+    # (label, label, ...) : seconds of self time
+    self.stacks = {}
+
+  # Interface
+  def NewPulse(self, clock):
+    '''! \brief Sections that follow are accounted to the pulse at clock.
+    '''
+    self.pulse = clock
+    self.stack = []
+
+  def Begin(self, kind, who = None):
+    '''! \brief Open a section. who is a unit (or its name), if any.
+    '''
+    if who != None and not type(who) in [type(''), type(u'')]:
+      who = who.GetName()
+    label = kind
+    if who:
+      label = '%s %s'%(kind, who)
+    self.stack.append([kind, who, label.replace(';',':'), time(), 0.0])
+
+  def End(self):
+    '''! \brief Close the last section.
+    '''
+    kind, who, label, begin, children = self.stack.pop()
+    elapsed = time() - begin
+    if self.stack:
+      self.stack[-1][4] += elapsed
+
+    self.Add(self.pulses, (self.pulse, kind), elapsed)
+    if who:
+      self.Add(self.units, (kind, who), elapsed)
+    path = tuple([i[2] for i in self.stack]) + (label,)
+    self.stacks[path] = self.stacks.get(path, 0.0) + elapsed - children
+
+  def Call(self, kind, who, fn, *args):
+    '''! \brief Call fn(*args) in a section (or just call it if disabled).
+    '''
+    if not self.enabled:
+      return fn(*args)
+    self.Begin(kind, who)
+    try:
+      return fn(*args)
+    finally:
+      self.End()
+
+  # Reports
+  def PulseTable(self):
+    '''! \brief Rows [pulse, kind, calls, seconds] sorted by pulse and kind.
+    '''
+    out = []
+    for k in self.pulses:
+      out.append([k[0], k[1]] + self.pulses[k])
+    out.sort()
+    return out
+
+  def UnitTable(self):
+    '''! \brief Rows [kind, unit, calls, seconds] from the most expensive.
+    '''
+    out = []
+    for k in self.units:
+      out.append([k[0], k[1]] + self.units[k])
+    out.sort(key = lambda x: -x[3])
+    return out
+
+  def Table(self, units = False):
+    '''! \brief Either table as tab separated text.
+    '''
+    if units:
+      out = 'kind\tunit\tcalls\tseconds\n'
+      rows = self.UnitTable()
+    else:
+      out = 'pulse\tkind\tcalls\tseconds\n'
+      rows = self.PulseTable()
+    for r in rows:
+      out = out + '%s\t%s\t%d\t%.6f\n'%tuple(r)
+    return out
+
+  def Folded(self):
+    '''! \brief The stacks in the folded format of flamegraph.pl (self time in microseconds).
+    '''
+    out = []
+    for path in self.stacks:
+      us = int(round(self.stacks[path] * 1e6))
+      if us > 0:
+        out.append('%s %d'%(';'.join(path), us))
+    out.sort()
+    return '\n'.join(out) + '\n'
+
+  # Private methods
+  def Add(self, table, key, elapsed):
+    if not key in table:
+      table[key] = [0, 0.0]
+    table[key][0] += 1
+    table[key][1] += elapsed
+
+
+# The profiler shared by all simulations of a process
+_profiler = None
+def SharedProfiler():
+  '''! \brief The profiler of this process (created on demand, disabled).
+  '''
+  global _profiler
+  if _profiler == None:
+    _profiler = sandbox_profiler()
+  return _profiler
+
+
+import unittest
+class ProfilerTest(unittest.TestCase):
+  def setUp(self):
+    self.prof = sandbox_profiler()
+    self.prof.enabled = True
+    self.prof.NewPulse('0700')
+
+  def testDisabledOnlyCalls(self):
+    self.prof.enabled = False
+    self.assertEqual([self.prof.Call('Step', 'A', max, 1, 2), self.prof.pulses], [2, {}])
+
+  def testNesting(self):
+    self.prof.Begin('PhaseStepAll')
+    self.prof.Call('Step', 'A/1', self.prof.Call, 'FindPath', None, len, [])
+    self.prof.Call('Step', 'B/1', len, [])
+    self.prof.End()
+    stacks = self.prof.stacks.keys()
+    stacks.sort()
+    self.assertEqual(stacks, [('PhaseStepAll',), ('PhaseStepAll','Step A/1'), ('PhaseStepAll','Step A/1','FindPath'), ('PhaseStepAll','Step B/1')])
+
+  def testTables(self):
+    for clock in ['0700', '0710']:
+      self.prof.NewPulse(clock)
+      self.prof.Call('PhaseStepAll', None, self.prof.Call, 'Step', 'A/1', len, [])
+    self.assertEqual([[r[:3] for r in self.prof.PulseTable()], [r[:3] for r in self.prof.UnitTable()]],
+                     [[['0700','PhaseStepAll',1], ['0700','Step',1], ['0710','PhaseStepAll',1], ['0710','Step',1]], [['Step','A/1',2]]])
+
+  def testSelfTimeAddsUp(self):
+    self.prof.Begin('PhaseDetection')
+    self.prof.Begin('Detection', 'A/1')
+    x = sum(range(100000))
+    self.prof.End()
+    self.prof.End()
+    total = self.prof.pulses[('0700','PhaseDetection')][1]
+    self.assertAlmostEqual(sum(self.prof.stacks.values()), total, 6)
+
+  def testException(self):
+    self.assertRaises(ZeroDivisionError, self.prof.Call, 'Step', 'A/1', lambda : 1/0)
+    self.assertEqual([self.prof.stack, self.prof.units[('Step','A/1')][0]], [[], 1])
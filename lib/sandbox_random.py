@@ -0,0 +1,146 @@
+'''
+    Random -- Deterministic random streams by pulse, phase and entity.
+    OPCON Sandbox -- Extensible Operational level military simulation.
+    Copyright (C) 2007 Christian Blouin
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 2 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+# Import
+import random as _random
+from hashlib import md5
+
+
+class sandbox_random:
+  '''! \brief The random streams of a simulation.
+
+       A stream is a generator seeded from the seed of the simulation, the pulse and a key (a phase and
+       the uids of the units it is about). The draws of a unit in a phase are thus independent of the
+       order in which the units are processed, and of the process doing it. Sections nest like the
+       profiler's: the models draw from the stream of the innermost section with the functions of this
+       module (random, choice, shuffle, ...). Out of any section, those are the functions of the random
+       module.
+
+       \param seed The seed of the simulation.
+  '''
+  def __init__(self, seed = 0):
+    self.seed = seed
+    self.NewPulse(None)
+
+  # Interface
+  def NewPulse(self, clock):
+    '''! \brief The streams that follow are those of the pulse at clock.
+    '''
+    self.clock = clock
+    # key : generator, for this pulse
+    self.streams = {}
+
+  def Stream(self, key):
+    '''! \brief The generator of a key (a tuple) in this pulse.
+    '''
+    if not key in self.streams:
+      digest = md5('%s|%s|%s'%(self.seed, self.clock, repr(key))).hexdigest()
+      self.streams[key] = _random.Random(long(digest[:16], 16))
+    return self.streams[key]
+
+  def Begin(self, kind, *units):
+    '''! \brief Open a section: draws come from the stream of kind and units (or their uids).
+    '''
+    key = (kind,) + tuple([Key(u) for u in units])
+    _sections.append(self.Stream(key))
+
+  def End(self):
+    _sections.pop()
+
+  def Call(self, kind, units, fn, *args):
+    '''! \brief Call fn(*args) in a section. units is a unit or a list of units.
+    '''
+    if type(units) != type([]):
+      units = [units]
+    self.Begin(kind, *units)
+    try:
+      return fn(*args)
+    finally:
+      self.End()
+
+
+def Key(unit):
+  '''! \brief The uid of a unit, as is otherwise.
+  '''
+  if isinstance(unit, dict) and 'uid' in unit:
+    return unit['uid']
+  return unit
+
+
+# The open sections, the innermost last
+_sections = []
+
+def Current():
+  '''! \brief The generator the models draw from.
+  '''
+  if _sections:
+    return _sections[-1]
+  return _random
+
+# Drop-in replacements for the functions of the random module
+def random():
+  return Current().random()
+
+def choice(seq):
+  return Current().choice(seq)
+
+def shuffle(x):
+  return Current().shuffle(x)
+
+def randint(a, b):
+  return Current().randint(a, b)
+
+def gauss(mu, sigma):
+  return Current().gauss(mu, sigma)
+
+def expovariate(lambd):
+  return Current().expovariate(lambd)
+
+
+import unittest
+class RandomTest(unittest.TestCase):
+  def setUp(self):
+    self.rng = sandbox_random(7)
+    self.rng.NewPulse('0700')
+
+  def Draws(self, rng, kind, uid, n = 3):
+    return rng.Call(kind, {'uid':uid}, lambda : [random() for i in range(n)])
+
+  def testOrderIndependent(self):
+    a = [self.Draws(self.rng, 'Step', 1), self.Draws(self.rng, 'Step', 2)]
+    other = sandbox_random(7)
+    other.NewPulse('0700')
+    b = [self.Draws(other, 'Step', 2), self.Draws(other, 'Step', 1)]
+    self.assertEqual(a, [b[1], b[0]])
+
+  def testStreamsDiffer(self):
+    draws = [self.Draws(self.rng, 'Step', 1), self.Draws(self.rng, 'Detection', 1), self.Draws(self.rng, 'Step', 2)]
+    self.rng.NewPulse('0710')
+    draws.append(self.Draws(self.rng, 'Step', 1))
+    self.assertEqual(len(set([tuple(i) for i in draws])), 4)
+
+  def testStreamContinuesInPulse(self):
+    self.assertNotEqual(self.Draws(self.rng, 'Step', 1), self.Draws(self.rng, 'Step', 1))
+
+  def testNesting(self):
+    self.rng.Begin('Engagement', 1, 2)
+    self.rng.Call('Step', 3, random)
+    self.assertTrue(Current() is self.rng.Stream(('Engagement', 1, 2)))
+    self.rng.End()
+    self.assertTrue(Current() is _random)
@@ -19,6 +19,7 @@
 
 # Import
 from datetime import datetime, timedelta
+from heapq import heappush, heappop
 
 
 class sandbox_event:
@@ -37,6 +38,10 @@ class sandbox_event:
     self._args = ()
     self._keyw = {}
     
+    # Scheduling, a period for recurring events and the cancellation flag
+    self.period = None
+    self.cancelled = False
+    
     # Set the fn and args
     if fn != None:
       self.SetFunction(fn)
@@ -75,7 +80,7 @@ class sandbox_memo(sandbox_event):
     return self.data
 
 class sandbox_Scheduler:
-  '''! General purpose Scheduling class using time structure as keys for lists of events. 
+  '''! General purpose Scheduling class using a heap of (time, sequence, event). 
   
       Design purpose :
       Post any function call to be executed from the scheduler while the simulation will be stepping throug the time.
@@ -86,18 +91,28 @@ class sandbox_Scheduler:
       or (using an alternative constructor):
       sim.PostEvent(self.clock+self.pulse, self.OOB[2], self.OOB[2].AdjustMoral, (0.25,))
       
+      Events at the same time are executed in the order they were posted. PostEvent returns the 
+      event, which is the handle to Cancel it. A recurring event is posted again one period later 
+      each time it is popped.
 
   '''
   def __init__(self):
     # Pointer to the owner (unit/world)
     self.parent = None
-    # Dictionary using datetime object as keys, the values will be list of events
-    self.events = {}
+    # Heap of [timestamp, sequence, event]
+    self.events = []
+    # Sequence number, for first-in first-out at equal timestamps
+    self.counter = 0
+    
+  def __len__(self):
+    self.Clean()
+    return len([i for i in self.events if not i[2].cancelled])
     
   # Adding
   def PostEvent(self, timestamp, event, fn = None, args = None):
     '''! Add an event to the Scheduler 
         if fn and args are not None, the method will make an event.
+        \return the event (the handle for cancellation)
     '''
     # Convenience built an event
     if fn != None:
@@ -105,46 +120,76 @@ class sandbox_Scheduler:
         args = ()
       event = sandbox_event(event, fn, args)
       
-    # Add the key if needed
-    if not self.events.has_key(timestamp):
-      self.events[timestamp] = []
-      
     # Update the datastructure
-    self.events[timestamp].append(event)
+    heappush(self.events, (timestamp, self.counter, event))
+    self.counter = self.counter + 1
+    return event
+  
+  def PostRecurring(self, timestamp, period, event, fn = None, args = None):
+    '''! \brief Add an event executed at timestamp, then every period until cancelled.
+        \return the event (the handle for cancellation)
+    '''
+    event = self.PostEvent(timestamp, event, fn, args)
+    event.period = period
+    return event
+  
+  def Cancel(self, event):
+    '''! \brief Cancel an event (and all its recurrences), it is dropped when reaching the top of the heap.
+    '''
+    event.cancelled = True
     
   # Pruning
   def ShredUpTo(self, timestamp):
     '''! \brief Remove from Scheduler all items that occured before, and exactly on, a threshold
          \param timestamp [datetime] The threshold.
     '''
-    off = self.events.keys()
-    off.sort()
+    while self.events and self.events[0][0] <= timestamp:
+      heappop(self.events)
     
-    for i in off:
-      if i <= timestamp:
-        del self.events[i]
-      else:
-        return
+  def Clean(self):
+    '''! \brief Drop the cancelled events from the top of the heap.
+    '''
+    while self.events and self.events[0][2].cancelled:
+      heappop(self.events)
     
   # Retrieval
+  def Peek(self):
+    '''! \brief The time of the next event, None if the Scheduler is empty.'''
+    self.Clean()
+    if self.events:
+      return self.events[0][0]
+    return None
+  
+  def Pop(self):
+    '''! \brief Remove the next event, a recurring event is posted again for its next occurence.
+         \return (timestamp, event) or None if the Scheduler is empty.
+    '''
+    self.Clean()
+    if not self.events:
+      return None
+    timestamp, seq, event = heappop(self.events)
+    if event.period:
+      heappush(self.events, (timestamp + event.period, self.counter, event))
+      self.counter = self.counter + 1
+    return timestamp, event
+  
   def NextEventTimeStamp(self, timestamp):
     '''! Retrieve the time of the next posted event.'''
-    # Get the keys in a list
-    temp = self.events.keys()
-    temp.sort()
-    for i in temp:
-      if i > timestamp:
-        return i
+    nxt = self.Peek()
+    if nxt == None or nxt > timestamp:
+      return nxt
+    # Rare case, events left in the past
+    temp = [i[0] for i in self.events if i[0] > timestamp and not i[2].cancelled]
+    if temp:
+      return min(temp)
     return None
 
       
   def EventList(self, timestamp):
     '''! Return the event list at a given timestamp'''
-    # No events
-    if not self.events.has_key(timestamp):
-      return []
-    # Do the deeds
-    return self.events[timestamp]
+    temp = [i for i in self.events if i[0] == timestamp and not i[2].cancelled]
+    temp.sort()
+    return [i[2] for i in temp]
   
   
   # Operators #######################################################################
@@ -155,6 +200,45 @@ class sandbox_Scheduler:
     else:
       print 'Key of type %s not implemented'%(str(type(key)))
     
+import unittest
+class SchedulerTest(unittest.TestCase):
+  def setUp(self):
+    self.sched = sandbox_Scheduler()
+    self.t0 = datetime(2010,1,3,8,0)
+    self.log = []
+    
+  def Run(self, endtime):
+    nxt = self.sched.Peek()
+    while nxt != None and nxt <= endtime:
+      ts, ev = self.sched.Pop()
+      ev.Execute()
+      nxt = self.sched.Peek()
+    
+  def testOrder(self):
+    self.sched.PostEvent(self.t0 + timedelta(minutes=20), self, self.log.append, ('c',))
+    self.sched.PostEvent(self.t0 + timedelta(minutes=10), self, self.log.append, ('a',))
+    self.sched.PostEvent(self.t0 + timedelta(minutes=10), self, self.log.append, ('b',))
+    self.Run(self.t0 + timedelta(hours=1))
+    self.assertEqual(self.log, ['a','b','c'])
+    
+  def testPeek(self):
+    self.sched.PostEvent(self.t0 + timedelta(minutes=20), self, self.log.append, ('c',))
+    self.sched.PostEvent(self.t0 + timedelta(minutes=10), self, self.log.append, ('a',))
+    self.assertEqual(self.sched.Peek(), self.t0 + timedelta(minutes=10))
+    
+  def testCancel(self):
+    h = self.sched.PostEvent(self.t0, self, self.log.append, ('a',))
+    self.sched.PostEvent(self.t0, self, self.log.append, ('b',))
+    self.sched.Cancel(h)
+    self.Run(self.t0)
+    self.assertEqual(self.log, ['b'])
+    
+  def testRecurring(self):
+    h = self.sched.PostRecurring(self.t0, timedelta(minutes=10), self, self.log.append, ('a',))
+    self.Run(self.t0 + timedelta(minutes=30))
+    self.sched.Cancel(h)
+    self.assertEqual([len(self.log), self.sched.Peek()], [4, None])
+    
 '''
 if __name__ == '__main__':
   class debug:
@@ -198,4 +282,4 @@ if __name__ == '__main__':
 '''  
   
     
-    
\ No newline at end of file
+    
\ No newline at end of file
@@ -4,7 +4,7 @@
 '''
 import os
 from copy import copy
-from random import random, choice
+from sandbox_random import random, choice
 
 import sandbox_geometry
 import sandbox_position
@@ -0,0 +1,352 @@
+#!/usr/bin/python
+'''
+    Server -- A resident simulation with a local HTTP order and query interface.
+    OPCON Sandbox -- Extensible Operational level military simulation.
+    Copyright (C) 2007 Christian Blouin
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 2 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+if __name__ == '__main__':
+  import syspathlib
+  import os
+  os.chdir('..')
+
+# Import
+import sys
+import threading
+import urlparse
+from copy import copy
+from cStringIO import StringIO
+from datetime import timedelta
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from xml.parsers.expat import ExpatError
+
+from sandbox_world import sandbox
+from sandbox_XML import sandboXML
+from sandbox_exception import SandboxException
+import sandbox_checkpoint
+
+
+class sandbox_server:
+  '''! \brief A world kept in memory between turns, driven by orders and queried by the umpire.
+
+       Commands (orders, advancing time, saving) run one at a time on the world. Queries are
+       answered from the state published after the last command: a checkpoint of the world that is
+       restored in a read-only copy on the first query that needs it. A query never waits for a turn
+       being computed and always sees a whole turn.
+
+       \param scenario The scenario or savegame to load (see sandbox.LoadFromFile).
+       \param gametag Overrides the name of the simulation folder.
+       \param headless Keep the files in memory (see sandbox_memory_writer).
+  '''
+  def __init__(self, scenario, gametag = None, headless = False):
+    self.world = sandbox(scenario, gametag=gametag, headless=headless)
+    # Commands
+    self.lock = threading.Lock()
+    # Queries, the last published state [clock, checkpoint, copy of the world] and its restored copy
+    self.viewlock = threading.Lock()
+    self.published = None
+    self.view = None
+    self.Publish()
+
+  # Commands
+  def IssueOrders(self, data):
+    '''! \brief Issue the orders of a XML document (an orders node, see sandbox.IssueOrdersFromXML).
+         \return The number of orders issued.
+    '''
+    try:
+      doc = sandboXML(read=StringIO(data))
+    except ExpatError, e:
+      raise SandboxException('BadOrders', str(e))
+    orders = doc.root
+    if doc.RootName() != 'orders':
+      orders = doc.Get(doc.root, 'orders')
+    if not orders:
+      raise SandboxException('BadOrders', 'No orders node')
+    with self.lock:
+      try:
+        count = self.world.IssueOrdersFromXML(doc, orders)
+      finally:
+        self.Publish()
+    return count
+
+  def Advance(self, minutes):
+    '''! \brief Simulate for a number of minutes.
+         \return The clock.
+    '''
+    with self.lock:
+      self.world.SimulateScheduled(timedelta(minutes=float(minutes)))
+      self.Publish()
+      return self.world.GetClock()
+
+  def Save(self):
+    '''! \brief Save the world (see sandbox.Save).
+    '''
+    with self.lock:
+      self.world.Save()
+      return self.world.GetClock()
+
+  # Queries
+  def Clock(self):
+    return self.published[0]
+
+  def Units(self, side = None):
+    '''! \brief The units of the OOB, as a XML string.
+    '''
+    view = self.View()
+    doc = sandboXML('units')
+    doc.SetAttribute('clock', view.GetClock(), doc.root)
+    for unit in view.GetOOB(side):
+      node = doc.NewNode('unit')
+      for a, v in [('uid', unit['uid']), ('name', unit.GetName()), ('side', unit['side']), ('TOE', unit['TOE']),
+                   ('position', view.map.MGRS.XYtoUTM(unit['position'])), ('stance', unit['stance']),
+                   ('readiness', unit['readiness']), ('supply', float(unit.GetCargo())), ('dormant', int(unit.IsDormant()))]:
+        doc.SetAttribute(a, v, node)
+      doc.AddNode(node)
+    return str(doc)
+
+  def Unit(self, uid):
+    '''! \brief The state of a unit (including its contacts), as a XML string.
+    '''
+    unit = self.Find(uid)
+    doc = sandboXML('sandbox')
+    doc.AddNode(unit.toXML(doc))
+    return str(doc)
+
+  def Contacts(self, uid):
+    '''! \brief The contacts of a unit, as a XML string.
+    '''
+    unit = self.Find(uid)
+    doc = sandboXML('intel_picture')
+    doc.SetAttribute('unit', unit.GetName(), doc.root)
+    for k in unit['contacts']:
+      node = unit['contacts'][k].toXML(doc)
+      doc.SetAttribute('key', k, node)
+      doc.AddNode(node)
+    return str(doc)
+
+  def Overlay(self, uid):
+    '''! \brief The overlay of the OPORD of a unit, as a XML string.
+    '''
+    unit = self.Find(uid)
+    doc = sandboXML('overlays')
+    doc.AddNode(unit['OPORD'].GetOverlay().toXML(doc))
+    return str(doc)
+
+  # HTTP interface
+  def Serve(self, port = 8086, host = 'localhost'):
+    '''! \brief Start answering HTTP requests in a thread (see sandbox_request_handler).
+         \return The HTTP server, stopped by its shutdown() method.
+    '''
+    httpd = sandbox_http_server((host, port), sandbox_request_handler)
+    httpd.sandbox = self
+    thread = threading.Thread(target=httpd.serve_forever, name='sandbox_server')
+    thread.daemon = True
+    thread.start()
+    return httpd
+
+  # Private methods
+  def Publish(self):
+    '''! \brief Make the current state of the world the one seen by queries (with the lock held).
+    '''
+    self.published = [self.world.GetClock(), sandbox_checkpoint.Dumps(self.world), copy(self.world)]
+
+  def View(self):
+    '''! \brief The read-only copy of the world at the last published state.
+    '''
+    published = self.published
+    with self.viewlock:
+      if self.view == None or self.view[0] is not published:
+        view = published[2]
+        view.archive = None
+        sandbox_checkpoint.Loads(view, published[1])
+        self.view = [published, view]
+      return self.view[1]
+
+  def Find(self, uid):
+    view = self.View()
+    try:
+      unit = view.AsEntity(int(uid))
+    except ValueError:
+      unit = None
+    if unit == None:
+      raise KeyError(uid)
+    return unit
+
+
+class sandbox_http_server(ThreadingMixIn, HTTPServer):
+  '''! \brief One thread per request, so queries don't wait for a command.
+  '''
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class sandbox_request_handler(BaseHTTPRequestHandler):
+  '''! \brief The routes of the server (all answers are XML).
+
+       GET  /clock
+       GET  /units[?side=BLUE]
+       GET  /units/<uid>
+       GET  /units/<uid>/contacts
+       GET  /units/<uid>/overlay
+       POST /orders                  (body: an orders node)
+       POST /advance?minutes=<n>
+       POST /save
+  '''
+  def do_GET(self):
+    path, query = self.Route()
+    server = self.server.sandbox
+    if path == ['clock']:
+      return self.Clock(server.Clock())
+    if path == ['units']:
+      return self.Reply(server.Units(query.get('side')))
+    if len(path) == 2 and path[0] == 'units':
+      return self.Reply(server.Unit(path[1]))
+    if len(path) == 3 and path[0] == 'units' and path[2] == 'contacts':
+      return self.Reply(server.Contacts(path[1]))
+    if len(path) == 3 and path[0] == 'units' and path[2] == 'overlay':
+      return self.Reply(server.Overlay(path[1]))
+    raise KeyError(self.path)
+
+  def do_POST(self):
+    path, query = self.Route()
+    server = self.server.sandbox
+    data = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+    if path == ['orders']:
+      doc = sandboXML('orders')
+      doc.SetAttribute('issued', server.IssueOrders(data), doc.root)
+      return self.Reply(str(doc))
+    if path == ['advance']:
+      return self.Clock(server.Advance(query.get('minutes', server.world.pulse.seconds / 60.0)))
+    if path == ['save']:
+      return self.Clock(server.Save())
+    raise KeyError(self.path)
+
+  def handle_one_request(self):
+    '''! \brief Errors are returned to the client: 404 (no such route or unit), 400 (bad command).
+    '''
+    try:
+      BaseHTTPRequestHandler.handle_one_request(self)
+    except KeyError, e:
+      self.Reply(self.Error('NotFound', e), 404)
+    except (SandboxException, ValueError), e:
+      self.Reply(self.Error(e.__class__.__name__, e), 400)
+
+  def Route(self):
+    url = urlparse.urlparse(self.path)
+    path = [i for i in url.path.split('/') if i]
+    query = dict([(k, v[-1]) for k, v in urlparse.parse_qs(url.query).items()])
+    return path, query
+
+  def Clock(self, clock):
+    doc = sandboXML('clock')
+    doc.SetAttribute('value', clock, doc.root)
+    self.Reply(str(doc))
+
+  def Error(self, kind, e):
+    doc = sandboXML('error')
+    doc.SetAttribute('type', kind, doc.root)
+    doc.SetAttribute('message', str(e), doc.root)
+    return str(doc)
+
+  def Reply(self, text, code = 200):
+    self.send_response(code)
+    self.send_header('Content-Type', 'text/xml')
+    self.send_header('Content-Length', str(len(text)))
+    self.end_headers()
+    self.wfile.write(text)
+
+  def log_message(self, format, *args):
+    pass
+
+
+import unittest
+import urllib2
+class ServerTest(unittest.TestCase):
+  def setUp(self):
+    self.server = sandbox_server('testTwoFireTeamsUTM.xml', gametag='Server Test', headless=True)
+    self.httpd = self.server.Serve(0)
+    self.url = 'http://localhost:%d'%(self.httpd.server_address[1])
+    # Not through a proxy
+    self.opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+
+  def tearDown(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
+  def Get(self, path, data = None):
+    return sandboXML(read=self.opener.open(self.url + path, data))
+
+  def testUnits(self):
+    doc = self.Get('/units')
+    names = [doc.Get(u, 'name') for u in doc.Get(doc.root, 'unit', True)]
+    self.assertEqual(sorted(names), sorted([u.GetName() for u in self.server.world.OOB]))
+
+  def testAdvance(self):
+    clock = self.server.world.GetClock() + timedelta(minutes=30)
+    doc = self.Get('/advance?minutes=30', '')
+    self.assertEqual([doc.Get(doc.root, 'value'), self.server.Clock()], [str(clock), clock])
+
+  def testQueryWhileTurnComputing(self):
+    # The lock is held by a command, queries are still answered
+    with self.server.lock:
+      doc = self.Get('/units/%d/contacts'%(self.server.world.OOB[0]['uid']))
+    self.assertEqual(doc.RootName(), 'intel_picture')
+
+  def testQueriesSeeWholeTurns(self):
+    uid = self.server.world.OOB[0]['uid']
+    before = self.server.Unit(uid)
+    self.server.world.OOB[0]['stance'] = 'changed'
+    self.assertEqual(self.server.Unit(uid), before)
+
+  def testOrders(self):
+    unit = self.server.world.OOB[0]
+    orders = '<orders><order side="%s" unit="%s" task="Redeploy" final_stance="deployed"/></orders>'%(unit['side'], unit.GetName())
+    doc = self.Get('/orders', orders)
+    self.assertEqual([doc.Get(doc.root, 'issued'), len(unit['staff queue'])], [1, 1])
+
+  def testErrors(self):
+    for path, data, code in [('/units/999', None, 404), ('/nothing', None, 404), ('/orders', '<orders>', 400),
+                             ('/orders', '<orders><order side="BLUE" unit="A" task="Dance"/></orders>', 400)]:
+      try:
+        self.opener.open(self.url + path, data)
+        self.fail(path)
+      except urllib2.HTTPError, e:
+        self.assertEqual(e.code, code)
+
+  def testRejectedOrders(self):
+    # A bad order rejects the whole document, the orders before it aren't issued
+    unit = self.server.world.OOB[0]
+    orders = '<orders><order side="%s" unit="%s" task="Redeploy"/><order side="%s" unit="%s" task="Dance"/></orders>'%(unit['side'], unit.GetName(), unit['side'], unit.GetName())
+    self.assertRaises(SandboxException, self.server.IssueOrders, orders)
+    self.assertEqual(len(unit['staff queue']), 0)
+
+
+if __name__ == '__main__':
+  # Check for the number of argument
+  if len(sys.argv) < 2:
+    print 'sandbox_server.py scenario.xml|savegame [port]'
+    sys.exit()
+
+  port = 8086
+  if len(sys.argv) > 2:
+    port = int(sys.argv[2])
+  httpd = sandbox_server(sys.argv[1]).Serve(port)
+  print 'Serving %s on http://localhost:%d'%(sys.argv[1], port)
+  try:
+    while True:
+      threading.Event().wait(3600)
+  except KeyboardInterrupt:
+    httpd.shutdown()
@@ -0,0 +1,152 @@
+'''
+    Spatial index -- Fast lookup of the units around a location.
+    OPCON Sandbox -- Extensible Operational level military simulation.
+    Copyright (C) 2007 Christian Blouin
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 2 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+# Import
+from math import floor
+
+
+class sandbox_spatial_index:
+  '''! \brief Uniform grid over bounding boxes [minx, miny, maxx, maxy] in km.
+
+       Each item is registered in all the cells its box touches. Queries return the items whose
+       box intersects the query box, sorted by key so that the results don't depend on the
+       layout of the grid. The caller does the exact geometric test on these candidates.
+
+       \param cellsize The side of a cell in km.
+  '''
+  def __init__(self, cellsize = 5.0):
+    self.cellsize = float(cellsize)
+    # (i,j) : {key:item}
+    self.cells = {}
+    # key : [box, cell range, item]
+    self.boxes = {}
+
+  def __len__(self):
+    return len(self.boxes)
+
+  def __contains__(self, key):
+    return key in self.boxes
+
+  # Modification
+  def Insert(self, key, item, box):
+    '''! \brief Register item under key (replaces a previous entry for key).
+    '''
+    rng = self.CellRange(box)
+    if key in self.boxes:
+      if self.boxes[key][1] == rng:
+        # Same cells, update in place
+        self.boxes[key][0] = box
+        self.boxes[key][2] = item
+        for cell in self.Cells(rng):
+          self.cells[cell][key] = item
+        return
+      self.Remove(key)
+
+    self.boxes[key] = [box, rng, item]
+    for cell in self.Cells(rng):
+      if not cell in self.cells:
+        self.cells[cell] = {}
+      self.cells[cell][key] = item
+
+  def Remove(self, key):
+    '''! \brief Forget the item under key, if any.
+    '''
+    if not key in self.boxes:
+      return
+    for cell in self.Cells(self.boxes[key][1]):
+      del self.cells[cell][key]
+      if not self.cells[cell]:
+        del self.cells[cell]
+    del self.boxes[key]
+
+  def Clear(self):
+    self.cells = {}
+    self.boxes = {}
+
+  # Queries
+  def Query(self, box):
+    '''! \brief The items whose box intersects box.
+         \return A list of items sorted by key.
+    '''
+    found = {}
+    for cell in self.Cells(self.CellRange(box)):
+      if cell in self.cells:
+        found.update(self.cells[cell])
+
+    out = []
+    keys = found.keys()
+    keys.sort()
+    for k in keys:
+      b = self.boxes[k][0]
+      if b[0] <= box[2] and b[2] >= box[0] and b[1] <= box[3] and b[3] >= box[1]:
+        out.append(found[k])
+    return out
+
+  def QueryPoint(self, point):
+    '''! \brief The items whose box contains a point.
+    '''
+    return self.Query([point.x, point.y, point.x, point.y])
+
+  def QueryRadius(self, point, radius):
+    '''! \brief The items whose box intersects the square enclosing a circle.
+    '''
+    return self.Query([point.x - radius, point.y - radius, point.x + radius, point.y + radius])
+
+  # Private methods
+  def CellRange(self, box):
+    s = self.cellsize
+    return (int(floor(box[0]/s)), int(floor(box[1]/s)), int(floor(box[2]/s)), int(floor(box[3]/s)))
+
+  def Cells(self, rng):
+    out = []
+    for i in range(rng[0], rng[2]+1):
+      for j in range(rng[1], rng[3]+1):
+        out.append((i,j))
+    return out
+
+
+import unittest
+from vector import vect_3D
+class SpatialIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.index = sandbox_spatial_index(1.0)
+    self.index.Insert(1, 'a', [0.2, 0.2, 0.8, 0.8])
+    self.index.Insert(2, 'b', [0.5, 0.5, 3.5, 1.5])
+    self.index.Insert(3, 'c', [-4.0, -4.0, -3.0, -3.0])
+
+  def testQueryPoint(self):
+    self.assertEqual(self.index.QueryPoint(vect_3D(0.6,0.6)), ['a','b'])
+
+  def testQueryPointSpanningCells(self):
+    self.assertEqual(self.index.QueryPoint(vect_3D(3.0,1.0)), ['b'])
+
+  def testQueryEmpty(self):
+    self.assertEqual(self.index.QueryPoint(vect_3D(10.0,10.0)), [])
+
+  def testQueryRadius(self):
+    self.assertEqual(self.index.QueryRadius(vect_3D(-2.0,-2.0), 1.5), ['c'])
+
+  def testMove(self):
+    self.index.Insert(3, 'c', [3.0, 3.0, 3.5, 3.5])
+    self.assertEqual([self.index.QueryPoint(vect_3D(-3.5,-3.5)), self.index.QueryPoint(vect_3D(3.2,3.2))], [[],['c']])
+
+  def testRemove(self):
+    self.index.Remove(2)
+    self.assertEqual([len(self.index), self.index.QueryPoint(vect_3D(0.6,0.6))], [2, ['a']])
+
@@ -25,7 +25,7 @@ from copy import deepcopy, copy
 
 from logistics import supply_package
 from Renderer_html import Tag, Table
-from random import random, choice
+from sandbox_random import random, choice
 
 
 import re
@@ -427,6 +427,7 @@ class sandbox_task(dict):
           if setBegin < T:
             # Start ASAP
             setBegin = T + timedelta()
+          self['planned begin time'] = copy(setBegin)
         else:
           # Set the value for the planned begin.
           self['planned begin time'] = copy(T)
@@ -1008,7 +1009,7 @@ class taskRelocate(sandbox_task):
 
   def SetFinalStance(self, s):
     self['final_stance'] = s
-  def Yield(self, E, spfr, sp, overlap):
+  def Yield(self, E, spfr, sp, overlap = None):
     ''' Simple decision for now, if speed cut in three, and timing isn't a priority over readiness, stop in 33% of the time. '''
     if sp/spfr >= 3:
       prior = E['agent'].PolicyPrioritize(['timing','readiness'])
@@ -1515,18 +1516,18 @@ class taskIndirectFire(sandbox_task):
     maxpoly = sandbox_geometry.circle(E.Position().AsVect() ,maxrange)
     
     out = []
-    for i in units:
-      if i.Position().Overlaps(maxpoly):
+    me = E.Position().AsVect()
+    overlaps = maxpoly.OverlapsAny([i.Footprint() for i in units])
+    for i in range(len(units)):
+      if overlaps[i]:
         # add if there is at least 1 vertex beyond the minrange
-        vees = i.Position().footprint.vertices()
-        me = E.Position().AsVect()
-        
-        for v in vees:
+        for v in units[i].Footprint().vertices():
           if (me-v).length() >= minrange:
-            out.append(i)
+            out.append(units[i])
             break
           
     return out
+
   def OrderHTML(self, A):
     '''! \brief Prepare a text version of the task for the HTML OPORD.
     '''
@@ -2429,7 +2430,6 @@ class taskTemplate(sandbox_task):
   
 import unittest
 import os
-import datetime
 class TaskTesting(unittest.TestCase):
   def setUp(self):
     filename = os.path.join(os.environ['OPCONhome'], 'tests', 'tasks.xml')
@@ -2461,7 +2461,7 @@ class TaskTesting(unittest.TestCase):
     
     # Add Parameters
     task['favourite color'] = 'pink'
-    task['birthdate'] = datetime.datetime.now()
+    task['birthdate'] = datetime.now()
     
     # Write is back to XML
     # New document
@@ -2473,6 +2473,28 @@ class TaskTesting(unittest.TestCase):
     
     self.assertTrue((task['birthdate'] - task2['birthdate']).seconds < 60)
     
+  def testDatetimeClass(self):
+    # Modules that import * from this one expect the class
+    import sandbox_tasks
+    self.assertTrue(sandbox_tasks.datetime is datetime and isinstance(datetime, type))
+    
+  def testYieldWithoutOverlap(self):
+    # As called by SpeedOnSpot
+    self.assertEqual(taskRelocate().Yield(None, 2.0, 1.0), False)
+    
+  def testPlannedBeginTime(self):
+    T = datetime(2010, 1, 3, 8, 0)
+    out = []
+    for begin in [T + timedelta(hours=2), T - timedelta(hours=2)]:
+      task = sandbox_task()
+      task.sequence.append(task)
+      task['set begin time'] = begin
+      task['task time'] = 1.0
+      end = task.PushPlannedBeginTime(T)
+      out.append((task['planned begin time'], end))
+    # Not before the set begin time, nor before T
+    self.assertEqual(out, [(T + timedelta(hours=2), T + timedelta(hours=3)), (T, T + timedelta(hours=1))])
+    
     
 if __name__ == '__main__':
     # suite
@@ -2483,4 +2505,4 @@ if __name__ == '__main__':
     
     # collate all and run
     allsuite = unittest.TestSuite(testsuite)
-    unittest.TextTestRunner(verbosity=2).run(allsuite)
\ No newline at end of file
+    unittest.TextTestRunner(verbosity=2).run(allsuite)
\ No newline at end of file
@@ -29,18 +29,27 @@ from math import log, pi
 # Import everything
 from sandbox_entity import *
 from sandbox_scheduler import sandbox_Scheduler
+from sandbox_spatial import sandbox_spatial_index
 from sandbox_cryptography import Encrypt
 from sandbox_map import sandbox_map
 from sandbox_XML import sandboXML
 from sandbox_infrastructure import sandbox_network
 from sandbox_exception import SandboxException
 from sandbox_data import sandbox_data_server
+from sandbox_writer import SharedWriter, sandbox_memory_writer
+from sandbox_profiler import SharedProfiler
+from sandbox_random import sandbox_random
+from sandbox_geometry import PointInPolygons
+import sandbox_checkpoint
+import sandbox_tasks
 
 # HTML renderer (for text)
 import Renderer_html as html
 
 # Import std python modules
 import time as tm
+from copy import copy
+
 from datetime import *
 import os
 import os.path
@@ -49,14 +58,31 @@ from sandbox_XML import sandboXML
 
 # classes
 class sandbox:
-  def __init__(self, scenario='blankworld.xml'):
+  def __init__(self, scenario='blankworld.xml', gametag=None, headless=False, keep=True):
     # compatibility
     self.version = '0.1'
     self.OS = {}
+    # Overrides the name of the scenario (and thus its folder), for concurrent runs of the same scenario
+    if gametag:
+      self.OS['gametag'] = gametag
+    # No folder is created and the files are kept in memory (see sandbox_memory_writer), or
+    # only counted if keep is False
+    self.headless = headless
     
     # Initialize all sorts of variables
     # The root node of the order of battle
     self.OOB = []
+    # Indexes of the OOB, by uid, by (side, name) and by side. The top level units are cached.
+    self.index_uid = {}
+    self.index_name = {}
+    self.index_side = {}
+    self.top_level = None
+    # Check the indexes at every pulse
+    self.debug = False
+    # Idle units go dormant until a wake condition fires (see sandbox_entity.Sleep)
+    self.lazy = True
+    # The autosave history (see sandbox_checkpoint.sandbox_archive), created by Save()
+    self.archive = None
   
     # The Database daemon
     self.data = sandbox_data_server()
@@ -90,10 +116,29 @@ class sandbox:
     
     # Scheduler
     self.scheduler = sandbox_Scheduler()
+    # Recurring events of the pulse phases
+    self.pulse_events = []
+    
+    # Spatial index of the footprints, by uid
+    self.spatial = sandbox_spatial_index()
+    # The signature of the footprint of each unit when the echelon footprints were last updated, by uid
+    self.footprints = {}
     
     # Sides registration (rgb colors)
     self.sides = {}
     
+    # File output is posted to a background thread, or kept in memory if headless
+    if headless:
+      self.writer = sandbox_memory_writer(keep)
+    else:
+      self.writer = SharedWriter()
+    
+    # Timing of the phases, units and path finding (disabled, see Profile())
+    self.profiler = SharedProfiler()
+    
+    # The random streams of the models, seeded from the random module (see sandbox_random)
+    self.rng = sandbox_random(randint(0, 2**31-1))
+    
     # Load the Scenario definition
     self.LoadFromFile(scenario)
 
@@ -108,56 +153,95 @@ class sandbox:
        INPUT : point --> a vect_5D
        OUPUT : List of entities
     '''
-    out = []
-    for i in range(len(self.OOB)):
-      if self.OOB[i].PointInFootprint(point):
-        out.append(self.OOB[i])
-    return out
+    candidates = self.spatial.QueryPoint(point)
+    inside = PointInPolygons(point, [i.Position().footprint for i in candidates])
+    return [candidates[i] for i in range(len(candidates)) if inside[i]]
         
   def UnitsInFootprint(self, entity):
     '''!
        Return everything in footrpint of entity
     '''
     out = []
-    for i in range(len(self.OOB)):
-      if self.OOB[i] != entity:
-        if entity.PointInFootprint(sekf,OOB[i]['position']):
-          out.append(self.OOB[i])
+    for i in self.spatial.Query(self.SpatialBox(entity)):
+      if i != entity:
+        if entity.PointInFootprint(i['position']):
+          out.append(i)
     return out
    
   def UnitsInPolygon(self, poly):
     '''!
        Return everything with footprint overlapping a polygon poly
     '''
+    candidates = self.spatial.Query(poly.BoundingBox())
+    overlaps = poly.OverlapsAny([i.Footprint() for i in candidates])
+    return [candidates[i] for i in range(len(candidates)) if overlaps[i]]
+
+  
+  def UnitsWithinRadius(self, point, radius):
+    '''!
+       Return the units positioned within radius (km) of point.
+    '''
     out = []
-    for i in range(len(self.OOB)):
-      if poly.Overlaps(self.OOB[i].Footprint()):
-        out.append(self.OOB[i])
+    for i in self.spatial.QueryRadius(point, radius):
+      if (i['position'] - point).length() <= radius:
+        out.append(i)
     return out
       
   def LOGPACsInFootprint(self, entity):
     '''
        Return the LOGPACs destined to entity if its in the footprint.
     '''
-    out = []
-    # List of LOGPAC
-    for i in self.OOB:
-      if i['TOE'] == 'LOGPAC': 
-        if i['recipient'] == entity['uid']:
-          out.append(i)
-          
-    # In footprint test
-    oout = []
-    for i in out:
-      if entity.Footprint().PointInside(i['position']):
-        oout.append(i)
-    return oout
+    out = [i for i in self.spatial.Query(self.SpatialBox(entity)) if i['TOE'] == 'LOGPAC' and i['recipient'] == entity['uid']]
+    if not out:
+      return out
+    inside = entity.Footprint().PointsInside([i['position'] for i in out])
+    return [out[i] for i in range(len(out)) if inside[i]]
+  
+  def SpatialBox(self, entity):
+    '''! \brief The box covering the footprint and the position of an entity.
+    '''
+    pos = entity['position']
+    box = [pos.x, pos.y, pos.x, pos.y]
+    fp = entity.Footprint()
+    if fp:
+      temp = fp.BoundingBox()
+      box = [min(box[0],temp[0]), min(box[1],temp[1]), max(box[2],temp[2]), max(box[3],temp[3])]
+    return box
   
+  def UpdateSpatialIndex(self, entity = None, units = None):
+    '''! \brief Refresh the spatial index for a unit in the OOB, or for a list of units (the whole OOB by default).
+    '''
+    if entity != None:
+      if entity.get('uid') in self.spatial:
+        self.spatial.Insert(entity['uid'], entity, self.SpatialBox(entity))
+      return
+    
+    if units == None:
+      units = self.OOB
+    for i in units:
+      self.spatial.Insert(i['uid'], i, self.SpatialBox(i))
+  
+  def DetectionRange(self, entity):
+    '''! \brief The farthest an entity's sensors can reach, None if one of them is unbounded.
+    '''
+    out = 0.0
+    for s in entity['intelligence'].EnumerateSensors(entity):
+      if s.max_range:
+        out = max(out, float(s.max_range))
+      elif 'LOS' in s.requires:
+        out = max(out, self.MaxVisibility())
+      else:
+        return None
+    return out
 
   def Visibility(self, pos):
     # By default, returns 4000m.
     return 4.0
   
+  def MaxVisibility(self):
+    ''' The upper bound of Visibility anywhere.'''
+    return 4.0
+  
 
   # Infrastructure related methods
   # 
@@ -174,9 +258,9 @@ class sandbox:
     v = self.GetLocation(name)
     
     if type(bearing) == type(''):
-      # Textual bearing are acceptable
-      b = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
-
+      # Textual bearing are acceptable
+      b = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+
       if bearing in b:
         bearing = b.index(bearing) * (2*pi / 16.0)
       else:
@@ -247,9 +331,11 @@ class sandbox:
     entity['agent'].map = self.map
     entity['uid'] = self.next_uid
     self.next_uid = self.next_uid + 1
+    self.IndexEntity(entity)
     
     # Generate a footprint
     entity.SetFootprint(entity['combat'].GetFootprint(entity))
+    self.spatial.Insert(entity['uid'], entity, self.SpatialBox(entity))
     
     # Get some variables setup
     entity.NewPulse(self.clock)
@@ -277,6 +363,9 @@ class sandbox:
         
     # Delete all contacts in OOB for entity
     self.OOB.remove(entity)
+    self.UnindexEntity(entity)
+    self.spatial.Remove(entity['uid'])
+    self.footprints.pop(entity['uid'], None)
     for unit in self.OOB:
       # Contacts
       unit.DeleteContact(entity)
@@ -321,25 +410,60 @@ class sandbox:
   def AsEntity(self, uid):
     ''' Return ta pointer regardless of whether uid is a pointer or an integer.
     '''
-    if type(uid) == type(sandbox_entity()):
+    if isinstance(uid, sandbox_entity):
       return uid
         
-    # Look for the correct unit in the master OOB
-    for i in range(len(self.OOB)):
-      if self.OOB[i]['uid'] == uid:
-        return self.OOB[i]
-      
-    # All else failed, return none.
-    return None  
+    # Look for the correct unit in the master OOB, none if it fails
+    try:
+      return self.index_uid.get(uid)
+    except TypeError:
+      # Not a uid (an empty field of an OPORD, for example)
+      return None
 
   def GetEntity(self, side, name):
     ''' Fetch an entity by side and name '''
-    for i in range(len(self.OOB)):
-      j = self.OOB[i]
-      if j['side'] == side and j.GetName() == name:
-        return self.OOB[i]
+    temp = self.index_name.get((side, name))
+    if temp:
+      return temp[0]
     return None
   
+  def IssueOrdersFromXML(self, doc, node):
+    '''! \brief Issue the order nodes under node (the orders node of a generated scenario, for example).
+    
+         The attributes of an order name the unit (side, unit), the task and optionally its
+         destination (MGRS) and final_stance. An order with a frago attribute amends the current
+         OPORD of the unit instead.
+
+         Orders to units that aren't in the OOB are skipped. All the orders are checked before any
+         is issued, so that a bad order leaves the world unchanged.
+         \return The number of orders issued.
+    '''
+    # Check
+    orders = []
+    for order in doc.Get(node, 'order', True):
+      tname = 'task%s'%(doc.Get(order, 'task'))
+      if not hasattr(sandbox_tasks, tname):
+        raise SandboxException('UnknownTask', tname)
+      unit = self.GetEntity(doc.Get(order, 'side'), doc.Get(order, 'unit'))
+      if unit != None:
+        orders.append((order, unit, getattr(sandbox_tasks, tname)))
+        
+    # Issue
+    count = 0
+    for order, unit, taskclass in orders:
+      task = taskclass()
+      if doc.Get(order, 'destination'):
+        task['destination'] = self.map.MGRS.AsVect(doc.Get(order, 'destination'))
+      if doc.Get(order, 'final_stance'):
+        task['final_stance'] = doc.Get(order, 'final_stance')
+      opord = OPORD(unit, unit)
+      if doc.Get(order, 'frago'):
+        opord['FRAGO'] = True
+      opord.AddTask(task)
+      unit.IssueOrder(opord)
+      count = count + 1
+    return count
+    
   def GetOOB(self, color=None, top_level =False):
     '''! \brief Return the OOB 
          \param color filter OOB for a given side.
@@ -348,12 +472,80 @@ class sandbox:
     if not color and not top_level:
       return self.OOB
     
-    out = []
+    if not top_level:
+      return list(self.index_side.get(color, []))
+    
+    if self.top_level == None:
+      self.top_level = [i for i in self.OOB if i.GetHQ() == None]
+    if not color:
+      return list(self.top_level)
+    return [i for i in self.top_level if i['side'] == color]
+  
+  def IndexEntity(self, entity):
+    '''! \brief Add an entity of the OOB to the indexes.
+    '''
+    self.index_uid[entity['uid']] = entity
+
+    key = (entity['side'], entity.GetName())
+    if not key in self.index_name:
+      self.index_name[key] = []
+    self.index_name[key].append(entity)
+    if not entity['side'] in self.index_side:
+      self.index_side[entity['side']] = []
+    self.index_side[entity['side']].append(entity)
+    self.top_level = None
+    entity.index_key = key
+    
+  def UnindexEntity(self, entity):
+    '''! \brief Remove an entity from the indexes.
+    '''
+    key = getattr(entity, 'index_key', None)
+    if key == None:
+      return
+    if self.index_uid.get(entity['uid']) is entity:
+      del self.index_uid[entity['uid']]
+    self.RemoveIdentical(self.index_name.get(key, []), entity)
+    if not self.index_name.get(key, True):
+      del self.index_name[key]
+    self.RemoveIdentical(self.index_side.get(key[0], []), entity)
+    self.top_level = None
+    entity.index_key = None
+    
+  def ChainOfCommandChanged(self):
+    '''! \brief To be called when a unit changes HQ (the top level units are listed again).
+    '''
+    self.top_level = None
+    
+  def CheckIndexes(self):
+    '''! \brief Debugging, raise an exception if the indexes don't match the OOB.
+    '''
+    # Rebuild from the OOB, compare by identity
+    names = {}
+    sides = {}
     for i in self.OOB:
-      if color and i['side'] == color or (not color):
-        if top_level and i.GetHQ() == None or (not top_level):
-          out.append(i)
-    return out
+      names.setdefault((i['side'], i.GetName()), []).append(id(i))
+      sides.setdefault(i['side'], []).append(id(i))
+    
+    if sorted([id(i) for i in self.OOB]) != sorted([id(i) for i in self.index_uid.values()]):
+      raise SandboxException('IndexMismatch','uid')
+    for i in self.index_uid:
+      if self.index_uid[i]['uid'] != i:
+        raise SandboxException('IndexMismatch','uid')
+    if names != dict([(k,[id(i) for i in v]) for k,v in self.index_name.items()]):
+      raise SandboxException('IndexMismatch','name')
+    if sides != dict([(k,[id(i) for i in v]) for k,v in self.index_side.items() if v]):
+      raise SandboxException('IndexMismatch','side')
+    if self.top_level != None and [id(i) for i in self.top_level] != [id(i) for i in self.OOB if i.GetHQ() == None]:
+      raise SandboxException('IndexMismatch','top level')
+    return True
+    
+  def RemoveIdentical(self, L, item):
+    # list.remove compares with ==, which is dict equality for entities
+    for i in range(len(L)):
+      if L[i] is item:
+        del L[i]
+        return
+
   # Interface at the Umpire level  
   #
   # Informative
@@ -373,40 +565,52 @@ class sandbox:
     '''
     # terminate batch simulation 
     endtime = self.clock + delta_time
-    ptime = self.lastpulse + self.pulse
     
-    # Layout the turn cycle
-    while ptime <= endtime:
-      self.scheduler.PostEvent(ptime,self,self.PhaseNewPulse)
-      self.scheduler.PostEvent(ptime,self,self.PhaseEngagements)
-      self.scheduler.PostEvent(ptime,self,self.PhaseStepAll)
-      self.scheduler.PostEvent(ptime,self,self.PhaseDetection)
-      self.scheduler.PostEvent(ptime,self,self.PhaseRegroup)
-      self.scheduler.PostEvent(ptime,self,self.PhaseSTAFFWORK)
-      self.scheduler.PostEvent(ptime,self,self.fileWriteAllLogs)
-      self.scheduler.PostEvent(ptime,self,self.PhaseRemoveUnits)
-      ptime = ptime + self.pulse
-      
-    # Set last pulse for the next Simulate call
-    if ptime != endtime:
-      self.lastpulse = ptime - self.pulse
-    else:
-      self.lastpulse = ptime
+    # Layout the turn cycle (once, as recurring events)
+    self.SchedulePulse()
       
     # Process all events until endtime
-    nextime = self.scheduler.NextEventTimeStamp(self.clock)
-    while nextime and nextime <= endtime:
-      # Update the clock
-      self.clock = copy(nextime)
-      # Execute the queue
-      for ev in self.scheduler.EventList(self.clock):
-        ev.Execute()
-        
-      # Delete the old scheduler events
-      self.scheduler.ShredUpTo(self.clock)
+    prof = self.profiler
+    nextime = self.scheduler.Peek()
+    while nextime != None and nextime <= endtime:
+      # Update the clock (events posted in the past are executed now)
+      if nextime > self.clock:
+        self.clock = copy(nextime)
+      if prof.enabled and prof.pulse != self.clock:
+        prof.NewPulse(self.clock)
+      # Execute the event
+      nextime, ev = self.scheduler.Pop()
+      self.rng.Call('World', [], prof.Call, getattr(ev._fn, '__name__', 'event'), None, ev.Execute)
       
       # Fetch the next time stamp
-      nextime = self.scheduler.NextEventTimeStamp(self.clock)
+      nextime = self.scheduler.Peek()
+      
+    # Set last pulse for the next Simulate call
+    while self.lastpulse + self.pulse <= endtime:
+      self.lastpulse = self.lastpulse + self.pulse
+      
+    # Bring the dormant units up to date
+    for i in self.OOB:
+      if i.dormant:
+        i.Settle(self.lastpulse)
+
+  
+  def SchedulePulse(self):
+    '''! \brief Post the phases of a pulse as recurring events, starting one pulse after the last one.
+    
+         Posted again if the pulse changes.
+    '''
+    if self.pulse_events:
+      if self.pulse_events[0].period == self.pulse:
+        return
+      for ev in self.pulse_events:
+        self.scheduler.Cancel(ev)
+    
+    ptime = self.lastpulse + self.pulse
+    self.pulse_events = []
+    for fn in [self.PhaseNewPulse, self.PhaseEngagements, self.PhaseStepAll, self.PhaseDetection,
+               self.PhaseRegroup, self.PhaseSTAFFWORK, self.fileWriteAllLogs, self.PhaseRemoveUnits]:
+      self.pulse_events.append(self.scheduler.PostRecurring(ptime, self.pulse, self, fn))
     
   def Simulate(self, delta_time = timedelta(hours = 1.0)):
     '''
@@ -424,6 +628,24 @@ class sandbox:
   def Pulse(self):
     # Return pulse time in hours
     return (self.pulse.seconds / 3600.0)
+  
+  def Profile(self, on = True):
+    '''! \brief Turn the profiler on (from scratch) or off.
+    '''
+    if on and not self.profiler.enabled:
+      self.profiler.Reset()
+    self.profiler.enabled = on
+    
+  def WriteProfile(self, folder = None):
+    '''! \brief Write the pulse table, the unit table and the flame graph stacks (profile.folded).
+         \param folder The simulation's folder by default.
+    '''
+    if folder == None:
+      folder = self.OS['savepath']
+    self.writer.Write(os.path.join(folder,'profile_pulses.txt'), self.profiler.Table())
+    self.writer.Write(os.path.join(folder,'profile_units.txt'), self.profiler.Table(units=True))
+    self.writer.Write(os.path.join(folder,'profile.folded'), self.profiler.Folded())
+    self.writer.Flush()
         
 
     
@@ -472,10 +694,7 @@ class sandbox:
     filename = os.path.join(signal.sender.FolderName(), 'COMMnet', signal.ArchiveName())
     
     # Write a text version 
-    fout = open(filename, 'w')
-    text = html.HTMLfile('COMM on net %s'%(net),signal.AsHTML())
-    fout.write(text)
-    fout.close()
+    self.writer.Write(filename, html.HTMLfile('COMM on net %s'%(net),signal.AsHTML()))
     
   # Engagement Interface
   #
@@ -504,21 +723,26 @@ class sandbox:
   def CounterBatteryOnPosition(self, pos, delivery = 'artillery'):
     '''! \brief return a list of units ordered to counter strike.
     '''
+    temp = []
     if 'shell missile'.find(delivery) != -1:
       temp = self.counterbattery
     elif delivery == 'AD':
       temp = self.SEADMisions
       
+    # The CFFZ of the units, tested at once
+    units, areas = [], []
     for i in temp:
       E = self.AsEntity(i)
       tk = E['OPORD'].GetCurrentSubtask()
       if tk:
         if 'CFFZ' in tk:
           area = E['agent'].SolveArea( tk['CFFZ'] )
-          if area.PointInside(pos):
-            out.append(E)
+          if area != None:
+            units.append(E)
+            areas.append(getattr(area, 'shape', area))
           
-    return out
+    inside = PointInPolygons(pos, areas)
+    return [units[i] for i in range(len(units)) if inside[i]]
     
   def EngagementBegin(self, A, B):
     '''
@@ -528,6 +752,10 @@ class sandbox:
       if i.UnitsIn([A,B]):
         return
     
+    # Wake up the dormant units
+    for i in [A, B]:
+      i.Wake(self.clock)
+    
     self.engagements.append(engagement(A,B))
     return self.engagements[-1]
     
@@ -566,7 +794,16 @@ class sandbox:
     '''
     # Delete all Echelon footprint
     for i in self.OOB:
-      i['agent'].PulseStaffwork()
+      if not i.dormant:
+        self.Call('Staffwork', i, i['agent'].PulseStaffwork)
+      
+    # Idle units go dormant
+    if self.lazy:
+      for i in self.OOB:
+        if not i.dormant:
+          sleep, until = self.rng.Call('Dormancy', i, i['agent'].SolveDormancy)
+          if sleep:
+            i.Sleep(self.clock, until)
   
   def PhaseRessuply(self):
     '''! Unplanned resupply
@@ -582,12 +819,31 @@ class sandbox:
        Implement a step move for all units
     '''
     for i in self.OOB:
-      i.Step(self.map, self.clock, self.Pulse())
-      i.ExpendPulseSupply()
+      if i.dormant:
+        continue
+      self.Call('Step', i, i.Step, self.map, self.clock, self.Pulse())
+      self.rng.Call('Supply', i, i.ExpendPulseSupply)
       
-    # Re-define the echelon footprints.  
+    # Re-define the echelon footprints that changed.
+    changed = self.UpdateEchelonFootprints()
+      
+    # Where everyone is now, the footprint follows the position so the other units stay put
+    self.UpdateSpatialIndex(units=changed)
+      
+  def UpdateEchelonFootprints(self):
+    '''! \brief Recompute the echelon footprints including a unit whose footprint changed since the last call.
+         \return The units whose footprint changed.
+    '''
+    changed = []
+    for i in self.OOB:
+      sig = i.Footprint().Signature()
+      if self.footprints.get(i['uid']) != sig:
+        self.footprints[i['uid']] = sig
+        i.FootprintChanged()
+        changed.append(i)
     for i in self.GetOOB(top_level=True):
-      i.EchelonFootprint(True)
+      i.EchelonFootprint()
+    return changed
       
   def PhaseStrikeResolution(self):
     '''! \brief Resolve all counter-measures (SEAD and Counter Bty) then implement strikes.
@@ -602,8 +858,13 @@ class sandbox:
   
 
   def PhaseNewPulse(self):
+    # Fresh random streams
+    self.rng.NewPulse(self.clock)
     for i in self.OOB:
+      if not i.dormant:
         i.NewPulse(self.clock)
+      elif not self.lazy or i.MustWake(self.clock):
+        i.Wake(self.clock)
         
     # Flush the communication stack
     self.commstack = []
@@ -614,25 +875,40 @@ class sandbox:
         
   def PhaseDetection(self):
     '''
-       Perform detection on all units against all units
+       Perform detection on all units against the units within reach of their sensors
+       (all units if one of the sensors is unbounded).
     '''
-    # Detector
-    A = 0
-    B = 0
-    while A < len(self.OOB):
-      B = 0
+    for A in self.OOB:
       # reset this list before starting again
-      self.OOB[A]['agent'].potentialengagements = []
+      A['agent'].potentialengagements = []
       
-      while B < len(self.OOB):
-        # Suppression
-        if self.OOB[A].IsSuppressed() or B == A:
-          B = B + 1
-          continue
-        # Detection Routine
-        self.OOB[A].Detection(self.OOB[B])
-        B = B + 1 
-      A = A + 1
+      # Suppression
+      if self.rng.Call('Suppression', A, A.IsSuppressed):
+        continue
+      
+      # Candidates from the spatial index
+      reach = self.DetectionRange(A)
+      if reach == None:
+        # By uid, as the index returns them, so that A's stream doesn't depend on the order of the OOB
+        targets = sorted(self.OOB, key=lambda x: x['uid'])
+      else:
+        targets = self.spatial.QueryRadius(A['position'], reach)
+        
+      # Detection Routine
+      self.Call('Detection', A, self.DetectionOf, A, targets)
+      
+  def Call(self, kind, unit, fn, *args):
+    '''! \brief Call a model of a unit in its random stream (see sandbox_random), timed by the profiler.
+    '''
+    return self.rng.Call(kind, unit, self.profiler.Call, kind, unit, fn, *args)
+      
+  def DetectionOf(self, A, targets):
+    '''! \brief Detection of targets by A, the areas of its sensors overlapping them solved at once.
+    '''
+    reach = A['intelligence'].SensorReach(A, targets)
+    for i in range(len(targets)):
+      if targets[i] is not A:
+        A.Detection(targets[i], reach[i])
       
       
   def PhaseEngagements(self):
@@ -644,16 +920,18 @@ class sandbox:
     '''
     # Initiate if necessary
     for i in self.OOB:
-      i['agent'].SolveInitiateEngagement()
+      if not i.dormant:
+        self.rng.Call('Initiate', i, i['agent'].SolveInitiateEngagement)
       
-    # Step over all active engagements.
+    # Step over all active engagements, each drawing from the stream of its units
     for i in self.engagements:
-      i.Step(self.Pulse())
+      self.rng.Call('Engagement', sorted(i.OOB.keys()), i.Step, self.Pulse())
       
       
   def PhaseRegroup(self):
       for i in self.OOB:
-        i.StepRegroup()
+        if not i.dormant:
+          self.rng.Call('Regroup', i, i.StepRegroup)
         
   def PhaseRemoveUnits(self):
       mydel = []
@@ -663,6 +941,9 @@ class sandbox:
           
       for i in mydel:
         self.RemoveEntity(i)
+        
+      if self.debug:
+        self.CheckIndexes()
   
 
   # 
@@ -683,9 +964,35 @@ class sandbox:
   
   #
   # Files and OS ops
-  def Save(self):
+  def Save(self, flush = True, xml = False):
     ''' 
-       Write itself as a XML file in the simulation's folder
+       Write the binary checkpoint of the world in the simulation's folder (current.bin) and the turn
+       in the Autosave history (what changed since the previous turn, see Rewind).
+       
+       \param flush Wait until all the files posted so far are written (end of turn consistency).
+       \param xml Also export the world as XML (see ExportXML).
+    '''
+    # define the file name to write to
+    current = os.path.join(self.OS['savepath'],'current.bin')
+    folder = os.path.join(self.OS['savepath'],'Autosave')
+    if self.archive == None or self.archive.folder != folder or self.archive.writer != self.writer:
+      self.archive = sandbox_checkpoint.sandbox_archive(folder, self.writer)
+    
+    # The snapshot
+    out = sandbox_checkpoint.Dumps(self)
+    
+    self.writer.Write(current, out, 'wb')
+    self.archive.Write(self)
+    
+    if xml:
+      self.ExportXML(False)
+    if flush:
+      self.writer.Flush()
+      
+  def ExportXML(self, flush = True):
+    '''
+       Write itself as a XML file in the simulation's folder (current.xml and a copy in Autosave),
+       and the state of each unit in its folder.
     '''
     # define the file name to write to
     current = os.path.join(self.OS['savepath'],'current.xml')
@@ -694,11 +1001,58 @@ class sandbox:
     # Get the XML string for it.
     out = self.ToXML()
     
-    with open(current,'w') as cf:
-      cf.write(out)
+    self.writer.Write(current, out)
+    self.writer.Write(archive, out)
+    
+    if flush:
+      self.writer.Flush()
+      
+  def Restore(self, fname):
+    '''
+       Replace the state of the world by a binary checkpoint.
+    '''
+    fin = open(fname, 'rb')
+    data = fin.read()
+    fin.close()
+    sandbox_checkpoint.Loads(self, data)
+    
+  def Rewind(self, clock):
+    '''
+       Replace the state of the world by the turn saved at clock in the Autosave history.
+       The next turn saved is a full snapshot.
+    '''
+    self.writer.Flush()
+    if self.archive == None:
+      self.archive = sandbox_checkpoint.sandbox_archive(os.path.join(self.OS['savepath'],'Autosave'), self.writer)
+
+    self.archive.Restore(self, clock)
+    
+
+  def Fork(self, n = 1, headless = True):
+    '''
+       Independent copies of the world in memory, for what-if branches. The map (and its path cache),
+       the data server and the profiler are shared; the state is restored in each branch from a
+       single checkpoint. A branch is named '<gametag> branch <i>' and is headless unless asked
+       otherwise, in which case it gets its own folder.
+       
+       \return The list of branches.
+    '''
+    data = sandbox_checkpoint.Dumps(self)
+    out = []
+    for i in range(n):
+      branch = copy(self)
+      branch.archive = None
+      branch.headless = headless
+      if headless:
+        branch.writer = sandbox_memory_writer()
+      sandbox_checkpoint.Loads(branch, data)
       
-    with open(archive,'w') as af:
-      af.write(out)
+      # Its own (virtual) folder
+      branch.fileStructure('%s branch %d'%(self.OS['gametag'], i + 1))
+      for unit in branch.OOB:
+        branch.fileNewEntity(unit)
+      out.append(branch)
+    return out
     
   def ForkWorld(self, newname):
     '''
@@ -706,7 +1060,9 @@ class sandbox:
     '''
     # Delete if newname isn't new
     temp = os.path.join(os.getcwd(),'Simulations',newname)
-    self.DeleteFolder(temp)
+    self.writer.Flush()
+    if not self.headless and os.path.exists(temp):
+      self.DeleteFolder(temp)
     
     # Create base folder structure
     self.fileStructure(newname)
@@ -734,8 +1090,11 @@ class sandbox:
       return None
     self.OS['gametag'] = savegame
     self.OS['savepath'] = os.path.join(os.getcwd(),'Simulations',savegame.replace(' ','_'))
-    # Test to create the folder
+    if self.headless:
+      return
+    # Test to create the folder (once the pending writes are done)
     try:
+      self.writer.Flush()
       self.DeleteFolder(self.OS['savepath'])
       #os.removedirs(self.OS['savepath'])
     except:
@@ -780,6 +1139,8 @@ class sandbox:
     # All other units are in the base folder
     else:
       entity['folder'] = os.path.join(self.OS['savepath'],entity['side'].upper(),tname)
+    if self.headless:
+      return
 
     try:
       # Unit's folder
@@ -818,8 +1179,13 @@ class sandbox:
       if not os.path.exists(fname):
         raise SandboxException('SaveGameNotFound', filename)
       
-      # Find the most recent savegame
-      fname = os.path.join('.',fname, 'current.xml')
+      # Find the most recent savegame, the binary checkpoint or else the XML
+      folder = fname
+      fname = os.path.join('.',folder, 'current.bin')
+      if os.path.exists(fname):
+        self.Restore(fname)
+        return True
+      fname = os.path.join('.',folder, 'current.xml')
       if not os.path.exists(fname):
         raise SandboxException('SaveGameFileNotFound', fname)
       
@@ -836,10 +1202,11 @@ class sandbox:
   def fromXML(self, doc, scenario):
     '''! \brief Either parse a XML scenario document at the scenario node level.
     '''
-    # Name and file system
-    self.OS['gametag'] = doc.Get(scenario,'name')
+    # Name and file system (an overriding game tag always starts in a fresh folder)
+    fresh = self.OS.has_key('gametag')
+    self.OS['gametag'] = self.OS.get('gametag') or doc.Get(scenario,'name')
     self.OS['savepath'] = os.path.join(os.getcwd(),'Simulations',self.OS['gametag'].replace(' ','_'))
-    if doc.Get(scenario,'reset'):
+    if doc.Get(scenario,'reset') or fresh:
       self.fileStructure(self.OS['gametag'])
     
     # Set clock
@@ -987,8 +1354,7 @@ class sandbox:
         path = os.path.join(unit.FolderName(),'current.xml')
         unitdoc = sandboXML('sandbox')
         unitdoc.AddNode(unit.toXML(unitdoc),unitdoc.root)
-        with open(path,'w') as fout:
-          fout.write(str(unitdoc))
+        self.writer.Write(path, str(unitdoc))
         
         
       doc.AddNode(oob, side)
@@ -1015,7 +1381,180 @@ class SandboxMain(unittest.TestCase):
     except:
       self.assertTrue(False)
     
+class HeadlessTest(unittest.TestCase):
+  def setUp(self):
+    self.box = sandbox('testTwoFireTeamsUTM.xml', gametag='Headless Test', headless=True)
+    self.box.SimulateScheduled(timedelta(minutes=30))
+    
+  def testNoFolder(self):
+    self.assertEqual([os.path.exists(self.box.OS['savepath']), self.box.OOB[0]['folder'].startswith(self.box.OS['savepath'])], [False, True])
+    
+  def testFilesInMemory(self):
+    logs = os.path.join(self.box.OOB[0]['folder'], 'logs.txt')
+    self.assertTrue(self.box.writer.Read(logs))
+    
+  def testKeepNothing(self):
+    box = sandbox('testTwoFireTeamsUTM.xml', gametag='Headless Test', headless=True, keep=False)
+    box.SimulateScheduled(timedelta(minutes=30))
+    self.assertEqual([box.writer.Files(), box.writer.Stats()['written'] > 0], [[], True])
+    
+  def testSaveAndRewind(self):
+    clock = self.box.GetClock()
+    self.box.Save()
+    self.box.SimulateScheduled(timedelta(minutes=30))
+    self.box.Save()
+    self.box.Rewind(clock)
+    self.assertEqual([self.box.GetClock(), os.path.exists(self.box.OS['savepath'])], [clock, False])
+    
+class EchelonFootprintTest(unittest.TestCase):
+  def setUp(self):
+    from sandbox_benchmark import sandbox_scenario_generator, IssueOrders
+    fname = sandbox_scenario_generator(units=12, depth=3).Write()
+    self.box = sandbox(fname, gametag='Echelon Footprint Test', headless=True)
+    IssueOrders(self.box, fname)
+    os.remove(os.path.join('scenarios', fname))
+    
+  def Hulls(self):
+    return [[(v.x, v.y) for v in i['Echelon Footprint'].vertices()] for i in self.box.OOB if i.has_key('Echelon Footprint')]
+    
+  def testIncrementalAsForced(self):
+    self.box.SimulateScheduled(timedelta(minutes=40))
+    hulls = self.Hulls()
+    for i in self.box.GetOOB(top_level=True):
+      i.EchelonFootprint(True)
+    self.assertEqual([bool(hulls), hulls], [True, self.Hulls()])
+    
+  def testOnlyChangedRecomputed(self):
+    self.box.PhaseStepAll()
+    top = self.box.GetOOB(top_level=True)
+    hulls = [i.EchelonFootprint() for i in top]
+    # No move, same footprints
+    self.box.UpdateEchelonFootprints()
+    self.assertEqual([i.EchelonFootprint() is h for i, h in zip(top, hulls)], [True] * len(top))
+    # A leaf moves, its chain of command is recomputed
+    leaf = [i for i in self.box.OOB if not i.Subordinates() and i.GetHQ()][0]
+    leaf['position'].Set(leaf['position'].AsVect() + vect_5D(0.5, 0.0))
+    self.box.UpdateEchelonFootprints()
+    self.assertTrue(leaf.GetHQ().EchelonFootprint().PointInside(leaf['position']))
+
+    self.assertEqual([i.EchelonFootprint() is h for i, h in zip(top, hulls)].count(False), 1)
+    
+  def testSpatialIndexOnlyChanged(self):
+    self.box.PhaseStepAll()
+    leaf = [i for i in self.box.OOB if not i.Subordinates() and i.GetHQ()][0]
+    leaf['position'].Set(leaf['position'].AsVect() + vect_5D(5.0, 5.0))
+    inserted = []
+    insert = self.box.spatial.Insert
+    def Insert(key, item, box):
+      inserted.append(key)
+      insert(key, item, box)
+    self.box.spatial.Insert = Insert
+    self.box.UpdateSpatialIndex(units=self.box.UpdateEchelonFootprints())
+    self.assertEqual([inserted, leaf in self.box.spatial.QueryPoint(leaf['position'])], [[leaf['uid']], True])
+    
+  def testSubordinateUnderLeaf(self):
+    self.box.PhaseStepAll()
+    leaves = [i for i in self.box.OOB if not i.Subordinates() and i.GetHQ()]
+    unit, leaf = leaves[0], [i for i in leaves[1:] if i.GetHQ() != leaves[0].GetHQ()][0]
+    HQ = unit.GetHQ()
+    # Far from everything, so each hull it joins or leaves changes
+    unit['position'].Set(unit['position'].AsVect() + vect_5D(20.0, 20.0))
+    self.box.UpdateEchelonFootprints()
+    for hq in [leaf, HQ]:
+      unit.ReportToHQ(hq)
+      self.box.UpdateEchelonFootprints()
+      hulls = self.Hulls()
+      for i in self.box.GetOOB(top_level=True):
+        i.EchelonFootprint(True)
+      self.assertEqual(hulls, self.Hulls())
+      self.assertTrue(hq.GetHQ().EchelonFootprint().PointInside(unit['position']))
+    
+
+class RandomStreamsTest(unittest.TestCase):
+  def setUp(self):
+    from sandbox_benchmark import sandbox_scenario_generator
+    self.fname = sandbox_scenario_generator(units=6).Write()
+    
+  def tearDown(self):
+    os.remove(os.path.join('scenarios', self.fname))
+    
+  def Run(self, reverse):
+    from sandbox_benchmark import IssueOrders
+    from sandbox_montecarlo import Outcomes
+    import random
+    random.seed(5)
+    box = sandbox(self.fname, gametag='Random Streams Test', headless=True)
+    IssueOrders(box, self.fname)
+    if reverse:
+      box.OOB.reverse()
+    clock, units = Outcomes(box, 1.0)
+    return sorted([(u['name'], u['personel'], u['supply'], u['position']) for u in units])
+    
+  def testOrderIndependent(self):
+    # Same seed, units processed in the opposite order
+    self.assertEqual(self.Run(False), self.Run(True))
+    
+  def testDetectionOrder(self):
+    box = sandbox(self.fname, gametag='Random Streams Test', headless=True)
+    box.OOB.reverse()
+    # Unbounded sensors, all of the OOB are candidates
+    box.DetectionRange = lambda E: None
+    seen = []
+    box.DetectionOf = lambda A, targets: seen.append([i['uid'] for i in targets])
+    box.PhaseDetection()
+    self.assertEqual([len(seen), seen], [len(box.OOB), [sorted(i) for i in seen]])
+    
+class OOBIndexTest(unittest.TestCase):
+  def setUp(self):
+    from sandbox_benchmark import sandbox_scenario_generator
+    fname = sandbox_scenario_generator(units=6, depth=2).Write()
+    self.box = sandbox(fname, gametag='OOB Index Test', headless=True)
+    os.remove(os.path.join('scenarios', fname))
     
+  def Scan(self):
+    '''! \brief The lookups of the indexes, by linear scans of the OOB.
+    '''
+    out = []
+    for i in self.box.OOB:
+      first = [j for j in self.box.OOB if j['side'] == i['side'] and j.GetName() == i.GetName()][0]
+      out.append((i['uid'], i, first, [j for j in self.box.OOB if j['side'] == i['side']]))
+    return out
+    
+  def Indexed(self):
+    return [(i['uid'], self.box.AsEntity(i['uid']), self.box.GetEntity(i['side'], i.GetName()), self.box.GetOOB(i['side'])) for i in self.box.OOB]
+    
+  def testAddRemove(self):
+    removed = []
+    for n in range(3):
+      unit = self.box.MakeConvoy()
+      unit['name'] = 'Convoy %d'%(n % 2)
+      unit['side'] = self.box.OOB[0]['side']
+      self.box.AddEntity(unit)
+      self.assertEqual(self.Indexed(), self.Scan())
+      victim = self.box.OOB[n]
+      removed.append(victim['uid'])
+      self.box.RemoveEntity(victim)
+      self.assertEqual(self.Indexed(), self.Scan())
+    self.assertEqual([self.box.AsEntity(i) for i in removed], [None] * 3)
+    self.assertEqual([self.box.CheckIndexes(), self.box.GetEntity('nobody', 'Convoy 0')], [True, None])
+    
+  def testTopLevel(self):
+    top = [i for i in self.box.OOB if i.GetHQ() == None]
+    self.assertEqual(self.box.GetOOB(top_level=True), top)
+    unit = [i for i in self.box.OOB if i.GetHQ()][0]
+    HQ = unit.GetHQ()
+    unit.ReportToHQ(None)
+    self.assertEqual(self.box.GetOOB(top_level=True), [i for i in self.box.OOB if i.GetHQ() == None])
+    self.assertTrue(unit in self.box.GetOOB(unit['side'], top_level=True))
+    unit.ReportToHQ(HQ)
+    self.assertEqual([self.box.GetOOB(top_level=True), self.box.CheckIndexes()], [top, True])
+    
+  def testNotUID(self):
+    # Empty fields of an OPORD are dictionaries
+    self.assertEqual([self.box.AsEntity({}), self.box.AsEntity([]), self.box.AsEntity('')], [None, None, None])
+    
+
+
 if __name__ == '__main__':
     # suite
     testsuite = []
@@ -1025,4 +1564,4 @@ if __name__ == '__main__':
     
     # collate all and run
     allsuite = unittest.TestSuite(testsuite)
-    unittest.TextTestRunner(verbosity=2).run(allsuite)
+    unittest.TextTestRunner(verbosity=2).run(allsuite)
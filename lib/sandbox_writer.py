@@ -0,0 +1,315 @@
+'''
+    Writer -- Background thread for the file output of the simulation.
+    OPCON Sandbox -- Extensible Operational level military simulation.
+    Copyright (C) 2007 Christian Blouin
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 2 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+'''
+
+# Import
+import atexit
+import threading
+import time
+import zipfile
+from Queue import Queue, Full, Empty
+
+from sandbox_exception import SandboxException
+
+
+class sandbox_writer:
+  '''! \brief A single thread that writes files in the order they are posted.
+
+       The simulation posts the content of the files (already rendered) and carries on. The queue
+       is bounded so that a slow file system pushes back on the simulation instead of filling
+       the memory. Consecutive appends to the same file are written with a single open.
+       Errors are kept and raised by the next Flush().
+
+       \param maxsize The number of pending writes before Write() blocks.
+       \param threaded Write in the calling thread instead (for debugging).
+  '''
+  def __init__(self, maxsize = 512, threaded = True):
+    self.queue = Queue(maxsize)
+    self.threaded = threaded
+    self.thread = None
+    self.lock = threading.Lock()
+    self.errors = []
+    self.ResetStats()
+
+  def ResetStats(self):
+    # Back-pressure metrics
+    self.stats = {'posted':0, 'written':0, 'opens':0, 'bytes':0, 'blocked':0, 'blocked time':0.0,
+                  'max depth':0, 'write time':0.0, 'flushes':0, 'flush time':0.0}
+
+  # Interface
+  def Write(self, fname, data, mode = 'w'):
+    '''! \brief Post the content of a file. mode is 'w' (replace) or 'a' (append).
+    '''
+    self.stats['posted'] += 1
+    if not self.threaded:
+      self.WriteBatch([(fname, mode, data)])
+      return
+    self.Start()
+    item = (fname, mode, data)
+    try:
+      self.queue.put_nowait(item)
+    except Full:
+      # The writer can't keep up, wait for it
+      t = time.time()
+      self.queue.put(item)
+      self.stats['blocked'] += 1
+      self.stats['blocked time'] += time.time() - t
+    self.stats['max depth'] = max(self.stats['max depth'], self.queue.qsize())
+
+  def Append(self, fname, data):
+    self.Write(fname, data, 'a')
+
+  def Flush(self):
+    '''! \brief Barrier, returns once all posted writes are on disk.
+    '''
+    t = time.time()
+    if self.thread:
+      self.queue.join()
+    self.stats['flushes'] += 1
+    self.stats['flush time'] += time.time() - t
+
+    # Report the errors
+    with self.lock:
+      errors, self.errors = self.errors, []
+    if errors:
+      raise SandboxException('WriterError', errors)
+
+  def Pending(self):
+    return self.queue.qsize()
+
+  def Stats(self):
+    '''! \brief A copy of the metrics, with the current depth of the queue.
+    '''
+    out = dict(self.stats)
+    out['pending'] = self.Pending()
+    return out
+
+  # Private methods
+  def Start(self):
+    if self.thread and self.thread.is_alive():
+      return
+    self.thread = threading.Thread(target=self.Run, name='sandbox_writer')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Run(self):
+    while True:
+      # Take all that is pending
+      batch = [self.queue.get()]
+      try:
+        while True:
+          batch.append(self.queue.get_nowait())
+      except Empty:
+        pass
+      try:
+        self.WriteBatch(batch)
+      finally:
+        for i in batch:
+          self.queue.task_done()
+
+  def WriteBatch(self, batch):
+    '''! \brief Write the items in order, merging consecutive appends to the same file.
+    '''
+    t = time.time()
+    i = 0
+    while i < len(batch):
+      fname, mode, data = batch[i]
+      chunks = [data]
+      i += 1
+      while mode == 'a' and i < len(batch) and batch[i][0] == fname and batch[i][1] == 'a':
+        chunks.append(batch[i][2])
+        i += 1
+      try:
+        with open(fname, mode) as fout:
+          for c in chunks:
+            fout.write(c)
+        self.stats['opens'] += 1
+        self.stats['written'] += len(chunks)
+        self.stats['bytes'] += sum([len(c) for c in chunks])
+      except Exception, e:
+        # Kept for Flush(), the rest of the batch is still written
+        with self.lock:
+          self.errors.append((fname, str(e)))
+    self.stats['write time'] += time.time() - t
+
+
+class sandbox_memory_writer:
+  '''! \brief The writer of a headless simulation: files are kept in memory, nothing touches the disk.
+
+       Same interface as sandbox_writer. The content of the files can be read back (Read, Files)
+       or written as a single zip file (Archive) at the end of the run.
+
+       \param keep Keep the content of the files, else only count them.
+  '''
+  def __init__(self, keep = True):
+    self.keep = keep
+    # fname : [chunks]
+    self.files = {}
+    self.ResetStats()
+
+  def ResetStats(self):
+    self.stats = {'posted':0, 'written':0, 'opens':0, 'bytes':0, 'blocked':0, 'blocked time':0.0,
+                  'max depth':0, 'write time':0.0, 'flushes':0, 'flush time':0.0}
+
+  # Interface
+  def Write(self, fname, data, mode = 'w'):
+    self.stats['posted'] += 1
+    self.stats['written'] += 1
+    self.stats['bytes'] += len(data)
+    if not self.keep:
+      return
+    if mode.startswith('a') and fname in self.files:
+      self.files[fname].append(data)
+    else:
+      self.files[fname] = [data]
+
+  def Append(self, fname, data):
+    self.Write(fname, data, 'a')
+
+  def Flush(self):
+    self.stats['flushes'] += 1
+
+  def Pending(self):
+    return 0
+
+  def Stats(self):
+    out = dict(self.stats)
+    out['pending'] = 0
+    return out
+
+  def Read(self, fname):
+    '''! \brief The content of a file, or None.
+    '''
+    if not fname in self.files:
+      return None
+    return ''.join(self.files[fname])
+
+  def Files(self):
+    out = self.files.keys()
+    out.sort()
+    return out
+
+  def Archive(self, fname, root = ''):
+    '''! \brief Write all the files in a zip file, with their names relative to root.
+    '''
+    out = zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED)
+    try:
+      for name in self.Files():
+        arcname = name
+        if root and name.startswith(root):
+          arcname = name[len(root):].lstrip('/\\')
+        out.writestr(arcname, self.Read(name))
+    finally:
+      out.close()
+    return fname
+
+
+# The writer shared by all simulations of a process
+
+_writer = None
+def SharedWriter():
+  '''! \brief The writer thread of this process (created on demand, flushed at exit).
+  '''
+  global _writer
+  if _writer == None:
+    _writer = sandbox_writer()
+    atexit.register(_writer.queue.join)
+  return _writer
+
+
+import unittest
+import os
+import os.path
+import tempfile
+import shutil
+class WriterTest(unittest.TestCase):
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.writer = sandbox_writer(maxsize=2)
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def Read(self, name):
+    with open(os.path.join(self.folder, name)) as fin:
+      return fin.read()
+
+  def testWriteAndAppendInOrder(self):
+    fname = os.path.join(self.folder, 'logs.txt')
+    self.writer.Write(fname, 'a\n')
+    for i in range(20):
+      self.writer.Append(fname, '%d\n'%(i))
+    self.writer.Flush()
+    self.assertEqual(self.Read('logs.txt'), 'a\n' + ''.join(['%d\n'%(i) for i in range(20)]))
+
+  def testOverwrite(self):
+    fname = os.path.join(self.folder, 'current.xml')
+    self.writer.Write(fname, 'first')
+    self.writer.Write(fname, 'second')
+    self.writer.Flush()
+    self.assertEqual(self.Read('current.xml'), 'second')
+
+  def testStats(self):
+    for i in range(10):
+      self.writer.Write(os.path.join(self.folder, '%d.html'%(i)), 'x')
+    self.writer.Flush()
+    stats = self.writer.Stats()
+    self.assertEqual([stats['posted'], stats['written'], stats['bytes'], stats['pending']], [10, 10, 10, 0])
+
+  def testErrorRaisedAtFlush(self):
+    self.writer.Write(os.path.join(self.folder, 'nofolder', 'x.txt'), 'x')
+    self.assertRaises(SandboxException, self.writer.Flush)
+
+  def testBadItemDoesNotDropBatch(self):
+    names = [os.path.join(self.folder, '%d.txt'%(i)) for i in range(3)]
+    self.writer.WriteBatch([(names[0], 'w', 'x'), (names[1], 'w', None), (names[2], 'w', u'\xe9')])
+    self.writer.Write(names[1], 'y')
+    self.assertRaises(SandboxException, self.writer.Flush)
+    self.assertEqual([self.Read('0.txt'), self.Read('1.txt'), self.writer.thread.is_alive()], ['x', 'y', True])
+
+
+  def testUnthreaded(self):
+    writer = sandbox_writer(threaded=False)
+    writer.Write(os.path.join(self.folder, 'x.txt'), 'x')
+    self.assertEqual([writer.thread, self.Read('x.txt')], [None, 'x'])
+
+
+class MemoryWriterTest(unittest.TestCase):
+  def setUp(self):
+    self.writer = sandbox_memory_writer()
+
+  def testWriteAndAppend(self):
+    self.writer.Write('a/logs.txt', 'a\n')
+    self.writer.Append('a/logs.txt', 'b\n')
+    self.writer.Write('a/current.bin', 'x', 'wb')
+    self.writer.Write('a/current.bin', 'y', 'wb')
+    self.assertEqual([self.writer.Read('a/logs.txt'), self.writer.Read('a/current.bin'), self.writer.Read('a/none')], ['a\nb\n', 'y', None])
+
+  def testNotKept(self):
+    writer = sandbox_memory_writer(keep=False)
+    writer.Write('a/logs.txt', 'abc')
+    self.assertEqual([writer.Files(), writer.Stats()['bytes']], [[], 3])
+
+  def testArchive(self):
+    folder = tempfile.mkdtemp()
+    try:
+      self.writer.Write(os.path.join('sim', 'BLUE', 'logs.txt'), 'a')
+      fname = self.writer.Archive(os.path.join(folder, 'sim.zip'), 'sim')
+      self.assertEqual(zipfile.ZipFile(fname).read(os.path.join('BLUE', 'logs.txt')), 'a')
+    finally:
+      shutil.rmtree(folder)